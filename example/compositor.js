@@ -0,0 +1,87 @@
+// Reference browser compositor for patch-mode streams.
+//
+//   import { PatchCompositor } from "./compositor.js";
+//   const compositor = new PatchCompositor(canvas, "http://localhost:8000", "short_avatar");
+//   await compositor.load();                 // base frames, fetched once (HTTP-cached)
+//   await compositor.play(audioFileOrBlob);  // POST audio, draw patches as they arrive
+
+export class PatchCompositor {
+  constructor(canvas, serverUrl, avatarId) {
+    this.canvas = canvas;
+    this.ctx = canvas.getContext("2d");
+    this.serverUrl = serverUrl;
+    this.avatarId = avatarId;
+    this.frames = [];
+  }
+
+  async load() {
+    const base = `${this.serverUrl}/avatars/${this.avatarId}/bundle`;
+    this.manifest = await (await fetch(`${base}/manifest`)).json();
+    this.canvas.width = this.manifest.width;
+    this.canvas.height = this.manifest.height;
+    this.frames = await Promise.all(
+      this.manifest.frames.map(async (_, i) =>
+        createImageBitmap(await (await fetch(`${base}/frames/${i}`)).blob())
+      )
+    );
+  }
+
+  async play(audio, options = {}) {
+    const form = new FormData();
+    form.append("audio_file", audio, "audio.wav");
+    form.append("mode", "patch");
+    if (options.lipStride) form.append("lip_stride", String(options.lipStride));
+
+    const response = await fetch(`${this.serverUrl}/inference/stream/${this.avatarId}`, {
+      method: "POST",
+      body: form,
+    });
+    if (!response.ok) throw new Error(`Stream failed: ${response.status}`);
+
+    for await (const { headers, body } of iterParts(response.body)) {
+      const [x1, y1] = headers["x-patch-box"].split(",").map(Number);
+      const patch = await createImageBitmap(new Blob([body], { type: "image/jpeg" }));
+      this.ctx.drawImage(this.frames[Number(headers["x-cycle-index"])], 0, 0);
+      this.ctx.drawImage(patch, x1, y1);
+      patch.close();
+    }
+  }
+}
+
+// Parses a multipart/x-mixed-replace body whose parts carry Content-Length.
+async function* iterParts(stream) {
+  const reader = stream.getReader();
+  const decoder = new TextDecoder();
+  let buffer = new Uint8Array(0);
+
+  const headerEnd = (buf) => {
+    for (let i = 0; i + 3 < buf.length; i++) {
+      if (buf[i] === 13 && buf[i + 1] === 10 && buf[i + 2] === 13 && buf[i + 3] === 10) return i;
+    }
+    return -1;
+  };
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) return;
+    const merged = new Uint8Array(buffer.length + value.length);
+    merged.set(buffer);
+    merged.set(value, buffer.length);
+    buffer = merged;
+
+    while (true) {
+      const end = headerEnd(buffer);
+      if (end < 0) break;
+      const headers = {};
+      for (const line of decoder.decode(buffer.subarray(0, end)).split("\r\n")) {
+        const sep = line.indexOf(": ");
+        if (sep > 0) headers[line.slice(0, sep).toLowerCase()] = line.slice(sep + 2);
+      }
+      const length = Number(headers["content-length"]);
+      const start = end + 4;
+      if (buffer.length < start + length + 2) break;
+      yield { headers, body: buffer.slice(start, start + length) };
+      buffer = buffer.slice(start + length + 2);
+    }
+  }
+}
@@ -0,0 +1,99 @@
+"""
+Reference client-side compositor for patch-mode streams.
+
+Downloads the avatar's cycle bundle once, then requests a patch-mode stream and
+draws every face patch over its base frame. Frames are shown in a window or
+written to a directory.
+
+    python example/compositor.py short_avatar data/audio/eng.wav --show
+"""
+import argparse
+import io
+import json
+import os
+import zipfile
+import cv2
+import httpx
+import numpy as np
+
+SERVER_URL = "http://localhost:8000"
+
+class PatchCompositor:
+    """
+    Holds the decoded base frames of one avatar bundle and composites patches onto them.
+    """
+    def __init__(self, bundle_bytes: bytes):
+        self._zip = zipfile.ZipFile(io.BytesIO(bundle_bytes))
+        self.manifest = json.loads(self._zip.read("manifest.json"))
+        self._frames = {}
+
+    def base_frame(self, cycle_index: int) -> np.ndarray:
+        frame = self._frames.get(cycle_index)
+        if frame is None:
+            data = np.frombuffer(self._zip.read(self.manifest["frames"][cycle_index]), np.uint8)
+            frame = self._frames[cycle_index] = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        return frame
+
+    def composite(self, cycle_index: int, box, jpeg: bytes) -> np.ndarray:
+        frame = self.base_frame(cycle_index).copy()
+        x1, y1, x2, y2 = box
+        patch = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        frame[y1:y2, x1:x2] = patch[:y2 - y1, :x2 - x1]
+        return frame
+
+def iter_parts(chunks):
+    """
+    Parses a multipart/x-mixed-replace stream whose parts carry Content-Length.
+    Yields (headers, body) pairs.
+    """
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            header_end = buffer.find(b"\r\n\r\n")
+            if header_end < 0:
+                break
+            lines = buffer[:header_end].decode().split("\r\n")
+            headers = dict(line.split(": ", 1) for line in lines if ": " in line)
+            length = int(headers["Content-Length"])
+            body_start = header_end + 4
+            if len(buffer) < body_start + length + 2:
+                break
+            yield headers, buffer[body_start:body_start + length]
+            buffer = buffer[body_start + length + 2:]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("avatar_id")
+    parser.add_argument("audio")
+    parser.add_argument("--server", default=SERVER_URL)
+    parser.add_argument("--show", action="store_true", help="Display frames in a window")
+    parser.add_argument("--out", default=None, help="Directory to write composited frames to")
+    args = parser.parse_args()
+
+    bundle = httpx.get(f"{args.server}/avatars/{args.avatar_id}/bundle", timeout=None)
+    bundle.raise_for_status()
+    compositor = PatchCompositor(bundle.content)
+    print(f"Bundle: {compositor.manifest['cycle_len']} frames, {len(bundle.content) / 1024 / 1024:.2f} MB")
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+
+    received = 0
+    with open(args.audio, "rb") as f:
+        files = {"audio_file": (os.path.basename(args.audio), f, "audio/wav")}
+        with httpx.stream("POST", f"{args.server}/inference/stream/{args.avatar_id}",
+                          data={"mode": "patch"}, files=files, timeout=None) as response:
+            response.raise_for_status()
+            for headers, jpeg in iter_parts(response.iter_bytes()):
+                received += len(jpeg)
+                box = [int(v) for v in headers["X-Patch-Box"].split(",")]
+                frame = compositor.composite(int(headers["X-Cycle-Index"]), box, jpeg)
+                if args.out:
+                    cv2.imwrite(os.path.join(args.out, f"{int(headers['X-Frame-Index']):08d}.jpg"), frame)
+                if args.show:
+                    cv2.imshow("MuseTalk", frame)
+                    cv2.waitKey(1)
+    print(f"Stream finished. Received {received / 1024 / 1024:.2f} MB of patches")
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import os
 
 from musetalk_server.conf import conf as settings
 from musetalk_server.core.model_loader import model_loader
-from musetalk_server.routers import system, avatars, inference
+from musetalk_server.services.result_cache import result_cache
+from musetalk_server.services.session import session_manager
+from musetalk_server.services.jobs import job_manager
+from musetalk_server.services.uploads import upload_store
+from musetalk_server.services.warmup import warmup, preload_list
+from musetalk_server.routers import system, avatars, inference, sessions, jobs
+from musetalk_server.routing import AffinityRouter, AffinityMiddleware
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -12,17 +19,34 @@ async def lifespan(app: FastAPI):
     print("Starting MuseTalk Server...")
     print(f"Configuration: {settings.dict()}")
     try:
-        # Pre-load models on startup to avoid latency on first request
-        # This can be disabled for faster dev startup if needed
+        # Pre-load the models this node's role needs to avoid latency on first request.
+        # Anything else is loaded on demand and unloaded again when idle.
         model_loader.load()
-        print("Models loaded successfully.")
+        print(f"Models loaded successfully (role: {model_loader.role}).")
     except Exception as e:
         print(f"Error loading models during startup: {e}")
+    model_loader.start_idle_reaper()
+    # Warm avatars in the background; /health reports "ready" once they are loaded
+    warmup.start(
+        preload_list(settings.preload_avatars, settings.preload_recent,
+                     os.path.join(settings.result_dir, settings.version, "avatars")),
+        avatars.preload_avatar
+    )
+    # Apply size/TTL limits to renders left over from previous runs
+    result_cache.evict()
+    if avatars.shared_store is not None:
+        # Drop shared avatar files left behind by processes that have exited
+        avatars.shared_store.collect()
+    upload_store.gc(settings.result_dir)
+    session_manager.start_idle_reaper()
+    # Bulk render jobs, resuming the ones a previous run left unfinished
+    job_manager.start(jobs.run_job)
     
     yield
     
     # Shutdown logic (if any)
     print("Shutting down MuseTalk Server...")
+    session_manager.close_all()
 
 app = FastAPI(
     title="MuseTalk API",
@@ -40,11 +64,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Avatar-affinity routing between nodes (optional)
+if settings.route_nodes:
+    app.add_middleware(
+        AffinityMiddleware,
+        router=AffinityRouter(settings.route_nodes.split(","), min_spare_fps=settings.route_min_spare_fps),
+        self_url=settings.route_self_url,
+    )
+
 # Include Routers
 app.include_router(system.router, tags=["System"])
 app.include_router(avatars.router, tags=["Avatars"])
 app.include_router(inference.router, tags=["Inference"])
+app.include_router(sessions.router, tags=["Sessions"])
+app.include_router(jobs.router, tags=["Jobs"])
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("musetalk_server.app:app", host=settings.host, port=settings.port, reload=False)
+    uvicorn.run("musetalk_server.app:app", host=settings.host, port=settings.port, reload=False, workers=settings.workers)
@@ -0,0 +1,213 @@
+"""
+Offline benchmarks and parity checks. Run from the MuseTalk/ directory like the server:
+
+    python -m musetalk_server.bench engine --backends eager,torchscript,onnx
+    python -m musetalk_server.bench lip-stride --strides 1,2,3
+    python -m musetalk_server.bench cpu-profile --profiles fp32,bf16,int8
+    python -m musetalk_server.bench landmarks --video data/video/anna.mp4 --intervals 5,10,25
+
+Set CUDA_VISIBLE_DEVICES= (empty) to measure the CPU path on a GPU host.
+"""
+import copy
+import argparse
+import json
+import time
+
+def run_engine(args):
+    from musetalk_server.core.model_loader import model_loader
+    from musetalk_server.core.engine import check_parity, benchmark
+
+    reference = model_loader.get_engine("eager")
+    device = model_loader.device
+    results = []
+    for backend in args.backends.split(","):
+        engine = reference if backend == "eager" else model_loader.get_engine(backend)
+        if engine.name != backend:
+            print(f"Skipping {backend}: engine could not be built")
+            continue
+        row = {
+            "backend": backend,
+            "device": str(device),
+            "batch_size": args.batch_size,
+            "fps": round(benchmark(engine, device, args.batch_size, args.iterations, args.warmup), 2),
+        }
+        if backend != "eager":
+            row["parity"] = check_parity(engine, reference, device, batch_sizes=(1, args.batch_size))
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+def run_lip_stride(args):
+    """
+    Output frames per second of prediction time (PE -> UNet -> VAE, plus crop
+    interpolation) for each lip stride, on synthetic whisper prompts and latents.
+    """
+    import torch
+    from musetalk_server.core.model_loader import model_loader, INFERENCE_COMPONENTS
+    from musetalk_server.core.engine import AUDIO_FEATURE_SHAPE, LATENT_SHAPE
+    from musetalk_server.services.inference import InferenceModels, predict_batches
+
+    models = model_loader.get_models(INFERENCE_COMPONENTS)
+    engine = model_loader.get_engine(args.backend) if args.backend else models['engine']
+    inference_models = InferenceModels(
+        vae=models['vae'], unet=models['unet'], pe=models['pe'],
+        audio_processor=models['audio_processor'], whisper=models['whisper'],
+        timesteps=models['timesteps'], engine=engine
+    )
+    device = models['device']
+    latent_cycle = torch.randn(args.cycle_len, *LATENT_SHAPE, dtype=engine.dtype, device=device)
+    cycle_index = torch.arange(args.frames, device=device) % args.cycle_len
+    prompts = torch.randn(args.frames, *AUDIO_FEATURE_SHAPE, dtype=engine.dtype)
+    batches = [prompts[i:i + args.batch_size] for i in range(0, args.frames, args.batch_size)]
+
+    def sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    results = []
+    baseline = None
+    for stride in [int(k) for k in args.strides.split(",")]:
+        for _ in predict_batches(inference_models, iter(batches[:args.warmup]), latent_cycle, cycle_index, device, stride):
+            pass
+        sync()
+        start = time.perf_counter()
+        frames = sum(len(recon) for recon in
+                     predict_batches(inference_models, iter(batches), latent_cycle, cycle_index, device, stride))
+        sync()
+        fps = frames / (time.perf_counter() - start)
+        baseline = baseline or fps
+        row = {
+            "lip_stride": stride,
+            "backend": engine.name,
+            "device": str(device),
+            "batch_size": args.batch_size,
+            "frames": frames,
+            "fps": round(fps, 2),
+            "speedup": round(fps / baseline, 2),
+        }
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+def run_cpu_profile(args):
+    """
+    Throughput and deviation from fp32 of each CPU profile: the engine (PE +
+    UNet + VAE decode) on synthetic batches and the Whisper encoder on one window.
+    """
+    from musetalk_server.conf import conf
+    # Load the fp32 modules as the reference; each profile is applied to a copy
+    conf.cpu_profile = "fp32"
+    from musetalk_server.core.model_loader import model_loader, INFERENCE_COMPONENTS
+    from musetalk_server.core.engine import EagerEngine, check_parity, benchmark
+    from musetalk_server.core.cpu_profile import resolve_profile, profile_components, whisper_report
+
+    models = model_loader.get_models(INFERENCE_COMPONENTS)
+    device = models['device']
+    if device.type != "cpu":
+        print("CPU profiles apply to CPU hosts only; run with CUDA_VISIBLE_DEVICES=")
+        return []
+    reference = EagerEngine(models['pe'], models['unet'], models['vae'], models['timesteps'])
+    components = {"whisper": models['whisper'], "pe": models['pe'], "unet": models['unet'].model,
+                  "vae": models['vae'].vae}
+
+    results = []
+    baseline = None
+    for requested in args.profiles.split(","):
+        profile = resolve_profile(requested)
+        optimized = profile_components(components, profile)
+        unet = copy.copy(models['unet'])
+        unet.model = optimized["unet"]
+        vae = copy.copy(models['vae'])
+        vae.vae = optimized["vae"]
+        engine = EagerEngine(optimized["pe"], unet, vae, models['timesteps'])
+        fps = benchmark(engine, device, args.batch_size, args.iterations, args.warmup)
+        baseline = baseline or fps
+        row = {
+            "profile": requested,
+            "applied": profile,
+            "batch_size": args.batch_size,
+            "fps": round(fps, 2),
+            "speedup": round(fps / baseline, 2),
+            "parity": check_parity(engine, reference, device, batch_sizes=(1, args.batch_size)),
+            **whisper_report(models['whisper'], optimized["whisper"], args.iterations),
+        }
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+def run_landmarks(args):
+    """
+    Preprocessing landmark stage on a source video: detection on every frame
+    against keyframe detection at each interval, with the keyframe accuracy report.
+    """
+    import glob
+    import tempfile
+    from musetalk_server.core.model_loader import model_loader
+    from musetalk_server.services.preprocess import (
+        video2imgs, detect_landmarks, detect_landmarks_keyframes, keyframe_report,
+    )
+
+    dwpose = model_loader.get_models(("dwpose",))["dwpose"]
+    results = []
+    with tempfile.TemporaryDirectory() as frames_dir:
+        video2imgs(args.video, frames_dir, ext='.png', cut_frame=args.frames)
+        img_list = sorted(glob.glob(f"{frames_dir}/*.png"))
+        start = time.perf_counter()
+        full = detect_landmarks(dwpose, img_list)
+        baseline = time.perf_counter() - start
+        for interval in [int(i) for i in args.intervals.split(",")]:
+            start = time.perf_counter()
+            tracked, detected = detect_landmarks_keyframes(dwpose, img_list, interval, args.motion_threshold)
+            elapsed = time.perf_counter() - start
+            row = {
+                "interval": interval,
+                "frames": len(img_list),
+                "detected": len(detected),
+                "seconds": round(elapsed, 2),
+                "speedup": round(baseline / elapsed, 2),
+                **keyframe_report(full, tracked, args.bbox_shift),
+            }
+            results.append(row)
+            print(json.dumps(row))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m musetalk_server.bench")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    engine = sub.add_parser("engine", help="Compare inference engine backends against eager mode")
+    engine.add_argument("--backends", default="eager,torchscript,onnx")
+    engine.add_argument("--batch-size", type=int, default=4)
+    engine.add_argument("--iterations", type=int, default=10)
+    engine.add_argument("--warmup", type=int, default=2)
+    engine.set_defaults(func=run_engine)
+
+    lip = sub.add_parser("lip-stride", help="Frames per second of prediction time for reduced-rate lip inference")
+    lip.add_argument("--strides", default="1,2,3")
+    lip.add_argument("--backend", default=None, help="Engine backend (default: MUSETALK_ENGINE_BACKEND)")
+    lip.add_argument("--batch-size", type=int, default=4)
+    lip.add_argument("--frames", type=int, default=250)
+    lip.add_argument("--cycle-len", type=int, default=50)
+    lip.add_argument("--warmup", type=int, default=2)
+    lip.set_defaults(func=run_lip_stride)
+
+    cpu = sub.add_parser("cpu-profile", help="Speed and accuracy of the CPU inference profiles against fp32")
+    cpu.add_argument("--profiles", default="fp32,bf16,int8", help="Comma-separated; the first is the speedup baseline")
+    cpu.add_argument("--batch-size", type=int, default=4)
+    cpu.add_argument("--iterations", type=int, default=5)
+    cpu.add_argument("--warmup", type=int, default=1)
+    cpu.set_defaults(func=run_cpu_profile)
+
+    landmarks = sub.add_parser("landmarks", help="Speed and accuracy of keyframe landmark detection against every frame")
+    landmarks.add_argument("--video", required=True, help="Source video of an avatar")
+    landmarks.add_argument("--intervals", default="5,10,25")
+    landmarks.add_argument("--motion-threshold", type=float, default=0.05)
+    landmarks.add_argument("--bbox-shift", type=int, default=0)
+    landmarks.add_argument("--frames", type=int, default=10000000, help="Only the first N frames")
+    landmarks.set_defaults(func=run_landmarks)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,8 @@ class MuseTalkSettings(BaseSettings):
     Defaults match scripts/realtime_inference.py arguments.
     """
     version: str = "v15"
+    role: str = "all"  # inference / preprocess / all: which models stay resident
+    model_idle_timeout: float = 600.0  # Seconds before on-demand models are unloaded (0 = never)
     host: str = "0.0.0.0"
     port: int = 8000
     ffmpeg_path: str = "ffmpeg"
@@ -22,6 +24,46 @@ class MuseTalkSettings(BaseSettings):
     audio_padding_length_left: int = 2
     audio_padding_length_right: int = 2
     batch_size: int = 4  # Reduced from 20 to prevent OOM errors
+    lip_stride: int = 1  # Run UNet/VAE on every k-th frame and interpolate the rest (1 = every frame)
+    engine_backend: str = "eager"  # eager / torchscript / onnx for PE, UNet and VAE decoder
+    engine_cache_dir: str = ""  # Exported engine artifacts (default: "engines/" next to the UNet weights)
+    latent_device_budget_mb: int = 1024  # Avatar latent cycles kept on the GPU (0 = gather on host)
+    cpu_profile: str = "fp32"  # fp32 / bf16 / int8 / auto: model precision on CPU-only hosts (see README)
+    cpu_threads: int = 0  # PyTorch intra-op threads on CPU-only hosts (0 = all cores not kept for blending)
+    cpu_blend_threads: int = 2  # Cores kept for the blend/encode workers and OpenCV on CPU-only hosts
+    blend_backend: str = "cv2"  # cv2 (per frame on the CPU) / torch (batched tensor ops on the inference device)
+    jpeg_splice: bool = True  # Encode frames by splicing the face region into pre-encoded cycle frames
+    memory_release: str = "idle"  # request / idle / never: when cached GPU memory is freed and a full GC runs
+    realtime_prebuffer_frames: int = 0  # Jitter buffer of real-time streams (0 = twice the batch size)
+    gpu_slots: int = 1  # Batches running on the device at once; the rest wait by priority (0 = no scheduling)
+    priority_aging_seconds: float = 10.0  # A waiting batch moves up one priority class per this many seconds (0 = no aging)
+    priority_api_keys: str = ""  # Comma-separated key=class pairs assigning a priority class per X-API-Key
+    capacity_fps: float = 0.0  # Device frames/s reported by /capacity (0 = measured from rendered batches)
+    route_nodes: str = ""  # Comma-separated node URLs for avatar-affinity routing (empty = off, see README)
+    route_self_url: str = ""  # This node's URL in MUSETALK_ROUTE_NODES (requests routed to it are served locally)
+    route_min_spare_fps: float = 0.0  # Spare fps below which a node counts as saturated (0 = one stream at its fps)
+    inference_timeout: float = 0.0  # Seconds before a render is cancelled (0 = no limit)
+    result_cache_enabled: bool = True  # Serve repeated batch renders from results/inference/
+    result_cache_max_mb: int = 2048  # Size limit of results/inference/ (0 = unlimited)
+    result_cache_ttl: float = 86400.0  # Seconds an unused render is kept (0 = forever)
+    upload_gc_grace: float = 3600.0  # Seconds before an upload no avatar refers to is removed
+    preload_avatars: str = ""  # Comma-separated avatar ids loaded at startup
+    preload_recent: int = 0  # Also preload the N most recently used avatars
+    avatar_decode_workers: int = 8  # Threads decoding an avatar's frames and masks when it is loaded
+    avatar_shared_memory: bool = False  # Share decoded avatars between worker processes (see README)
+    avatar_shared_dir: str = ""  # Directory of the shared avatar files (default: /dev/shm/musetalk-avatars)
+    avatar_store_url: str = ""  # Shared avatar store: a directory (NFS), file:///path or s3://bucket/prefix (empty = off)
+    avatar_store_endpoint_url: str = ""  # Endpoint of an S3-compatible service (MinIO, R2, ...; empty = AWS)
+    avatar_store_publish: bool = True  # Publish avatars to the store after preprocessing
+    avatar_cache_max_mb: int = 0  # Avatars fetched from the store kept on local disk (0 = unlimited)
+    avatar_fetch_workers: int = 4  # Concurrent avatar fetches / ranged S3 requests per download
+    workers: int = 1  # uvicorn worker processes when started with `python -m musetalk_server.app`
+    max_sessions: int = 8  # Concurrent avatar sessions (0 = unlimited)
+    session_idle_timeout: float = 300.0  # Seconds before an unused session is closed (0 = never)
+    job_paths_root: str = ""  # Server directory bulk jobs may read audio from and write outputs to (empty = uploads only)
+    job_feature_cache_mb: int = 1024  # Audio and Whisper prompts a bulk job keeps for clips used by several items
+    landmark_keyframe_interval: int = 0  # Detect landmarks every N frames and interpolate (0/1 = every frame)
+    landmark_motion_threshold: float = 0.05  # Face box motion (share of face size) that forces detection in between
     parsing_mode: str = "jaw"
     left_cheek_width: int = 90
     right_cheek_width: int = 90
@@ -3,7 +3,32 @@ import cv2
 import pickle
 import torch
 import glob
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Optional
+from musetalk_server.core.jpeg_splice import JpegSplicer
+
+class _DeviceBudget:
+    """
+    Process-wide accounting of avatar latents kept resident on the inference device.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.used_bytes = 0
+
+    def reserve(self, nbytes: int, limit_bytes: int) -> bool:
+        with self._lock:
+            if self.used_bytes + nbytes > limit_bytes:
+                return False
+            self.used_bytes += nbytes
+            return True
+
+    def release(self, nbytes: int):
+        with self._lock:
+            self.used_bytes = max(0, self.used_bytes - nbytes)
+
+device_latent_budget = _DeviceBudget()
 
 class Avatar:
     """
@@ -21,11 +46,23 @@ class Avatar:
         self.avatar_info_path = os.path.join(self.avatar_path, "avator_info.json")
 
         # State containers
-        self.input_latent_list_cycle: Optional[torch.Tensor] = None
+        # Latent cycle stacked into one (N, 8, 32, 32) tensor; see latents_for()
+        self.latent_cycle: Optional[torch.Tensor] = None
+        self._latent_lock = threading.Lock()
+        self._latents_placed = False
+        self._resident_bytes = 0
         self.coord_list_cycle: Optional[List[Tuple[int, int, int, int]]] = None
         self.frame_list_cycle: Optional[List[object]] = None # cv2 images
         self.mask_coords_list_cycle: Optional[List[Tuple[int, int, int, int]]] = None
         self.mask_list_cycle: Optional[List[object]] = None # cv2 images
+        # JPEG encodings of the untouched cycle frames (idle frames), filled lazily
+        self._encoded_frames: dict = {}
+        self._splicer: Optional[JpegSplicer] = None
+        # Number of open sessions holding this avatar in memory
+        self.pins = 0
+        self._pin_lock = threading.Lock()
+        # Reference held on the SharedAvatarStore entry the arrays are mapped from
+        self.shared_ref: Optional[str] = None
         
         # Info
         self.info: dict = {}
@@ -39,41 +76,157 @@ class Avatar:
                os.path.exists(self.latents_out_path) and \
                os.path.exists(self.coords_path)
 
-    def load_state(self):
+    @property
+    def content_version(self) -> str:
+        """
+        Identifies the preprocessed artifacts on disk; changes whenever the avatar is rebuilt.
+        """
+        digest = hashlib.sha1()
+        for path in (self.latents_out_path, self.coords_path, self.mask_coords_path,
+                     self.avatar_info_path, self.full_imgs_path, self.mask_out_path):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()[:16]
+
+    def load_state(self, workers: int = 1, store=None, remote=None):
         """
         Loads the avatar state from disk into memory.
+        Frames and masks are decoded on `workers` threads (cv2 releases the GIL).
+        With a SharedAvatarStore, frames, masks and latents are mapped from the copy
+        other server processes already decoded (or decoded once and published there).
+        With an AvatarStore (`remote`), an avatar not built on this node is first
+        fetched from the shared store (or refreshed if it was republished).
         """
+        if remote is not None:
+            remote.fetch(self.avatar_id)
         if not self.exists():
             raise FileNotFoundError(f"Avatar {self.avatar_id} data not found at {self.avatar_path}")
 
-        # Load latents
-        self.input_latent_list_cycle = torch.load(self.latents_out_path, map_location='cpu')
+        self.release_latents()
 
         # Load coordinates
         with open(self.coords_path, 'rb') as f:
             self.coord_list_cycle = pickle.load(f)
 
-        # Load frames
-        input_img_list = glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-        input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-        self.frame_list_cycle = self._read_imgs(input_img_list)
-
         # Load mask coordinates
         with open(self.mask_coords_path, 'rb') as f:
             self.mask_coords_list_cycle = pickle.load(f)
 
+        if store is not None:
+            store.detach(self)
+            store.attach(self, lambda: self._decode(workers))
+        else:
+            self._decode(workers)
+        self._encoded_frames = {}
+        self._splicer = None
+
+        print(f"Avatar {self.avatar_id} loaded successfully.")
+
+    def _decode(self, workers: int):
+        # Load latents (saved as a list of (1, 8, 32, 32) tensors) and stack them once
+        latent_list = torch.load(self.latents_out_path, map_location='cpu')
+        self.latent_cycle = torch.cat(list(latent_list), dim=0)
+
+        # Load frames
+        input_img_list = glob.glob(os.path.join(self.full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
+        input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+        self.frame_list_cycle = self._read_imgs(input_img_list, workers)
+
         # Load masks
         input_mask_list = glob.glob(os.path.join(self.mask_out_path, '*.[jpJP][pnPN]*[gG]'))
         input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-        self.mask_list_cycle = self._read_imgs(input_mask_list)
+        self.mask_list_cycle = self._read_imgs(input_mask_list, workers)
 
-        print(f"Avatar {self.avatar_id} loaded successfully.")
+    def latents_for(self, device: torch.device, dtype: torch.dtype, budget_mb: int = 0) -> torch.Tensor:
+        """
+        Returns the stacked latent cycle in `dtype`, converted once per avatar.
+        On a CUDA device the cycle is moved there if it fits into the process-wide
+        budget of `budget_mb`; otherwise it stays in pinned host memory and batches
+        are gathered on the host.
+        """
+        with self._latent_lock:
+            latents = self.latent_cycle
+            if latents is None:
+                raise ValueError(f"Avatar {self.avatar_id} is not loaded")
+            if latents.dtype != dtype:
+                latents = latents.to(dtype=dtype)
+            if device.type != "cpu" and not self._latents_placed:
+                nbytes = latents.numel() * latents.element_size()
+                if device_latent_budget.reserve(nbytes, budget_mb * 1024 * 1024):
+                    latents = latents.to(device)
+                    self._resident_bytes = nbytes
+                else:
+                    latents = latents.pin_memory()
+                self._latents_placed = True
+            self.latent_cycle = latents
+            return latents
+
+    def release_latents(self):
+        """
+        Drops the latent cycle and returns its share of the device budget.
+        """
+        with self._latent_lock:
+            if self._resident_bytes:
+                device_latent_budget.release(self._resident_bytes)
+                self._resident_bytes = 0
+            self.latent_cycle = None
+            self._latents_placed = False
+
+    def pin(self):
+        with self._pin_lock:
+            self.pins += 1
+
+    def unpin(self):
+        with self._pin_lock:
+            self.pins = max(0, self.pins - 1)
+
+    @property
+    def is_pinned(self) -> bool:
+        with self._pin_lock:
+            return self.pins > 0
+
+    @property
+    def memory_bytes(self) -> int:
+        """
+        Host memory held by the loaded state: frames, masks, latents and cached
+        JPEG encodings (frames mapped from a SharedAvatarStore count in full).
+        """
+        total = sum(getattr(a, "nbytes", 0) for images in (self.frame_list_cycle, self.mask_list_cycle)
+                    for a in images or ())
+        latents = self.latent_cycle
+        if latents is not None and latents.device.type == "cpu":
+            total += latents.numel() * latents.element_size()
+        return total + sum(len(data) for data in list(self._encoded_frames.values()))
+
+    def encoded_frame(self, cycle_idx: int) -> bytes:
+        """
+        JPEG bytes of cycle frame `cycle_idx` without any lip-sync applied (idle frame).
+        """
+        cycle_idx = cycle_idx % len(self.frame_list_cycle)
+        data = self._encoded_frames.get(cycle_idx)
+        if data is None:
+            ret, buffer = cv2.imencode('.jpg', self.frame_list_cycle[cycle_idx])
+            if not ret:
+                raise ValueError(f"Failed to encode frame {cycle_idx} of avatar {self.avatar_id}")
+            data = self._encoded_frames[cycle_idx] = buffer.tobytes()
+        return data
+
+    def jpeg_splicer(self) -> JpegSplicer:
+        """
+        Encoder splicing composited face regions into this avatar's pre-encoded cycle frames.
+        """
+        if self._splicer is None:
+            self._splicer = JpegSplicer(self.frame_list_cycle)
+        return self._splicer
 
-    def _read_imgs(self, img_list: List[str]) -> List[object]:
-        frames = []
-        for img_path in img_list:
-            frame = cv2.imread(img_path)
+    def _read_imgs(self, img_list: List[str], workers: int = 1) -> List[object]:
+        if workers > 1 and len(img_list) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                frames = list(pool.map(cv2.imread, img_list))
+        else:
+            frames = [cv2.imread(img_path) for img_path in img_list]
+        for img_path, frame in zip(img_list, frames):
             if frame is None:
                  raise ValueError(f"Failed to read image: {img_path}")
-            frames.append(frame)
         return frames
@@ -0,0 +1,372 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+from musetalk_server.core.metrics import metrics
+
+# What an inference node needs of a preprocessed avatar (stage caches stay with the build)
+ARCHIVE_ENTRIES = ("full_imgs", "mask", "coords.pkl", "mask_coords.pkl", "latents.pt", "avator_info.json")
+# Written into a fetched avatar directory: the archive it was extracted from
+MARKER_FILE = "store.json"
+# warmup.LAST_USED_FILE, touched when an avatar is used
+LAST_USED_FILE = "last_used"
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _dir_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class FileBackend:
+    """
+    Remote store on a shared filesystem (NFS, SMB, a mounted bucket). Files are
+    written under a temporary name and renamed, so readers never see a partial one.
+    """
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def put_file(self, key: str, local_path: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        shutil.copyfile(local_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def get_file(self, key: str, local_path: str) -> bool:
+        try:
+            shutil.copyfile(self._path(key), local_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key: str, data: bytes):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix: str) -> list:
+        """Keys directly under `prefix` (a "directory" ending in /)."""
+        path = self._path(prefix)
+        if not os.path.isdir(path):
+            return []
+        return [prefix + name for name in sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, name))]
+
+class S3Backend:
+    """
+    Remote store in an S3-compatible bucket (AWS S3, MinIO, R2, ...). Credentials
+    come from the usual AWS environment / config files. Needs `boto3`. Large
+    archives are downloaded as concurrent ranged requests (`max_concurrency`).
+    """
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = "", max_concurrency: int = 8):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError as e:
+            raise RuntimeError("An s3:// avatar store needs the boto3 package (pip install boto3)") from e
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or None)
+        self.transfer = TransferConfig(max_concurrency=max_concurrency)
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def _missing(self, error) -> bool:
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def put_file(self, key: str, local_path: str):
+        self.client.upload_file(local_path, self.bucket, self._key(key), Config=self.transfer)
+
+    def get_file(self, key: str, local_path: str) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.download_file(self.bucket, self._key(key), local_path, Config=self.transfer)
+            return True
+        except ClientError as e:
+            if self._missing(e):
+                return False
+            raise
+
+    def read(self, key: str) -> Optional[bytes]:
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(key))["Body"].read()
+        except ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def write(self, key: str, data: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def list(self, prefix: str) -> list:
+        keys = []
+        strip = len(self._key(""))
+        for page in self.client.get_paginator("list_objects_v2").paginate(
+                Bucket=self.bucket, Prefix=self._key(prefix), Delimiter="/"):
+            keys.extend(item["Key"][strip:] for item in page.get("Contents", ()))
+        return keys
+
+def open_backend(url: str, endpoint_url: str = "", max_concurrency: int = 8):
+    """MUSETALK_AVATAR_STORE_URL as a backend: s3://bucket/prefix, file:///path or a plain path."""
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        return S3Backend(bucket, prefix, endpoint_url, max_concurrency)
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+    return FileBackend(url)
+
+class AvatarStore:
+    """
+    Preprocessed avatars shared between nodes through a remote `backend`.
+    `publish` packs an avatar into one tar archive, uploaded under its SHA-256
+    (`{version}/avatars/{id}/{sha256}.tar`), then points the avatar's manifest
+    (`{version}/avatars/{id}.json`) at it. `fetch` downloads the archive into
+    the node's avatar directory (`cache_root`) on first use, verifies the
+    checksum and extracts it; concurrent fetches of an avatar share one download.
+
+    Fetched copies are a cache: beyond `max_bytes` the least recently used ones
+    that aren't loaded (`in_use()`) are removed again. Avatars built on this
+    node are never replaced or evicted.
+
+    Metrics: `avatar_store.fetches`, `.fetch_bytes`, `.fetch_ms`, `.shared_fetches`
+    (callers that waited for a download already in flight), `.checksum_failures`,
+    `.publishes` and `.evictions`; gauge `avatar_store.cache_bytes`.
+    """
+    def __init__(self, backend, cache_root: str, version: str = "v15", max_bytes: int = 0,
+                 workers: int = 4, in_use: Optional[Callable[[], Iterable[str]]] = None):
+        self.backend = backend
+        self.cache_root = cache_root
+        self.version = version
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.in_use = in_use or (lambda: ())
+        # Downloads and extraction happen next to the avatars, so the final rename stays on one filesystem
+        self.staging = os.path.join(os.path.dirname(cache_root.rstrip(os.sep)), ".avatar_fetch")
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+
+    def _manifest_key(self, avatar_id: str) -> str:
+        return f"{self.version}/avatars/{avatar_id}.json"
+
+    def _archive_key(self, avatar_id: str, sha256: str) -> str:
+        return f"{self.version}/avatars/{avatar_id}/{sha256}.tar"
+
+    def manifest(self, avatar_id: str) -> Optional[dict]:
+        data = self.backend.read(self._manifest_key(avatar_id))
+        return None if data is None else json.loads(data)
+
+    def remote_ids(self) -> list:
+        prefix = f"{self.version}/avatars/"
+        return [key[len(prefix):-len(".json")] for key in self.backend.list(prefix) if key.endswith(".json")]
+
+    def local_marker(self, avatar_id: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.cache_root, avatar_id, MARKER_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def publish(self, avatar_id: str) -> dict:
+        """
+        Uploads the avatar's current build and makes it the one other nodes fetch.
+        Returns the new manifest.
+        """
+        avatar_path = os.path.join(self.cache_root, avatar_id)
+        os.makedirs(self.staging, exist_ok=True)
+        fd, archive = tempfile.mkstemp(dir=self.staging, suffix=".tar")
+        os.close(fd)
+        try:
+            with tarfile.open(archive, "w") as tar:
+                for name in ARCHIVE_ENTRIES:
+                    path = os.path.join(avatar_path, name)
+                    if os.path.exists(path):
+                        tar.add(path, arcname=name, filter=lambda info: info if info.isfile() or info.isdir() else None)
+            sha256 = _sha256(archive)
+            previous = self.manifest(avatar_id)
+            manifest = {
+                "avatar_id": avatar_id,
+                "sha256": sha256,
+                "size": os.path.getsize(archive),
+                "published": time.time(),
+            }
+            if previous is None or previous.get("sha256") != sha256:
+                self.backend.put_file(self._archive_key(avatar_id, sha256), archive)
+                # The manifest goes last: a reader never sees one for a partial archive
+                self.backend.write(self._manifest_key(avatar_id), json.dumps(manifest).encode())
+                if previous is not None:
+                    self.backend.delete(self._archive_key(avatar_id, previous["sha256"]))
+            metrics.inc("avatar_store.publishes")
+            return manifest
+        finally:
+            os.remove(archive)
+
+    def adopt(self, avatar_id: str):
+        """
+        Turns a fetched copy into a local build (before preprocessing rewrites it),
+        so later fetches don't replace the result.
+        """
+        try:
+            os.remove(os.path.join(self.cache_root, avatar_id, MARKER_FILE))
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, avatar_id: str) -> bool:
+        """
+        Makes the published build of `avatar_id` available locally. True if the
+        avatar directory is usable (built here, already current, or fetched now).
+        """
+        avatar_path = os.path.join(self.cache_root, avatar_id)
+        marker = self.local_marker(avatar_id)
+        if marker is None and os.path.isdir(avatar_path):
+            # Built on this node
+            return True
+        with self._lock:
+            future = self._inflight.get(avatar_id)
+            owner = future is None
+            if owner:
+                future = self._inflight[avatar_id] = Future()
+        if not owner:
+            metrics.inc("avatar_store.shared_fetches")
+            return future.result()
+        try:
+            result = self._fetch(avatar_id, avatar_path, marker)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(avatar_id, None)
+
+    def _fetch(self, avatar_id: str, avatar_path: str, marker: Optional[dict]) -> bool:
+        manifest = self.manifest(avatar_id)
+        if manifest is None:
+            return marker is not None
+        if marker is not None and marker.get("sha256") == manifest["sha256"]:
+            return True
+
+        start = time.perf_counter()
+        os.makedirs(self.staging, exist_ok=True)
+        work = tempfile.mkdtemp(dir=self.staging, prefix=f"{avatar_id}-")
+        try:
+            archive = os.path.join(work, "avatar.tar")
+            if not self.backend.get_file(self._archive_key(avatar_id, manifest["sha256"]), archive):
+                # Republished since the manifest was read; the next use fetches the new build
+                print(f"Archive of avatar {avatar_id} disappeared during fetch")
+                return marker is not None
+            if _sha256(archive) != manifest["sha256"]:
+                metrics.inc("avatar_store.checksum_failures")
+                raise ValueError(f"Checksum mismatch in the archive of avatar {avatar_id}")
+            extracted = os.path.join(work, avatar_id)
+            with tarfile.open(archive) as tar:
+                members = tar.getmembers()
+                for member in members:
+                    name = os.path.normpath(member.name)
+                    if os.path.isabs(name) or name.startswith("..") or not (member.isfile() or member.isdir()):
+                        raise ValueError(f"Unsafe entry '{member.name}' in the archive of avatar {avatar_id}")
+                tar.extractall(extracted, members=members)
+            with open(os.path.join(extracted, MARKER_FILE), "w") as f:
+                json.dump(manifest, f)
+            open(os.path.join(extracted, LAST_USED_FILE), "a").close()
+
+            # Swap in the new copy; an outdated one is moved aside first and removed
+            if os.path.isdir(avatar_path):
+                os.replace(avatar_path, os.path.join(work, "previous"))
+            os.makedirs(self.cache_root, exist_ok=True)
+            os.replace(extracted, avatar_path)
+            metrics.inc("avatar_store.fetches")
+            metrics.inc("avatar_store.fetch_bytes", manifest.get("size", 0))
+            metrics.observe("avatar_store.fetch_ms", (time.perf_counter() - start) * 1000)
+            print(f"Fetched avatar {avatar_id} from the avatar store")
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        self.evict(keep={avatar_id})
+        return True
+
+    def prefetch(self, avatar_ids: Iterable[str]) -> dict:
+        """Fetches several avatars on `workers` threads; {avatar_id: True / False}."""
+        def safe_fetch(avatar_id):
+            try:
+                return self.fetch(avatar_id)
+            except Exception as e:
+                print(f"Failed to fetch avatar {avatar_id}: {e}")
+                return False
+
+        avatar_ids = list(avatar_ids)
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            return dict(zip(avatar_ids, pool.map(safe_fetch, avatar_ids)))
+
+    def evict(self, keep: Iterable[str] = ()) -> int:
+        """
+        Removes least recently used fetched avatars (not loaded, not in `keep`)
+        until the fetched copies fit into `max_bytes`. Returns bytes freed.
+        """
+        if not os.path.isdir(self.cache_root):
+            return 0
+        with self._evict_lock:
+            entries = []
+            for avatar_id in os.listdir(self.cache_root):
+                path = os.path.join(self.cache_root, avatar_id)
+                if not os.path.exists(os.path.join(path, MARKER_FILE)):
+                    continue
+                used = os.path.join(path, LAST_USED_FILE)
+                last_used = os.path.getmtime(used) if os.path.exists(used) else 0.0
+                entries.append((last_used, avatar_id, path, _dir_bytes(path)))
+
+            total = sum(size for *_, size in entries)
+            freed = 0
+            if self.max_bytes > 0 and total > self.max_bytes:
+                protected = set(keep) | set(self.in_use())
+                for _, avatar_id, path, size in sorted(entries):
+                    if total <= self.max_bytes:
+                        break
+                    if avatar_id in protected or avatar_id in self._inflight:
+                        continue
+                    shutil.rmtree(path, ignore_errors=True)
+                    total -= size
+                    freed += size
+                    metrics.inc("avatar_store.evictions")
+            metrics.set("avatar_store.cache_bytes", total)
+            return freed
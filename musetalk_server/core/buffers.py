@@ -0,0 +1,113 @@
+import gc
+import time
+import threading
+import numpy as np
+import torch
+from contextlib import contextmanager
+from musetalk_server.conf import conf
+from musetalk_server.core.metrics import metrics
+
+MEMORY_RELEASE_POLICIES = ("request", "idle", "never")
+
+class BufferSet:
+    """
+    Reusable tensors and arrays of one render worker, keyed by name and shape.
+    A buffer is overwritten the next time its owner asks for the same key, so
+    it must not be handed to another thread that keeps it.
+    Allocations are counted in `buffers.allocations` / `buffers.allocated_bytes`,
+    hits in `buffers.reuses`.
+    """
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+        self.nbytes = 0
+
+    def _get(self, key, allocate):
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = self._buffers[key] = allocate()
+            nbytes = buf.numel() * buf.element_size() if isinstance(buf, torch.Tensor) else buf.nbytes
+            self.allocations += 1
+            self.nbytes += nbytes
+            metrics.inc("buffers.allocations")
+            metrics.inc("buffers.allocated_bytes", nbytes)
+        else:
+            metrics.inc("buffers.reuses")
+        return buf
+
+    def tensor(self, name: str, shape, dtype: torch.dtype, device: torch.device, pinned: bool = False) -> torch.Tensor:
+        device = torch.device(device)
+        # Page-locked host memory only makes sense (and only works) next to a GPU
+        pinned = pinned and device.type == "cpu" and torch.cuda.is_available()
+        key = ("tensor", name, tuple(shape), dtype, device, pinned)
+        return self._get(key, lambda: torch.empty(tuple(shape), dtype=dtype, device=device, pin_memory=pinned))
+
+    def array(self, name: str, shape, dtype) -> np.ndarray:
+        key = ("array", name, tuple(shape), np.dtype(dtype))
+        return self._get(key, lambda: np.empty(shape, dtype=dtype))
+
+class BufferPool:
+    """
+    Hands out BufferSets to render workers and keeps up to `max_idle` of them
+    for the next renders, so steady-state traffic allocates no new buffers.
+    """
+    def __init__(self, max_idle: int = 8):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self):
+        with self._lock:
+            buffers = self._idle.pop() if self._idle else BufferSet()
+        try:
+            yield buffers
+        finally:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append(buffers)
+                metrics.set("buffers.idle_bytes", sum(b.nbytes for b in self._idle))
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+            metrics.set("buffers.idle_bytes", 0)
+
+class MemoryPolicy:
+    """
+    When the CUDA caching allocator is emptied and a full GC runs after renders:
+    "request" after every render, "idle" once no render is running anymore
+    (never in the middle of concurrent traffic), "never" leaves it to the allocator.
+    Releases are counted in `memory.releases` and timed in `memory.release_ms`.
+    """
+    def __init__(self, policy: str = "idle"):
+        if policy not in MEMORY_RELEASE_POLICIES:
+            raise ValueError(f"Unknown memory release policy '{policy}'; expected one of {MEMORY_RELEASE_POLICIES}")
+        self.policy = policy
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def begin(self):
+        """Called when a render starts."""
+        with self._lock:
+            self.active += 1
+
+    def end(self):
+        """Called when a render's workers are done; releases memory if the policy says so."""
+        with self._lock:
+            self.active -= 1
+            idle = self.active == 0
+        if self.policy == "request" or (self.policy == "idle" and idle):
+            self.release()
+
+    def release(self):
+        start = time.perf_counter()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        gc.collect()
+        metrics.inc("memory.releases")
+        metrics.observe("memory.release_ms", (time.perf_counter() - start) * 1000)
+
+# Global instances shared by all renders of the process
+buffer_pool = BufferPool()
+memory_policy = MemoryPolicy(conf.memory_release)
@@ -0,0 +1,112 @@
+import os
+import copy
+import time
+import cv2
+import torch
+from musetalk_server.core.metrics import metrics
+
+# fp32: modules as loaded. bf16: bfloat16 weights (CPUs with native bf16: AVX512-BF16 / AMX).
+# int8: dynamic int8 quantization of Linear layers. auto: bf16 where supported, else int8.
+CPU_PROFILES = ("fp32", "bf16", "int8", "auto")
+
+# Per component: (cast to bf16, quantize Linear layers to int8, channels-last layout).
+# Whisper is all Linear layers; the UNet's attention blocks are Linear and its
+# ResNet blocks convolutions; the VAE decoder is convolutions only, so it keeps
+# fp32 weights (pixel accuracy) and only gets the oneDNN-friendly layout.
+COMPONENT_RULES = {
+    "whisper": (True, True, False),
+    "pe": (True, False, False),
+    "unet": (True, True, True),
+    "vae": (False, False, True),
+}
+
+def bf16_supported() -> bool:
+    """True if the CPU runs bfloat16 matmuls natively (otherwise bf16 is emulated and slower than fp32)."""
+    for check in ("_is_avx512_bf16_supported", "_is_amx_tile_supported"):
+        probe = getattr(torch.cpu, check, None)
+        if probe is not None and probe():
+            return True
+    return False
+
+def resolve_profile(profile: str) -> str:
+    """The profile actually applied on this CPU for MUSETALK_CPU_PROFILE."""
+    if profile not in CPU_PROFILES:
+        raise ValueError(f"Unknown CPU profile '{profile}'; expected one of {CPU_PROFILES}")
+    if profile == "auto":
+        return "bf16" if bf16_supported() else "int8"
+    if profile == "bf16" and not bf16_supported():
+        print("CPU has no native bf16 support; using the int8 profile instead")
+        return "int8"
+    return profile
+
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def configure_threads(threads: int = 0, blend_threads: int = 2) -> int:
+    """
+    Splits the cores between PyTorch and the blend/encode workers: `blend_threads`
+    cores stay with the workers (and OpenCV, which they run), PyTorch gets the
+    rest for intra-op parallelism (or exactly `threads`). Batches run one after
+    another, so a single inter-op thread is enough. Returns the intra-op count.
+    """
+    intra = threads if threads > 0 else max(1, available_cores() - blend_threads)
+    torch.set_num_threads(intra)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only possible before the first parallel op; keep the current pool
+        pass
+    cv2.setNumThreads(max(1, blend_threads))
+    metrics.set("cpu.intra_op_threads", intra)
+    return intra
+
+def optimize_module(module: torch.nn.Module, component: str, profile: str) -> torch.nn.Module:
+    """
+    `module` (one of COMPONENT_RULES) prepared for CPU inference under a resolved
+    profile. Quantization returns a new module; casts and layout changes are in place.
+    """
+    to_bf16, quantize, channels_last = COMPONENT_RULES[component]
+    module = module.eval()
+    if profile == "bf16" and to_bf16:
+        module = module.to(torch.bfloat16)
+    if channels_last:
+        module = module.to(memory_format=torch.channels_last)
+    if profile == "int8" and quantize:
+        module = torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+    return module
+
+def profile_components(components: dict, profile: str) -> dict:
+    """
+    Copies of `components` ({"whisper", "pe", "unet", "vae"}: torch modules) with
+    a resolved profile applied, leaving the originals as the fp32 reference.
+    """
+    return {name: optimize_module(copy.deepcopy(module), name, profile) for name, module in components.items()}
+
+@torch.no_grad()
+def whisper_report(reference, candidate, iterations: int = 3, seed: int = 0) -> dict:
+    """
+    Deviation of `candidate`'s encoder hidden states from `reference` on one
+    random 30 s window, and the time per window of each.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    features = torch.randn(1, 80, 3000, generator=generator)
+
+    def run(model):
+        # Fully quantized modules have no float parameters left: they take fp32 input
+        dtype = next(model.parameters(), torch.empty(0)).dtype
+        start = time.perf_counter()
+        for _ in range(iterations):
+            hidden = model.encoder(features.to(dtype), output_hidden_states=True).hidden_states
+        return torch.stack(hidden, dim=2).float(), (time.perf_counter() - start) * 1000 / iterations
+
+    ref_hidden, ref_ms = run(reference)
+    out_hidden, out_ms = run(candidate)
+    diff = (ref_hidden - out_hidden).abs()
+    return {
+        "whisper_max_abs": round(diff.max().item(), 4),
+        "whisper_rel_err": round((diff.norm() / ref_hidden.norm()).item(), 5),
+        "whisper_ms": round(out_ms, 1),
+        "whisper_speedup": round(ref_ms / out_ms, 2),
+    }
@@ -0,0 +1,343 @@
+import os
+import time
+import hashlib
+import inspect
+import numpy as np
+import torch
+from typing import Optional
+
+# Engines wrap the three modules of the per-batch hot loop (positional encoder,
+# UNet, VAE decoder) behind one interface so exported runtimes can replace the
+# eager PyTorch modules. Eager mode stays the reference implementation.
+BACKENDS = ("eager", "torchscript", "onnx")
+
+# Whisper chunk and latent shapes fed to the engine (per frame).
+AUDIO_FEATURE_SHAPE = (50, 384)
+LATENT_SHAPE = (8, 32, 32)
+
+def _to_bgr_uint8(image: torch.Tensor) -> torch.Tensor:
+    """
+    Same post-processing as upstream VAE.decode_latents, kept on the image's
+    device: NCHW [0, 1] -> NHWC uint8 BGR.
+    """
+    image = image.detach().permute(0, 2, 3, 1).float()
+    return (image * 255).round().to(torch.uint8).flip(-1)
+
+class _UNetForward(torch.nn.Module):
+    def __init__(self, unet_model, timesteps):
+        super().__init__()
+        self.unet_model = unet_model
+        self.register_buffer("timesteps", timesteps)
+
+    def forward(self, latents, audio_features):
+        return self.unet_model(latents, self.timesteps, encoder_hidden_states=audio_features).sample
+
+class _VaeDecode(torch.nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae.vae
+        self.scaling_factor = float(vae.scaling_factor)
+
+    def forward(self, latents):
+        image = self.vae.decode(latents / self.scaling_factor).sample
+        return (image / 2 + 0.5).clamp(0, 1)
+
+class EagerEngine:
+    """
+    Reference engine: calls the loaded PyTorch modules directly.
+    """
+    name = "eager"
+
+    def __init__(self, pe, unet, vae, timesteps):
+        self.pe = pe
+        self.unet = unet
+        self.vae = vae
+        self.timesteps = timesteps
+        self.dtype = unet.model.dtype
+
+    @torch.no_grad()
+    def encode_audio(self, whisper_batch: torch.Tensor) -> torch.Tensor:
+        return self.pe(whisper_batch)
+
+    @torch.no_grad()
+    def predict(self, latent_batch: torch.Tensor, audio_feature_batch: torch.Tensor) -> torch.Tensor:
+        return self.unet.model(latent_batch, self.timesteps, encoder_hidden_states=audio_feature_batch).sample
+
+    @torch.no_grad()
+    def decode(self, pred_latents: torch.Tensor) -> np.ndarray:
+        return self.vae.decode_latents(pred_latents.to(dtype=self.vae.vae.dtype))
+
+    @torch.no_grad()
+    def decode_tensor(self, pred_latents: torch.Tensor) -> torch.Tensor:
+        """
+        Like decode, but returns the (n, 256, 256, 3) uint8 BGR crops on the device.
+        """
+        latents = pred_latents.to(dtype=self.vae.vae.dtype) / self.vae.scaling_factor
+        image = self.vae.vae.decode(latents).sample
+        return _to_bgr_uint8((image / 2 + 0.5).clamp(0, 1))
+
+class TorchScriptEngine(EagerEngine):
+    """
+    Runs traced TorchScript modules. Tracing records the batch dimension as a
+    runtime size, so one artifact serves every batch size.
+    """
+    name = "torchscript"
+
+    def __init__(self, pe, unet, vae, timesteps, device, artifacts: dict):
+        super().__init__(pe, unet, vae, timesteps)
+        modules = {
+            "pe": pe,
+            "unet": _UNetForward(unet.model, timesteps),
+            "vae_decoder": _VaeDecode(vae),
+        }
+        self.modules = {}
+        for key, module in modules.items():
+            path = artifacts[key]
+            if not os.path.exists(path):
+                print(f"Exporting {key} to TorchScript: {path}")
+                example = _example_inputs(key, device, self.dtype)
+                with torch.no_grad():
+                    traced = torch.jit.trace(module.eval(), example, check_trace=False)
+                _atomic_save(path, lambda tmp: torch.jit.save(traced, tmp))
+            self.modules[key] = torch.jit.load(path, map_location=device).eval()
+
+    @torch.no_grad()
+    def encode_audio(self, whisper_batch):
+        return self.modules["pe"](whisper_batch)
+
+    @torch.no_grad()
+    def predict(self, latent_batch, audio_feature_batch):
+        return self.modules["unet"](latent_batch, audio_feature_batch)
+
+    @torch.no_grad()
+    def decode(self, pred_latents):
+        return self.decode_tensor(pred_latents).cpu().numpy()
+
+    @torch.no_grad()
+    def decode_tensor(self, pred_latents):
+        return _to_bgr_uint8(self.modules["vae_decoder"](pred_latents.to(dtype=self.dtype)))
+
+_ORT_TYPES = {
+    "tensor(float)": torch.float32,
+    "tensor(float16)": torch.float16,
+    "tensor(uint8)": torch.uint8,
+}
+
+class _OrtModule:
+    """
+    Thin callable around an ONNX Runtime session taking and returning torch tensors.
+    Inputs and output are bound in place by device pointer (IO binding), so a
+    CUDA session reads and writes the torch tensors without a host round trip.
+    """
+    def __init__(self, path: str, device: torch.device):
+        import onnxruntime as ort
+
+        providers = ["CPUExecutionProvider"]
+        self.bind_device = torch.device("cpu")
+        if device.type == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, ("CUDAExecutionProvider", {"device_id": device.index or 0}))
+            self.bind_device = torch.device("cuda", device.index or 0)
+        self.session = ort.InferenceSession(path, providers=providers)
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        output = self.session.get_outputs()[0]
+        self.output_name = output.name
+        # Every axis but the batch is static in the exported graphs
+        self.output_shape = tuple(output.shape[1:])
+        self.output_dtype = _ORT_TYPES[output.type]
+        self.device = device
+
+    def __call__(self, *tensors: torch.Tensor) -> torch.Tensor:
+        binding = self.session.io_binding()
+        device_type, device_id = self.bind_device.type, self.bind_device.index or 0
+        inputs = [tensor.detach().to(self.bind_device).contiguous() for tensor in tensors]
+        for name, tensor in zip(self.input_names, inputs):
+            binding.bind_input(name, device_type, device_id, _numpy_dtype(tensor.dtype),
+                               tuple(tensor.shape), tensor.data_ptr())
+        output = torch.empty((inputs[0].shape[0],) + self.output_shape,
+                             dtype=self.output_dtype, device=self.bind_device)
+        binding.bind_output(self.output_name, device_type, device_id, _numpy_dtype(output.dtype),
+                            tuple(output.shape), output.data_ptr())
+        if device_type == "cuda":
+            # ORT runs on its own stream; the inputs may still be in flight on torch's
+            torch.cuda.current_stream(self.bind_device).synchronize()
+        self.session.run_with_iobinding(binding)
+        binding.synchronize_outputs()
+        return output.to(self.device)
+
+def _numpy_dtype(dtype: torch.dtype):
+    return torch.empty((), dtype=dtype).numpy().dtype
+
+class OnnxEngine(EagerEngine):
+    """
+    Runs ONNX Runtime sessions exported with a dynamic batch axis.
+    Requires the optional `onnx` and `onnxruntime` (or `onnxruntime-gpu`) packages.
+    """
+    name = "onnx"
+
+    _IO = {
+        "pe": (["whisper_chunks"], "audio_features"),
+        "unet": (["latents", "audio_features"], "pred_latents"),
+        "vae_decoder": (["latents"], "image"),
+    }
+
+    def __init__(self, pe, unet, vae, timesteps, device, artifacts: dict):
+        super().__init__(pe, unet, vae, timesteps)
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError as e:
+            raise RuntimeError("engine_backend 'onnx' requires the onnxruntime package") from e
+
+        modules = {
+            "pe": pe,
+            "unet": _UNetForward(unet.model, timesteps),
+            "vae_decoder": _VaeDecode(vae),
+        }
+        self.modules = {}
+        for key, module in modules.items():
+            path = artifacts[key]
+            if not os.path.exists(path):
+                print(f"Exporting {key} to ONNX: {path}")
+                input_names, output_name = self._IO[key]
+                example = _example_inputs(key, device, self.dtype)
+                export_kwargs = dict(
+                    input_names=input_names,
+                    output_names=[output_name],
+                    dynamic_axes={name: {0: "batch"} for name in input_names + [output_name]},
+                    opset_version=17,
+                )
+                # Newer torch defaults to the dynamo exporter; keep the TorchScript-based one.
+                if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+                    export_kwargs["dynamo"] = False
+                _atomic_save(path, lambda tmp: torch.onnx.export(module.eval(), example, tmp, **export_kwargs))
+            self.modules[key] = _OrtModule(path, device)
+
+    def encode_audio(self, whisper_batch):
+        return self.modules["pe"](whisper_batch)
+
+    def predict(self, latent_batch, audio_feature_batch):
+        return self.modules["unet"](latent_batch, audio_feature_batch)
+
+    def decode(self, pred_latents):
+        return self.decode_tensor(pred_latents).cpu().numpy()
+
+    def decode_tensor(self, pred_latents):
+        return _to_bgr_uint8(self.modules["vae_decoder"](pred_latents.to(dtype=self.dtype)))
+
+def _example_inputs(key: str, device: torch.device, dtype: torch.dtype, batch_size: int = 2):
+    audio = torch.zeros((batch_size,) + AUDIO_FEATURE_SHAPE, device=device, dtype=dtype)
+    latents = torch.zeros((batch_size,) + LATENT_SHAPE, device=device, dtype=dtype)
+    if key == "pe":
+        return (audio,)
+    if key == "unet":
+        return (latents, audio)
+    return (latents[:, :4],)
+
+def _atomic_save(path: str, save):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        save(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def weights_fingerprint(*paths: str) -> str:
+    """
+    Cheap identity of the weight files an artifact was exported from (path, size, mtime).
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(os.path.abspath(path).encode())
+        if os.path.isdir(path):
+            entries = sorted(os.path.join(path, name) for name in os.listdir(path))
+        else:
+            entries = [path]
+        for entry in entries:
+            if os.path.isfile(entry):
+                stat = os.stat(entry)
+                digest.update(f"{entry}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:12]
+
+def artifact_paths(backend: str, cache_dir: str, fingerprint: str, device: torch.device, dtype: torch.dtype) -> dict:
+    ext = {"torchscript": "ts", "onnx": "onnx"}[backend]
+    dtype_name = str(dtype).replace("torch.", "")
+    return {
+        key: os.path.join(cache_dir, f"{key}-{fingerprint}-{device.type}-{dtype_name}.{ext}")
+        for key in ("pe", "unet", "vae_decoder")
+    }
+
+def build_engine(
+    backend: str,
+    pe,
+    unet,
+    vae,
+    timesteps,
+    device: torch.device,
+    cache_dir: Optional[str] = None,
+    fingerprint: str = "default",
+):
+    """
+    Creates the engine for `backend`, exporting (or reusing cached) artifacts under `cache_dir`.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown engine backend '{backend}'; expected one of {BACKENDS}")
+    if backend == "eager":
+        return EagerEngine(pe, unet, vae, timesteps)
+
+    artifacts = artifact_paths(backend, cache_dir, fingerprint, device, unet.model.dtype)
+    engine_cls = TorchScriptEngine if backend == "torchscript" else OnnxEngine
+    return engine_cls(pe, unet, vae, timesteps, device, artifacts)
+
+def _random_inputs(batch_size: int, device: torch.device, dtype: torch.dtype, seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    whisper_batch = torch.randn((batch_size,) + AUDIO_FEATURE_SHAPE, generator=generator)
+    latent_batch = torch.randn((batch_size,) + LATENT_SHAPE, generator=generator)
+    return whisper_batch.to(device=device, dtype=dtype), latent_batch.to(device=device, dtype=dtype)
+
+def check_parity(engine, reference, device: torch.device, batch_sizes=(1, 4), seed: int = 0) -> dict:
+    """
+    Runs `engine` and `reference` (normally the eager engine) on the same random
+    inputs and reports the largest deviations per stage. Decoded frames are
+    compared as uint8 pixels. Inputs are cast to each engine's dtype, so engines
+    of different precision (e.g. a bf16 CPU profile) can be compared.
+    """
+    report = {"pe_max_abs": 0.0, "unet_max_abs": 0.0, "frame_max_abs": 0, "frame_mean_abs": 0.0}
+    for batch_size in batch_sizes:
+        whisper_batch, latent_batch = _random_inputs(batch_size, device, reference.dtype, seed)
+
+        ref_audio = reference.encode_audio(whisper_batch)
+        out_audio = engine.encode_audio(whisper_batch.to(engine.dtype))
+        ref_pred = reference.predict(latent_batch, ref_audio)
+        out_pred = engine.predict(latent_batch.to(engine.dtype), ref_audio.to(engine.dtype))
+        ref_frames = reference.decode(ref_pred).astype(np.int16)
+        out_frames = engine.decode(ref_pred).astype(np.int16)
+
+        frame_diff = np.abs(ref_frames - out_frames)
+        report["pe_max_abs"] = max(report["pe_max_abs"], (ref_audio.float() - out_audio.float()).abs().max().item())
+        report["unet_max_abs"] = max(report["unet_max_abs"], (ref_pred.float() - out_pred.float()).abs().max().item())
+        report["frame_max_abs"] = max(report["frame_max_abs"], int(frame_diff.max()))
+        report["frame_mean_abs"] = max(report["frame_mean_abs"], float(frame_diff.mean()))
+    return report
+
+def benchmark(engine, device: torch.device, batch_size: int = 4, iterations: int = 10, warmup: int = 2) -> float:
+    """
+    Measures end-to-end engine throughput (PE + UNet + VAE decode) in frames per second.
+    """
+    whisper_batch, latent_batch = _random_inputs(batch_size, device, engine.dtype)
+
+    def step():
+        audio = engine.encode_audio(whisper_batch)
+        pred = engine.predict(latent_batch, audio)
+        engine.decode(pred)
+
+    for _ in range(warmup):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return batch_size * iterations / (time.perf_counter() - start)
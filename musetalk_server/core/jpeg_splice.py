@@ -0,0 +1,105 @@
+import re
+import cv2
+import numpy as np
+from typing import List, Tuple
+from musetalk_server.core.metrics import metrics
+
+# Frames are encoded with 4:2:0 chroma subsampling (libjpeg's default): 16x16 MCUs
+MCU_SIZE = 16
+# Longest restart interval in MCUs; each interval costs a marker and byte alignment
+MAX_RESTART_MCUS = 8
+_RST = re.compile(rb"\xff[\xd0-\xd7]")
+
+def restart_interval(width: int) -> int:
+    """
+    Restart interval (MCUs) for frames `width` pixels wide: the largest one up to
+    MAX_RESTART_MCUS that divides an MCU row, so no interval spans two rows.
+    """
+    mcus = -(-width // MCU_SIZE)
+    return max(d for d in range(1, MAX_RESTART_MCUS + 1) if mcus % d == 0)
+
+def encode_segments(image: np.ndarray, interval: int) -> Tuple[bytes, List[bytes]]:
+    """
+    Encodes `image` with a restart marker every `interval` MCUs and splits the
+    result into the headers (up to the end of SOS) and the entropy-coded
+    segments between markers.
+    """
+    params = [cv2.IMWRITE_JPEG_RST_INTERVAL, interval]
+    if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):
+        params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420]
+    ret, buffer = cv2.imencode('.jpg', image, params)
+    if not ret:
+        raise ValueError("Failed to encode frame")
+    data = buffer.tobytes()
+    sos = data.index(b"\xff\xda")
+    header_end = sos + 2 + int.from_bytes(data[sos + 2:sos + 4], "big")
+    # Stuffed 0xFF bytes are followed by 0x00, so markers can't occur inside segments
+    return data[:header_end], _RST.split(data[header_end:-2])
+
+def join_segments(header: bytes, segments: List[bytes]) -> bytes:
+    parts = [header]
+    for i, segment in enumerate(segments):
+        if i:
+            parts.append(bytes((0xFF, 0xD0 + (i - 1) % 8)))
+        parts.append(segment)
+    parts.append(b"\xff\xd9")
+    return b"".join(parts)
+
+class JpegSplicer:
+    """
+    JPEG encoder for composited frames of an avatar cycle, where only a box
+    (the mask crop box) differs from the cycle frame. Cycle frames are encoded
+    once with restart markers (one interval never spans two MCU rows) and kept
+    as entropy-coded segments. A composited frame re-encodes just the intervals
+    that intersect the box and splices them into its background's segments, so
+    encode cost scales with the face size instead of the frame size.
+
+    Segments depend only on their own MCUs, so the result is byte-identical to
+    encoding the whole composited frame with the same restart interval.
+    """
+    def __init__(self, frames: list):
+        self.frames = frames
+        self._backgrounds = {}
+
+    def background(self, cycle_idx: int) -> Tuple[bytes, List[bytes]]:
+        cached = self._backgrounds.get(cycle_idx)
+        if cached is None:
+            frame = self.frames[cycle_idx]
+            cached = self._backgrounds[cycle_idx] = encode_segments(frame, restart_interval(frame.shape[1]))
+        return cached
+
+    def encode(self, cycle_idx: int, box: Tuple[int, int, int, int], pixels: np.ndarray) -> bytes:
+        """
+        JPEG of cycle frame `cycle_idx` with `pixels` drawn at `box` (x1, y1, x2, y2).
+        """
+        cycle_idx = cycle_idx % len(self.frames)
+        frame = self.frames[cycle_idx]
+        height, width = frame.shape[:2]
+        interval = restart_interval(width)
+        header, segments = self.background(cycle_idx)
+
+        # Box grown to whole restart intervals (clipped at the frame edge)
+        x1, y1, x2, y2 = box
+        span = MCU_SIZE * interval
+        row0, row1 = y1 // MCU_SIZE, -(-y2 // MCU_SIZE)
+        col0, col1 = x1 // span, -(-x2 // span)
+        ax, ay = col0 * span, row0 * MCU_SIZE
+        region = frame[ay:min(row1 * MCU_SIZE, height), ax:min(col1 * span, width)].copy()
+        region[y1 - ay:y2 - ay, x1 - ax:x2 - ax] = pixels
+        _, patch = encode_segments(region, interval)
+
+        per_row = -(-width // MCU_SIZE) // interval
+        cols = col1 - col0
+        if len(segments) != -(-height // MCU_SIZE) * per_row or len(patch) != (row1 - row0) * cols:
+            # Not the MCU layout splicing relies on (e.g. another JPEG library): encode in full
+            metrics.inc("jpeg.splice_fallbacks")
+            full = frame.copy()
+            full[y1:y2, x1:x2] = pixels
+            return join_segments(*encode_segments(full, interval))
+        spliced = list(segments)
+        for r in range(row1 - row0):
+            start = (row0 + r) * per_row + col0
+            spliced[start:start + cols] = patch[r * cols:(r + 1) * cols]
+        metrics.inc("jpeg.spliced_frames")
+        metrics.inc("jpeg.spliced_segments", len(patch))
+        return join_segments(header, spliced)
@@ -0,0 +1,42 @@
+import threading
+
+class Metrics:
+    """
+    Minimal in-process metrics registry: counters, gauges and summaries
+    (count / sum / max), exposed as JSON by GET /metrics.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            summary = self._summaries.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+    def get(self, name: str, default: float = 0):
+        with self._lock:
+            return self._counters.get(name, self._gauges.get(name, default))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "summaries": {name: dict(value) for name, value in self._summaries.items()},
+            }
+
+# Global registry
+metrics = Metrics()
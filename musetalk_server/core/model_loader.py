@@ -1,11 +1,48 @@
 import torch
 import os
 import gc
+import sys
+import time
+import importlib
+import threading
+from contextlib import contextmanager
 from transformers import WhisperModel
-from musetalk.utils.utils import load_all_model
+from musetalk.models.vae import VAE
+from musetalk.models.unet import UNet, PositionalEncoding
 from musetalk.utils.audio_processor import AudioProcessor
 from musetalk.utils.face_parsing import FaceParsing
 from musetalk_server.conf import conf
+from musetalk_server.core.cpu_profile import resolve_profile, configure_threads, optimize_module
+from musetalk_server.core.engine import build_engine, weights_fingerprint
+
+# Components each node role keeps resident. "unet" also covers the positional
+# encoder, "whisper" also covers the audio feature extractor and "dwpose" is the
+# upstream preprocessing module (DWPose + face detector, initialised on import).
+ROLE_COMPONENTS = {
+    "inference": ("vae", "unet", "whisper"),
+    "preprocess": ("vae", "face_parsing", "dwpose"),
+    "all": ("vae", "unet", "whisper", "face_parsing", "dwpose"),
+}
+INFERENCE_COMPONENTS = ROLE_COMPONENTS["inference"]
+PREPROCESS_COMPONENTS = ROLE_COMPONENTS["preprocess"]
+
+_DWPOSE_MODULE = "musetalk.utils.preprocessing"
+
+def _forget_module(name: str):
+    """
+    Drops every reference the import system holds to a module: its sys.modules
+    entry and the attribute import bound on its parent package.
+    """
+    module = sys.modules.pop(name, None)
+    parent_name, _, attr = name.rpartition(".")
+    parent = sys.modules.get(parent_name)
+    if parent is not None and module is not None and getattr(parent, attr, None) is module:
+        delattr(parent, attr)
+
+def _clear_cache():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    gc.collect()
 
 class ModelLoader:
     _instance = None
@@ -21,7 +58,22 @@ class ModelLoader:
             return
 
         self.device = torch.device(f"cuda:{conf.gpu_id}" if torch.cuda.is_available() else "cpu")
-        
+        # Same dtype the UNet runs in; Whisper and the VAE follow it.
+        self.weight_dtype = torch.float16 if self.device.type == "cuda" else torch.float32
+
+        if conf.role not in ROLE_COMPONENTS:
+            raise ValueError(f"Unknown MUSETALK_ROLE '{conf.role}'; expected one of {sorted(ROLE_COMPONENTS)}")
+        self.role = conf.role
+
+        # CPU-only hosts: reduced-precision models and threads split with the blend workers
+        self.cpu_profile = None
+        if self.device.type == "cpu":
+            self.cpu_profile = resolve_profile(conf.cpu_profile)
+            threads = configure_threads(conf.cpu_threads, conf.cpu_blend_threads)
+            print(f"CPU profile: {self.cpu_profile}, {threads} intra-op threads")
+        # Precision the models render in; it changes the output, so renders are cached per precision
+        self.precision = "fp16" if self.device.type == "cuda" else self.cpu_profile
+
         # Models
         self.vae = None
         self.unet = None
@@ -29,65 +81,72 @@ class ModelLoader:
         self.audio_processor = None
         self.whisper = None
         self.face_parsing = None
+        self.dwpose = None
         self.timesteps = None
-        
+        self.engine = None
+
+        # On-demand bookkeeping
+        self._lock = threading.RLock()
+        self._last_used = {}
+        self._in_use = {}
+        self._reaper = None
+
         self.initialized = True
 
-    def load(self):
+    @property
+    def role_components(self) -> tuple:
+        return ROLE_COMPONENTS[self.role]
+
+    def load(self, components=None):
         """
-        Loads all required models into memory if they aren't already loaded.
+        Loads the given components (default: the ones required by the node role)
+        into memory if they aren't already loaded.
         """
-        if self.unet is not None:
-            # Already loaded
-            return
+        components = self.role_components if components is None else components
+        with self._lock:
+            missing = [name for name in components if not self._is_component_loaded(name)]
+            if not missing:
+                return
 
-        print(f"Loading models on device: {self.device}...")
-        
-        # Clear cache before loading
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        gc.collect()
-
-        # 1. Load VAE, UNet, PE
-        self.vae, self.unet, self.pe = load_all_model(
-            unet_model_path=conf.unet_model_path,
-            vae_type=conf.vae_type,
-            unet_config=conf.unet_config,
-            device=self.device
-        )
+            print(f"Loading models {missing} on device: {self.device}...")
 
+            # Clear cache before loading
+            _clear_cache()
+
+            for name in missing:
+                getattr(self, f"_load_{name}")()
+                self._last_used[name] = time.time()
+                # Clear cache after each component
+                _clear_cache()
+
+            print(f"Models loaded: {missing}")
+
+    def _optimize(self, module, component: str):
+        """Applies the CPU profile to a loaded module (no-op on GPU hosts)."""
+        if self.cpu_profile is None:
+            return module
+        return optimize_module(module, component, self.cpu_profile)
+
+    def _load_vae(self):
+        self.vae = VAE(model_path=os.path.join("models", conf.vae_type))
         # Move to device and half precision (CUDA only)
-        if self.device.type == "cuda":
-            self.pe = self.pe.half().to(self.device)
-            self.vae.vae = self.vae.vae.half().to(self.device)
-            self.unet.model = self.unet.model.half().to(self.device)
-        else:
-            self.pe = self.pe.to(self.device)
-            self.vae.vae = self.vae.vae.to(self.device)
-            self.unet.model = self.unet.model.to(self.device)
+        self.vae.vae = self._optimize(self.vae.vae.to(device=self.device, dtype=self.weight_dtype), "vae")
+
+    def _load_unet(self):
+        self.unet = UNet(unet_config=conf.unet_config, model_path=conf.unet_model_path, device=self.device)
+        self.pe = PositionalEncoding(d_model=384)
+        self.pe = self._optimize(self.pe.to(device=self.device, dtype=self.weight_dtype), "pe")
+        self.unet.model = self._optimize(self.unet.model.to(device=self.device, dtype=self.weight_dtype), "unet")
         self.timesteps = torch.tensor([0], device=self.device)
-        
-        # Clear cache after loading models
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        gc.collect()
 
-        # 2. Audio Processor
+    def _load_whisper(self):
         self.audio_processor = AudioProcessor(feature_extractor_path=conf.whisper_dir)
-
-        # 3. Whisper
-        # Use same dtype as UNet
-        weight_dtype = self.unet.model.dtype
         self.whisper = WhisperModel.from_pretrained(conf.whisper_dir)
-        self.whisper = self.whisper.to(device=self.device, dtype=weight_dtype).eval()
+        self.whisper = self.whisper.to(device=self.device, dtype=self.weight_dtype).eval()
         self.whisper.requires_grad_(False)
-        
-        # Clear cache after loading Whisper
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        gc.collect()
+        self.whisper = self._optimize(self.whisper, "whisper")
 
-        # 4. Face Parsing
+    def _load_face_parsing(self):
         if conf.version == "v15":
             self.face_parsing = FaceParsing(
                 left_cheek_width=conf.left_cheek_width,
@@ -95,35 +154,168 @@ class ModelLoader:
             )
         else:
             self.face_parsing = FaceParsing()
-            
-        print("All models loaded successfully.")
-        
-        # Final cache clear
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        gc.collect()
+
+    def _load_dwpose(self):
+        # The upstream module builds DWPose and the face detector at import time.
+        self.dwpose = importlib.import_module(_DWPOSE_MODULE)
+
+    def get_engine(self, backend: str | None = None):
+        """
+        Returns the inference engine (PE + UNet + VAE decoder) for the configured
+        backend, exporting or loading cached artifacts on first use. Falls back to
+        eager mode if the backend cannot be built.
+        """
+        backend = backend or conf.engine_backend
+        if backend != "eager" and self.cpu_profile not in (None, "fp32"):
+            # Exported graphs are traced from fp32 modules; the profile's modules run eagerly
+            print(f"CPU profile '{self.cpu_profile}' runs the eager engine instead of '{backend}'")
+            backend = "eager"
+        with self._lock:
+            if self.engine is not None and self.engine.name == backend:
+                return self.engine
+            self.load(("vae", "unet"))
+            vae_dir = os.path.join("models", conf.vae_type)
+            cache_dir = conf.engine_cache_dir or os.path.join(os.path.dirname(conf.unet_model_path), "engines")
+            try:
+                self.engine = build_engine(
+                    backend, self.pe, self.unet, self.vae, self.timesteps, self.device,
+                    cache_dir=cache_dir,
+                    fingerprint=weights_fingerprint(conf.unet_model_path, conf.unet_config, vae_dir),
+                )
+            except Exception as e:
+                print(f"Failed to build '{backend}' engine, falling back to eager: {e}")
+                self.engine = build_engine("eager", self.pe, self.unet, self.vae, self.timesteps, self.device)
+            print(f"Inference engine: {self.engine.name}")
+            return self.engine
+
+    def unload(self, components):
+        """
+        Drops the given components. Requests that still hold a reference keep
+        working; memory is returned once they finish.
+        """
+        with self._lock:
+            for name in components:
+                if not self._is_component_loaded(name):
+                    continue
+                if name == "vae":
+                    self.vae = None
+                    self.engine = None
+                elif name == "unet":
+                    self.unet = None
+                    self.engine = None
+                    self.pe = None
+                    self.timesteps = None
+                elif name == "whisper":
+                    self.whisper = None
+                    self.audio_processor = None
+                elif name == "face_parsing":
+                    self.face_parsing = None
+                elif name == "dwpose":
+                    self.dwpose = None
+                    _forget_module(_DWPOSE_MODULE)
+                self._last_used.pop(name, None)
+                print(f"Unloaded idle model component: {name}")
+            _clear_cache()
+
+    def unload_idle(self, timeout: float | None = None) -> list:
+        """
+        Unloads on-demand components (those outside the node role) that are not
+        in use and have been idle for longer than `timeout` seconds.
+        """
+        timeout = conf.model_idle_timeout if timeout is None else timeout
+        now = time.time()
+        with self._lock:
+            idle = [
+                name for name, last_used in self._last_used.items()
+                if name not in self.role_components
+                and self._in_use.get(name, 0) == 0
+                and now - last_used > timeout
+            ]
+            if idle:
+                self.unload(idle)
+        return idle
+
+    def start_idle_reaper(self):
+        """
+        Starts a daemon thread that periodically unloads idle on-demand components.
+        Disabled when MUSETALK_MODEL_IDLE_TIMEOUT is 0.
+        """
+        if conf.model_idle_timeout <= 0 or self._reaper is not None:
+            return
+        interval = min(max(conf.model_idle_timeout / 4, 1.0), 30.0)
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.unload_idle()
+                except Exception as e:
+                    print(f"Idle model reaper error: {e}")
+
+        self._reaper = threading.Thread(target=reap, name="model-idle-reaper", daemon=True)
+        self._reaper.start()
+
+    def _is_component_loaded(self, name: str) -> bool:
+        if name not in ROLE_COMPONENTS["all"]:
+            raise ValueError(f"Unknown model component: {name}")
+        return getattr(self, name) is not None
+
+    def loaded_components(self) -> list:
+        return [name for name in ROLE_COMPONENTS["all"] if self._is_component_loaded(name)]
 
     def is_loaded(self) -> bool:
-        return self.unet is not None
+        return all(self._is_component_loaded(name) for name in self.role_components)
 
-    def get_models(self):
+    def get_models(self, components=None):
         """
-        Ensure models are loaded and return them.
+        Ensure the requested components (default: the node role) are loaded and return them.
+        Components outside the role are loaded on demand.
         """
-        if self.unet is None:
-            self.load()
-        
-        models = {
-            "vae": self.vae,
-            "unet": self.unet,
-            "pe": self.pe,
-            "audio_processor": self.audio_processor,
-            "whisper": self.whisper,
-            "face_parsing": self.face_parsing,
-            "timesteps": self.timesteps,
-            "device": self.device
-        }
+        components = self.role_components if components is None else components
+        with self._lock:
+            self.load(components)
+            now = time.time()
+            for name in components:
+                self._last_used[name] = now
+
+            engine = None
+            if "unet" in components and "vae" in components:
+                engine = self.get_engine()
+
+            models = {
+                "engine": engine,
+                "vae": self.vae,
+                "unet": self.unet,
+                "pe": self.pe,
+                "audio_processor": self.audio_processor,
+                "whisper": self.whisper,
+                "face_parsing": self.face_parsing,
+                "dwpose": self.dwpose,
+                "timesteps": self.timesteps,
+                "device": self.device,
+                "precision": self.precision
+            }
         return models
 
+    @contextmanager
+    def hold(self, components=None):
+        """
+        Like get_models, but keeps the components from being unloaded as idle
+        until the block exits.
+        """
+        components = self.role_components if components is None else components
+        with self._lock:
+            models = self.get_models(components)
+            for name in components:
+                self._in_use[name] = self._in_use.get(name, 0) + 1
+        try:
+            yield models
+        finally:
+            with self._lock:
+                now = time.time()
+                for name in components:
+                    self._in_use[name] -= 1
+                    self._last_used[name] = now
+
 # Global singleton instance
 model_loader = ModelLoader()
@@ -0,0 +1,195 @@
+import time
+import itertools
+import threading
+from typing import Callable, Iterator, Optional
+from musetalk_server.conf import conf
+from musetalk_server.core.metrics import metrics
+
+# Highest priority first
+PRIORITY_CLASSES = ("interactive", "standard", "bulk")
+
+# Weight of the newest batch in the device time per frame average
+EWMA_WEIGHT = 0.2
+
+class Ticket:
+    """
+    One render's place in the device queue. Each batch it runs waits for a turn;
+    among waiting batches of the same (aged) priority the earliest deadline goes
+    first. With `fps` the deadline of the next batch is when its first frame is
+    due for playback (so a stream running ahead of real time lets others pass),
+    otherwise it is the ticket's creation time (first come, first served).
+    """
+    def __init__(self, scheduler: "GpuScheduler", priority: str, fps: float = 0, seq: int = 0):
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}'; expected one of {PRIORITY_CLASSES}")
+        self.scheduler = scheduler
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES.index(priority)
+        self.fps = fps
+        self.seq = seq
+        self.created = time.monotonic()
+        self.frames = 0
+        self.batches = 0
+        self.waiting_since = None
+
+    @property
+    def deadline(self) -> float:
+        return self.created + self.frames / self.fps if self.fps else self.created
+
+    def iterate(self, batches: Iterator, cancelled: Optional[Callable[[], bool]] = None) -> Iterator:
+        """
+        Pulls each item of `batches` (a generator doing the device work of one
+        batch per item) inside a turn, so other renders can take the device at
+        every batch boundary. Stops early once `cancelled()` is true.
+        """
+        self.scheduler.started(self)
+        try:
+            while True:
+                if not self.scheduler.acquire(self, cancelled):
+                    return
+                start = time.perf_counter()
+                try:
+                    batch = next(batches, None)
+                finally:
+                    self.scheduler.release(self)
+                if batch is None:
+                    return
+                elapsed = (time.perf_counter() - start) * 1000
+                metrics.observe(f"scheduler.batch_ms.{self.priority}", elapsed)
+                self.scheduler.record(len(batch), elapsed)
+                self.batches += 1
+                self.frames += len(batch)
+                yield batch
+        finally:
+            self.scheduler.finished(self)
+
+class GpuScheduler:
+    """
+    Grants device turns (one batch each) to at most `slots` renders at a time.
+    The next turn goes to the waiting batch with the highest priority class,
+    then the earliest deadline, so a live stream preempts an offline render at
+    its next batch boundary. A waiting batch moves up one class for every
+    `aging_seconds` it has waited, so bulk work is never starved.
+    `slots` = 0 turns scheduling off (every batch runs immediately).
+
+    Per-class metrics: `scheduler.wait_ms.<class>` (time a batch waited for its
+    turn), `scheduler.batch_ms.<class>` (time the turn took) and
+    `scheduler.preemptions.<class>` (turns lost to a batch that arrived later).
+
+    It also tracks the renders in progress and a moving average of device time
+    per frame, from which `load()` estimates the capacity left for real time.
+    """
+    def __init__(self, slots: int = 1, aging_seconds: float = 10.0):
+        self.slots = slots
+        self.aging_seconds = aging_seconds
+        self.active = 0
+        self.ms_per_frame = None
+        self._running = set()
+        self._waiting = []
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+
+    def ticket(self, priority: str, fps: float = 0) -> Ticket:
+        return Ticket(self, priority, fps, next(self._seq))
+
+    def _key(self, ticket: Ticket, now: float):
+        rank = ticket.rank
+        if self.aging_seconds > 0:
+            rank = max(0, rank - int((now - ticket.waiting_since) / self.aging_seconds))
+        return rank, ticket.deadline, ticket.seq
+
+    def acquire(self, ticket: Ticket, cancelled: Optional[Callable[[], bool]] = None) -> bool:
+        """Waits for a turn; False if `cancelled()` became true first."""
+        if self.slots <= 0:
+            return True
+        with self._cond:
+            ticket.waiting_since = time.monotonic()
+            self._waiting.append(ticket)
+            metrics.set("scheduler.waiting", len(self._waiting))
+            try:
+                while True:
+                    if cancelled is not None and cancelled():
+                        return False
+                    if self.active < self.slots:
+                        now = time.monotonic()
+                        if min(self._waiting, key=lambda t: self._key(t, now)) is ticket:
+                            break
+                    self._cond.wait(timeout=0.1)
+            finally:
+                self._waiting.remove(ticket)
+                metrics.set("scheduler.waiting", len(self._waiting))
+                self._cond.notify_all()
+            # Batches that were already waiting when this one arrived lost their turn to it
+            for other in self._waiting:
+                if other.waiting_since < ticket.waiting_since:
+                    metrics.inc(f"scheduler.preemptions.{other.priority}")
+            self.active += 1
+        metrics.inc(f"scheduler.turns.{ticket.priority}")
+        metrics.observe(f"scheduler.wait_ms.{ticket.priority}", (time.monotonic() - ticket.waiting_since) * 1000)
+        return True
+
+    def release(self, ticket: Ticket):
+        if self.slots <= 0:
+            return
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def started(self, ticket: Ticket):
+        with self._cond:
+            self._running.add(ticket)
+
+    def finished(self, ticket: Ticket):
+        with self._cond:
+            self._running.discard(ticket)
+
+    def record(self, frames: int, elapsed_ms: float):
+        """Folds one batch's device time into the per-frame average."""
+        if frames <= 0:
+            return
+        sample = elapsed_ms / frames
+        with self._cond:
+            if self.ms_per_frame is None:
+                self.ms_per_frame = sample
+            else:
+                self.ms_per_frame += EWMA_WEIGHT * (sample - self.ms_per_frame)
+
+    def load(self) -> dict:
+        """
+        Renders in progress per class, real-time renders (tickets with an fps)
+        and the frame rate they need, batches waiting for a turn, and the
+        measured device throughput in frames per second (None before the first batch).
+        """
+        with self._cond:
+            running = list(self._running)
+            waiting = len(self._waiting)
+            ms_per_frame = self.ms_per_frame
+        throughput = None
+        if ms_per_frame:
+            throughput = max(1, self.slots) * 1000 / ms_per_frame
+        realtime = [t for t in running if t.fps]
+        return {
+            "renders": {c: sum(1 for t in running if t.priority == c) for c in PRIORITY_CLASSES},
+            "realtime_renders": len(realtime),
+            "realtime_fps": sum(t.fps for t in realtime),
+            "waiting": waiting,
+            "throughput_fps": throughput,
+        }
+
+def parse_priority_keys(spec: str) -> dict:
+    """
+    MUSETALK_PRIORITY_API_KEYS ("key=class,key=class") as {key: class}.
+    """
+    keys = {}
+    for entry in spec.split(","):
+        if not entry.strip():
+            continue
+        key, _, priority = entry.partition("=")
+        priority = priority.strip()
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}' for an API key; expected one of {PRIORITY_CLASSES}")
+        keys[key.strip()] = priority
+    return keys
+
+# Global instance shared by all renders of the process
+gpu_scheduler = GpuScheduler(conf.gpu_slots, conf.priority_aging_seconds)
@@ -0,0 +1,167 @@
+import os
+import json
+import fcntl
+import itertools
+import shutil
+import tempfile
+import threading
+import numpy as np
+import torch
+from contextlib import contextmanager
+from typing import Optional
+
+_ALIGN = 64
+
+def _aligned(offset: int) -> int:
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class SharedAvatarStore:
+    """
+    Decoded avatar data (cycle frames, masks, stacked latents) shared by all server
+    processes on a host through one memory-mapped file per avatar content version,
+    by default in /dev/shm. The first process that loads an avatar decodes it and
+    publishes the file; the others map it, so N uvicorn workers hold one copy.
+
+    Files are reference-counted with one ref file per attached Avatar object
+    (`{key}.refs/{pid}-{n}`); a file is removed once no live process refers to it.
+    Mappings are copy-on-write: a stray in-place write stays private to its process.
+    """
+    def __init__(self, root: str = ""):
+        if not root:
+            root = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            root = os.path.join(root, "musetalk-avatars")
+        self.root = root
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _paths(self, key: str):
+        base = os.path.join(self.root, key)
+        return f"{base}.bin", f"{base}.json", f"{base}.refs", f"{base}.lock"
+
+    @contextmanager
+    def _locked(self, key: str, blocking: bool = True):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self._paths(key)[3], "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def attach(self, avatar, load) -> None:
+        """
+        Fills `avatar`'s frames, masks and latent cycle with views of the shared file,
+        calling `load()` (the regular decode from disk) first if no process has
+        published this content version yet.
+        """
+        key = f"{avatar.avatar_id}-{avatar.content_version}"
+        data_path, manifest_path, refs_path, _ = self._paths(key)
+        with self._locked(key):
+            if not os.path.exists(data_path):
+                load()
+                self._publish(avatar, data_path, manifest_path)
+                print(f"Avatar {avatar.avatar_id} published to shared memory ({os.path.getsize(data_path) >> 20} MB)")
+            os.makedirs(refs_path, exist_ok=True)
+            with self._lock:
+                ref = os.path.join(refs_path, f"{os.getpid()}-{next(self._counter)}")
+            open(ref, "w").close()
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+
+        mapped = np.memmap(data_path, dtype=np.uint8, mode="c")
+
+        def view(entry):
+            start, (shape, dtype) = entry["offset"], (entry["shape"], np.dtype(entry["dtype"]))
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            return np.asarray(mapped[start:start + nbytes]).view(dtype).reshape(shape)
+
+        avatar.frame_list_cycle = [view(e) for e in manifest["frames"]]
+        avatar.mask_list_cycle = [view(e) for e in manifest["masks"]]
+        avatar.latent_cycle = torch.from_numpy(view(manifest["latents"]))
+        avatar.shared_ref = ref
+        self.collect(exclude=key)
+
+    def detach(self, avatar) -> None:
+        """
+        Drops `avatar`'s reference (its arrays stay valid until garbage-collected).
+        """
+        ref = getattr(avatar, "shared_ref", None)
+        if ref is None:
+            return
+        avatar.shared_ref = None
+        try:
+            os.remove(ref)
+        except FileNotFoundError:
+            pass
+
+    def _publish(self, avatar, data_path: str, manifest_path: str):
+        latents = avatar.latent_cycle.detach().to("cpu").contiguous().numpy()
+        arrays = {"frames": avatar.frame_list_cycle, "masks": avatar.mask_list_cycle, "latents": [latents]}
+        manifest, offset = {}, 0
+        for name, items in arrays.items():
+            entries = []
+            for arr in items:
+                entries.append({"offset": offset, "shape": list(arr.shape), "dtype": arr.dtype.str})
+                offset = _aligned(offset + arr.nbytes)
+            manifest[name] = entries
+        manifest["latents"] = manifest["latents"][0]
+
+        tmp_path = f"{data_path}.tmp{os.getpid()}"
+        out = np.memmap(tmp_path, dtype=np.uint8, mode="w+", shape=(max(offset, 1),))
+        for name, items in arrays.items():
+            entries = manifest[name] if name != "latents" else [manifest["latents"]]
+            for arr, entry in zip(items, entries):
+                start = entry["offset"]
+                out[start:start + arr.nbytes] = np.ascontiguousarray(arr).reshape(-1).view(np.uint8)
+        out.flush()
+        del out
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+        # The data file appears last; its presence means the entry is complete
+        os.replace(tmp_path, data_path)
+
+    def collect(self, exclude: Optional[str] = None) -> list:
+        """
+        Removes shared files no live process refers to. Returns the removed keys.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        removed = []
+        keys = {name[:-len(".bin")] for name in os.listdir(self.root) if name.endswith(".bin")}
+        for key in sorted(keys - {exclude}):
+            data_path, manifest_path, refs_path, lock_path = self._paths(key)
+            with self._locked(key, blocking=False) as locked:
+                if not locked:
+                    continue
+                live = False
+                for ref in os.listdir(refs_path) if os.path.isdir(refs_path) else []:
+                    pid = int(ref.split("-", 1)[0]) if ref.split("-", 1)[0].isdigit() else 0
+                    if _pid_alive(pid):
+                        live = True
+                    else:
+                        os.remove(os.path.join(refs_path, ref))
+                if live:
+                    continue
+                for path in (data_path, manifest_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                shutil.rmtree(refs_path, ignore_errors=True)
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            removed.append(key)
+        return removed
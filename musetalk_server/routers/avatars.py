@@ -1,17 +1,39 @@
 import re
 
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request, Response
+from fastapi.responses import FileResponse
 from musetalk_server.conf import conf as settings
-from musetalk_server.core.model_loader import model_loader
+from musetalk_server.core.model_loader import model_loader, PREPROCESS_COMPONENTS
 from musetalk_server.core.avatar import Avatar
+from musetalk_server.core.shared_store import SharedAvatarStore
+from musetalk_server.core.avatar_store import AvatarStore, open_backend
 from musetalk_server.services.preprocess import AvatarPreprocessor
+from musetalk_server.services.bundle import build_bundle, bundle_manifest
+from musetalk_server.services.uploads import upload_store
+from musetalk_server.services.warmup import mark_used
 from musetalk_server.schemas.api import PreprocessResponse, AvatarInfo
-import shutil
+import json
 import os
+import time
+import threading
 import traceback
 
 router = APIRouter()
 avatars = {} # In-memory cache for loaded avatars
+_load_locks = {} # avatar_id -> lock, so concurrent first requests (or warm-up) load an avatar once
+_load_locks_guard = threading.Lock()
+_last_marked = {} # avatar_id -> time its last_used marker was touched
+# Decoded avatars shared by all worker processes on this host (None: each process decodes its own)
+shared_store = SharedAvatarStore(settings.avatar_shared_dir) if settings.avatar_shared_memory else None
+# Avatars published by other nodes, fetched on first use (None: only avatars built on this node)
+avatar_store = AvatarStore(
+    open_backend(settings.avatar_store_url, settings.avatar_store_endpoint_url, settings.avatar_fetch_workers),
+    os.path.join(settings.result_dir, settings.version, "avatars"),
+    version=settings.version,
+    max_bytes=settings.avatar_cache_max_mb * 1024 * 1024,
+    workers=settings.avatar_fetch_workers,
+    in_use=lambda: list(avatars),
+) if settings.avatar_store_url else None
 
 _AVATAR_ID_PATTERN = re.compile(r'^[a-zA-Z0-9_\-]{1,64}$')
 
@@ -21,11 +43,14 @@ def validate_avatar_id(avatar_id: str) -> None:
 
 @router.get("/avatars", response_model=list[str])
 def list_avatars():
-    """List all available (preprocessed) avatars on disk."""
+    """List all available (preprocessed) avatars: on disk and, with an avatar store, published by any node."""
     avatar_root = os.path.join(settings.result_dir, settings.version, "avatars")
-    if not os.path.exists(avatar_root):
-        return []
-    return [d for d in os.listdir(avatar_root) if os.path.isdir(os.path.join(avatar_root, d))]
+    local = []
+    if os.path.exists(avatar_root):
+        local = [d for d in os.listdir(avatar_root) if os.path.isdir(os.path.join(avatar_root, d))]
+    if avatar_store is None:
+        return local
+    return sorted(set(local) | set(avatar_store.remote_ids()))
 
 @router.post("/avatars/preprocess", response_model=PreprocessResponse)
 async def preprocess_avatar(
@@ -36,65 +61,187 @@ async def preprocess_avatar(
     """
     Upload a video and preprocess it to create an avatar.
     This is a blocking operation for simplicity, but in production should be backgrounded.
+    Uploads are stored by content hash; re-uploading a video with the same parameters
+    under another avatar_id links the existing build instead of preprocessing again.
     """
     validate_avatar_id(avatar_id)
 
-    # Save uploaded video
-    video_dir = os.path.join(settings.result_dir, "uploads")
-    os.makedirs(video_dir, exist_ok=True)
-    video_path = os.path.join(video_dir, f"{avatar_id}_{video_file.filename}")
-    
-    with open(video_path, "wb") as buffer:
-        shutil.copyfileobj(video_file.file, buffer)
+    # Save uploaded video (hashed while streaming to results/uploads/{sha256}{ext})
+    sha256, video_path = upload_store.save(video_file.file, video_file.filename or "")
     
+    return run_preprocess(avatar_id, video_path, bbox_shift, source_digest=sha256)
+
+@router.post("/avatars/{avatar_id}/reprocess", response_model=PreprocessResponse)
+def reprocess_avatar(avatar_id: str, bbox_shift: int = Form(0)):
+    """
+    Re-runs preprocessing of an existing avatar from its stored source video, e.g. to
+    tune bbox_shift. Cached stages are reused (frames and landmarks don't depend on
+    bbox_shift), so only boxes, latents and masks are recomputed.
+    """
+    validate_avatar_id(avatar_id)
+    avatar = Avatar(avatar_id, results_dir=settings.result_dir, version=settings.version)
+    video_path = None
+    if os.path.exists(avatar.avatar_info_path):
+        with open(avatar.avatar_info_path, "r") as f:
+            video_path = json.load(f).get("video_path")
+    if not video_path or not os.path.exists(video_path):
+        raise HTTPException(status_code=404, detail=f"Source video of avatar {avatar_id} not found; upload it again.")
+    return run_preprocess(avatar_id, video_path, bbox_shift)
+
+def run_preprocess(avatar_id: str, video_path: str, bbox_shift: int, source_digest: str = None) -> PreprocessResponse:
     try:
-        # Load models if not loaded (lazy loading)
-        models = model_loader.get_models()
-        
-        # Run preprocessing
-        preprocessor = AvatarPreprocessor(models['vae'], models['face_parsing'])
-        preprocessor.process_avatar(
-            video_path,
-            avatar_id,
-            bbox_shift,
-            results_dir=settings.result_dir,
-            extra_margin=settings.extra_margin,
-            parsing_mode=settings.parsing_mode,
-            version=settings.version
-        )
+        if avatar_store is not None:
+            # A fetched copy becomes this node's build
+            avatar_store.adopt(avatar_id)
+        # Load models if not loaded (lazy loading; on-demand on inference-only nodes)
+        with model_loader.hold(PREPROCESS_COMPONENTS) as models:
+            # Run preprocessing
+            preprocessor = AvatarPreprocessor(models['vae'], models['face_parsing'], models['dwpose'])
+            linked_from = preprocessor.process_avatar(
+                video_path,
+                avatar_id,
+                bbox_shift,
+                results_dir=settings.result_dir,
+                extra_margin=settings.extra_margin,
+                parsing_mode=settings.parsing_mode,
+                version=settings.version,
+                left_cheek_width=settings.left_cheek_width,
+                right_cheek_width=settings.right_cheek_width,
+                source_digest=source_digest,
+                keyframe_interval=settings.landmark_keyframe_interval,
+                motion_threshold=settings.landmark_motion_threshold
+            )
         
         # Load the avatar into memory to verify it works and cache it
         avatar = Avatar(avatar_id, results_dir=settings.result_dir, version=settings.version)
-        avatar.load_state()
+        avatar.load_state(workers=settings.avatar_decode_workers, store=shared_store)
+        previous = avatars.get(avatar_id)
         avatars[avatar_id] = avatar
+        if previous is not None and not previous.is_pinned:
+            previous.release_latents()
+            if shared_store is not None:
+                shared_store.detach(previous)
+        # The avatar now refers to its upload; drop uploads nothing refers to anymore
+        upload_store.gc(settings.result_dir)
+        if avatar_store is not None and settings.avatar_store_publish:
+            try:
+                avatar_store.publish(avatar_id)
+            except Exception as e:
+                # Still usable on this node; POST /avatars/{id}/publish retries
+                print(f"Failed to publish avatar {avatar_id}: {e}")
         
         return PreprocessResponse(
-            message="Avatar processed successfully",
+            message=f"Avatar linked to the identical build of {linked_from}" if linked_from else "Avatar processed successfully",
             avatar_id=avatar_id,
             info=AvatarInfo(
                 avatar_id=avatar_id,
                 video_path=video_path,
                 bbox_shift=bbox_shift,
                 version=settings.version
-            )
+            ),
+            linked_from=linked_from
         )
     except Exception as e:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Preprocessing failed: {str(e)}")
 
+@router.post("/avatars/{avatar_id}/publish")
+def publish_avatar(avatar_id: str):
+    """
+    Uploads an avatar built on this node to the avatar store, e.g. one preprocessed
+    before the store was configured. Other nodes fetch it on first use.
+    """
+    validate_avatar_id(avatar_id)
+    if avatar_store is None:
+        raise HTTPException(status_code=400, detail="No avatar store configured (MUSETALK_AVATAR_STORE_URL)")
+    avatar = Avatar(avatar_id, results_dir=settings.result_dir, version=settings.version)
+    if not avatar.exists():
+        raise HTTPException(status_code=404, detail=f"Avatar {avatar_id} not found")
+    return avatar_store.publish(avatar_id)
+
+def get_loaded_avatar(avatar_id: str) -> Avatar:
+    avatar = get_avatar(avatar_id)
+    if not avatar:
+        raise HTTPException(status_code=404, detail=f"Avatar {avatar_id} not found")
+    return avatar
+
+def _not_modified(request: Request, etag: str) -> bool:
+    return request.headers.get("if-none-match") == f'"{etag}"'
+
+@router.get("/avatars/{avatar_id}/bundle")
+def avatar_bundle(avatar_id: str, request: Request):
+    """
+    Cycle bundle for client-side compositing (patch stream mode): a zip with
+    manifest.json and the pre-encoded base frames. Fetch once per content version.
+    """
+    avatar = get_loaded_avatar(avatar_id)
+    etag = avatar.content_version
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": f'"{etag}"'})
+    path = build_bundle(avatar, settings.fps)
+    return FileResponse(path, media_type="application/zip", filename=f"{avatar_id}_bundle.zip",
+                        headers={"ETag": f'"{etag}"'})
+
+@router.get("/avatars/{avatar_id}/bundle/manifest")
+def avatar_bundle_manifest(avatar_id: str):
+    """The bundle's manifest.json, for clients that fetch base frames one by one (e.g. browsers)."""
+    return bundle_manifest(get_loaded_avatar(avatar_id), settings.fps)
+
+@router.get("/avatars/{avatar_id}/bundle/frames/{cycle_index}")
+def avatar_bundle_frame(avatar_id: str, cycle_index: int, request: Request):
+    avatar = get_loaded_avatar(avatar_id)
+    if not 0 <= cycle_index < len(avatar.frame_list_cycle):
+        raise HTTPException(status_code=404, detail=f"Frame {cycle_index} out of range")
+    etag = f"{avatar.content_version}-{cycle_index}"
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "public, max-age=86400"}
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(avatar.encoded_frame(cycle_index), media_type="image/jpeg", headers=headers)
+
 def get_avatar(avatar_id: str) -> Avatar:
     """Helper to get avatar from cache or load from disk"""
     validate_avatar_id(avatar_id)
 
-    if avatar_id in avatars:
-        return avatars[avatar_id]
-    
+    avatar = _get_or_load(avatar_id)
+    if avatar is not None:
+        _mark_used(avatar)
+    return avatar
+
+def avatar_exists(avatar_id: str) -> bool:
+    """Built on this node, or published to the avatar store (then fetched on first use)."""
+    if Avatar(avatar_id, results_dir=settings.result_dir, version=settings.version).exists():
+        return True
+    return avatar_store is not None and avatar_store.manifest(avatar_id) is not None
+
+def preload_avatar(avatar_id: str) -> bool:
+    """Loads an avatar into the cache at startup (without counting it as used)."""
+    validate_avatar_id(avatar_id)
+    return _get_or_load(avatar_id) is not None
+
+def _get_or_load(avatar_id: str) -> Avatar:
+    avatar = avatars.get(avatar_id)
+    if avatar is not None:
+        return avatar
+    with _load_locks_guard:
+        lock = _load_locks.setdefault(avatar_id, threading.Lock())
+    with lock:
+        avatar = avatars.get(avatar_id)
+        return avatar if avatar is not None else _load_avatar(avatar_id)
+
+def _load_avatar(avatar_id: str) -> Avatar:
     # Try to load from disk
     try:
         avatar = Avatar(avatar_id, results_dir=settings.result_dir, version=settings.version)
-        avatar.load_state()
+        avatar.load_state(workers=settings.avatar_decode_workers, store=shared_store, remote=avatar_store)
         avatars[avatar_id] = avatar
         return avatar
     except Exception as e:
         print(f"Failed to load avatar {avatar_id}: {e}")
         return None
+
+def _mark_used(avatar: Avatar):
+    # Records use for MUSETALK_PRELOAD_RECENT, at most once a minute per avatar
+    now = time.monotonic()
+    if now - _last_marked.get(avatar.avatar_id, -60.0) >= 60.0:
+        _last_marked[avatar.avatar_id] = now
+        mark_used(avatar.avatar_path)
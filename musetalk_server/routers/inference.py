@@ -1,80 +1,263 @@
-from typing import Optional
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from typing import Literal, Optional
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Request, Response
 from fastapi.responses import StreamingResponse, FileResponse
-from musetalk_server.core.model_loader import model_loader
-from musetalk_server.services.inference import InferenceService
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from musetalk_server.core.model_loader import model_loader, INFERENCE_COMPONENTS
+from musetalk_server.core.scheduler import PRIORITY_CLASSES, parse_priority_keys
+from musetalk_server.services.inference import InferenceService, FramePatch, CancelToken, InferenceCancelled
 from musetalk_server.routers.avatars import get_avatar
+from musetalk_server.services.result_cache import result_cache
+from musetalk_server.services.audio import AudioClip, AudioDecodeError, decode_audio
+from musetalk_server.services.realtime import RealtimePacer, StreamPart
 from musetalk_server.conf import conf as settings
-import shutil
+import asyncio
+import hashlib
+import json
 import os
 import uuid
 
 router = APIRouter()
+# Seconds between client disconnect checks while a batch render runs
+DISCONNECT_POLL_INTERVAL = 0.5
+# API key -> priority class (MUSETALK_PRIORITY_API_KEYS)
+priority_keys = parse_priority_keys(settings.priority_api_keys)
+
+Priority = Literal["interactive", "standard", "bulk"]
+
+def request_priority(request: Request, requested: Optional[str], default: str) -> str:
+    """
+    Priority class of a render: the requested class (else the endpoint default),
+    capped at the class of the request's X-API-Key when it is listed in
+    MUSETALK_PRIORITY_API_KEYS; a keyed client can lower its class, not raise it.
+    """
+    priority = requested or default
+    key_class = priority_keys.get(request.headers.get("x-api-key", ""))
+    if key_class is not None:
+        if requested is None:
+            return key_class
+        return max(key_class, priority, key=PRIORITY_CLASSES.index)
+    return priority
+
+def read_audio_upload(upload: UploadFile) -> tuple[AudioClip, str]:
+    """
+    Decodes an audio upload in memory (no temporary file).
+    Returns the clip and the SHA-256 hex digest of the uploaded bytes.
+    """
+    data = upload.file.read()
+    try:
+        return decode_audio(data, settings.ffmpeg_path), hashlib.sha256(data).hexdigest()
+    except AudioDecodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def until_disconnected(parts, cancel: CancelToken):
+    """
+    Iterates a blocking part generator in the threadpool. When the response task ends
+    early (the client disconnected and Starlette cancelled it), the render is cancelled
+    so its workers stop at the next batch instead of running to the end of the audio.
+    """
+    try:
+        async for part in iterate_in_threadpool(parts):
+            yield part
+    finally:
+        cancel.cancel("disconnect")
+        try:
+            parts.close()
+        except ValueError:
+            # Still running in a worker thread; it returns promptly now that the token is set
+            pass
+
+async def run_until_disconnected(request: Request, cancel: CancelToken, render):
+    """
+    Runs a blocking render in the threadpool and polls the client meanwhile. When it
+    disconnects, the render is cancelled and stops at the next batch instead of
+    keeping the device busy for a response nobody reads.
+    """
+    task = asyncio.ensure_future(run_in_threadpool(render))
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if not task.done() and not cancel.cancelled and await request.is_disconnected():
+                cancel.cancel("disconnect")
+    except asyncio.CancelledError:
+        cancel.cancel("disconnect")
+        raise
+    return task.result()
+
+def video_file_response(path: str, request: Request, etag: str, filename: str, cache_status: str) -> Response:
+    """FileResponse (with Range support) plus a content-addressed ETag."""
+    headers = {"ETag": f'"{etag}"', "X-Cache": cache_status}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    # Stat now: raises FileNotFoundError here, not halfway through the response, if it was evicted
+    return FileResponse(path, media_type="video/mp4", filename=filename, headers=headers, stat_result=os.stat(path))
+
+def multipart_part(content_type: str, payload: bytes, headers: dict) -> bytes:
+    """Multipart part with Content-Length and extra headers."""
+    lines = [f"Content-Type: {content_type}", f"Content-Length: {len(payload)}"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return b'--frame\r\n' + ("\r\n".join(lines) + "\r\n\r\n").encode() + payload + b'\r\n'
+
+def patch_headers(patch: FramePatch) -> dict:
+    return {
+        "X-Frame-Index": patch.frame_index,
+        "X-Cycle-Index": patch.cycle_index,
+        "X-Patch-Box": ",".join(str(v) for v in patch.box),
+    }
+
+def patch_part(patch: FramePatch) -> bytes:
+    """Multipart part of a patch-mode stream."""
+    return multipart_part("image/jpeg", patch.jpeg, patch_headers(patch))
+
+def realtime_part(part: StreamPart, audio: AudioClip) -> bytes:
+    """
+    Multipart part of a real-time stream: L16 audio chunks and video frames
+    (full JPEG or patch) carrying their presentation timestamp.
+    """
+    headers = {"X-PTS": f"{part.pts:.3f}", "X-Audio-Chunk": part.index}
+    if part.kind == "audio":
+        return multipart_part(f"audio/L16;rate={audio.sample_rate};channels={audio.channels}", part.payload, headers)
+    if isinstance(part.payload, FramePatch):
+        return multipart_part("image/jpeg", part.payload.jpeg, {**patch_headers(part.payload), **headers})
+    return multipart_part("image/jpeg", part.payload, {"X-Frame-Index": part.index, **headers})
 
 @router.post("/inference/stream/{avatar_id}")
 async def stream_inference(
+    request: Request,
     avatar_id: str,
     audio_file: UploadFile = File(...),
-    batch_size: Optional[int] = Form(None, description="Override default batch size (1-32)", ge=1, le=32)
+    batch_size: Optional[int] = Form(None, description="Override default batch size (1-32)", ge=1, le=32),
+    lip_stride: Optional[int] = Form(None, description="Infer every k-th frame and interpolate the rest (1-4)", ge=1, le=4),
+    mode: Literal["frame", "patch"] = Form("frame", description="frame: full composited frames; patch: blended face patches only"),
+    realtime: bool = Form(False, description="Pace output at fps with timestamps and interleaved L16 audio"),
+    priority: Optional[Priority] = Form(None, description="Scheduling class on the device (default: interactive)")
 ):
     """
     Real-time streaming inference. Returns an MJPEG stream.
+    In patch mode each part only holds the blended face region, with X-Cycle-Index and
+    X-Patch-Box headers; clients draw it over the base frame from /avatars/{avatar_id}/bundle.
+    With `realtime`, frames are paced at fps behind a jitter buffer, every frame is
+    preceded by its audio chunk, both carry X-PTS, and a final JSON part reports the
+    stream's underrun and lateness counters.
+    `priority` (or the class of the X-API-Key) orders this stream's batches
+    against other renders on the device.
     """
-    avatar = get_avatar(avatar_id)
+    # Loading the avatar, decoding the audio and loading models block; keep them off the
+    # event loop so they don't stall streams that are already running
+    avatar = await run_in_threadpool(get_avatar, avatar_id)
     if not avatar:
         raise HTTPException(status_code=404, detail=f"Avatar {avatar_id} not found. Preprocess it first.")
 
-    temp_id = str(uuid.uuid4())
-    audio_path = os.path.join(settings.result_dir, "temp", f"{temp_id}.wav")
-    os.makedirs(os.path.dirname(audio_path), exist_ok=True)
-    with open(audio_path, "wb") as buffer:
-        shutil.copyfileobj(audio_file.file, buffer)
+    audio, _ = await run_in_threadpool(read_audio_upload, audio_file)
+    priority = request_priority(request, priority, "interactive")
 
-    models = model_loader.get_models()
-    service = InferenceService(models, settings, batch_size_override=batch_size)
+    models = await run_in_threadpool(model_loader.get_models, INFERENCE_COMPONENTS)
+    service = InferenceService(models, settings, batch_size_override=batch_size, lip_stride_override=lip_stride)
+    cancel = CancelToken(settings.inference_timeout)
 
     def iterfile():
         try:
-            for frame_bytes in service.inference_stream(avatar, audio_path):
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            # Keep the models pinned while the stream is being consumed
+            with model_loader.hold(INFERENCE_COMPONENTS):
+                frames = service.inference_stream(avatar, audio, patch_mode=mode == "patch", cancel=cancel,
+                                                  priority=priority)
+                if realtime:
+                    prebuffer = settings.realtime_prebuffer_frames or 2 * service.batch_size
+                    pacer = RealtimePacer(frames, audio, settings.fps, prebuffer,
+                                          on_close=lambda: cancel.cancel("closed"))
+                    for part in pacer:
+                        yield realtime_part(part, audio)
+                    print(f"Real-time stream stats: {pacer.stats}")
+                    yield multipart_part("application/json", json.dumps(pacer.stats).encode(), {"X-Stream-Stats": "1"})
+                    return
+                for item in frames:
+                    if isinstance(item, FramePatch):
+                        yield patch_part(item)
+                        continue
+                    yield (b'--frame\r\n'
+                           b'Content-Type: image/jpeg\r\n\r\n' + item + b'\r\n')
+        except InferenceCancelled as e:
+            print(f"Stream stopped: {e}")
         except Exception as e:
             print(f"Stream error: {e}")
-        finally:
-            if os.path.exists(audio_path):
-                os.remove(audio_path)
 
-    return StreamingResponse(iterfile(), media_type="multipart/x-mixed-replace; boundary=frame")
+    return StreamingResponse(until_disconnected(iterfile(), cancel), media_type="multipart/x-mixed-replace; boundary=frame")
 
 @router.post("/inference/batch/{avatar_id}")
 async def batch_inference(
+    request: Request,
     avatar_id: str,
     audio_file: UploadFile = File(...),
-    batch_size: Optional[int] = Form(None, description="Override default batch size (1-32)", ge=1, le=32)
+    batch_size: Optional[int] = Form(None, description="Override default batch size (1-32)", ge=1, le=32),
+    lip_stride: Optional[int] = Form(None, description="Infer every k-th frame and interpolate the rest (1-4)", ge=1, le=4),
+    progressive: bool = Form(False, description="Stream a fragmented MP4 while it is being rendered"),
+    priority: Optional[Priority] = Form(None, description="Scheduling class on the device (default: standard)")
 ):
     """
     Batch inference. Generates a full MP4 video and returns it.
+    Identical requests are served from the result cache. With `progressive`, a cache
+    miss is streamed as a fragmented MP4 while rendering; the finished file is cached.
     """
-    avatar = get_avatar(avatar_id)
+    avatar = await run_in_threadpool(get_avatar, avatar_id)
     if not avatar:
         raise HTTPException(status_code=404, detail=f"Avatar {avatar_id} not found")
 
+    audio, audio_sha256 = await run_in_threadpool(read_audio_upload, audio_file)
+    priority = request_priority(request, priority, "standard")
     temp_id = str(uuid.uuid4())
-    temp_dir = os.path.join(settings.result_dir, "temp")
-    os.makedirs(temp_dir, exist_ok=True)
-    audio_path = os.path.join(temp_dir, f"{temp_id}.wav")
+    cancel = CancelToken(settings.inference_timeout)
+
+    try:
+        models = await run_in_threadpool(model_loader.get_models, INFERENCE_COMPONENTS)
+        service = InferenceService(models, settings, batch_size_override=batch_size, lip_stride_override=lip_stride)
+        cache_key = result_cache.make_key(avatar_id, avatar.content_version, audio_sha256, service.render_settings())
+        filename = f"{avatar_id}_{cache_key[:12]}.mp4"
 
-    with open(audio_path, "wb") as buffer:
-        shutil.copyfileobj(audio_file.file, buffer)
+        cached_path = result_cache.get(cache_key)
+        if cached_path:
+            try:
+                return video_file_response(cached_path, request, cache_key, filename, "HIT")
+            except FileNotFoundError:
+                # Evicted by another request's store since get(); render it again
+                print(f"Cached render {cache_key[:12]} vanished; rendering again")
 
-    models = model_loader.get_models()
-    service = InferenceService(models, settings, batch_size_override=batch_size)
+        rendered_path = os.path.join(result_cache.root, f"tmp_{temp_id}.mp4")
 
-    try:
-        output_path = service.inference_batch(avatar, audio_path)
-        return FileResponse(output_path, media_type="video/mp4", filename=f"{avatar_id}_{temp_id}.mp4")
+        if progressive:
+            def iterfile():
+                try:
+                    with model_loader.hold(INFERENCE_COMPONENTS):
+                        yield from service.inference_progressive(avatar, audio, rendered_path, cancel=cancel,
+                                                                priority=priority)
+                    result_cache.put(cache_key, rendered_path)
+                except Exception as e:
+                    print(f"Progressive render error: {e}")
+                finally:
+                    if os.path.exists(rendered_path):
+                        os.remove(rendered_path)
+
+            return StreamingResponse(
+                until_disconnected(iterfile(), cancel),
+                media_type="video/mp4",
+                headers={
+                    "ETag": f'"{cache_key}"',
+                    "X-Cache": "MISS",
+                    "Content-Disposition": f'attachment; filename="{filename}"',
+                },
+            )
+
+        def render() -> str:
+            try:
+                with model_loader.hold(INFERENCE_COMPONENTS):
+                    service.inference_batch(avatar, audio, output_path=rendered_path, cancel=cancel, priority=priority)
+                return result_cache.put(cache_key, rendered_path)
+            finally:
+                if os.path.exists(rendered_path):
+                    os.remove(rendered_path)
+
+        # The render takes as long as the audio; in a worker thread, live streams keep flowing
+        output_path = await run_until_disconnected(request, cancel, render)
+        return video_file_response(output_path, request, cache_key, filename, "MISS")
+    except InferenceCancelled as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Inference failed: {str(e)}")
-    finally:
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
@@ -0,0 +1,113 @@
+import os
+import json
+from typing import List
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from pydantic import ValidationError
+from musetalk_server.core.model_loader import model_loader, INFERENCE_COMPONENTS
+from musetalk_server.core.scheduler import gpu_scheduler
+from musetalk_server.routers.avatars import avatar_exists, get_avatar, validate_avatar_id
+from musetalk_server.services.inference import InferenceService, CancelToken
+from musetalk_server.services.jobs import RenderJob, job_manager, render_job
+from musetalk_server.services.uploads import UploadStore
+from musetalk_server.schemas.api import JobInfo, JobManifest
+from musetalk_server.conf import conf as settings
+
+router = APIRouter()
+
+def run_job(job: RenderJob, cancel: CancelToken):
+    """Renders a job on the job worker, with the inference models held for its duration."""
+    with model_loader.hold(INFERENCE_COMPONENTS) as models:
+        service = InferenceService(models, settings, batch_size_override=job.batch_size,
+                                   lip_stride_override=job.lip_stride)
+        render_job(job, service, get_avatar, cancel, feature_cache_mb=settings.job_feature_cache_mb,
+                   ticket=gpu_scheduler.ticket("bulk"))
+
+def server_path(path: str, what: str) -> str:
+    """Resolves a manifest path under MUSETALK_JOB_PATHS_ROOT."""
+    if not settings.job_paths_root:
+        raise HTTPException(status_code=400, detail=f"{what} '{path}': server paths are disabled (set MUSETALK_JOB_PATHS_ROOT)")
+    root = os.path.realpath(settings.job_paths_root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise HTTPException(status_code=400, detail=f"{what} '{path}' is outside MUSETALK_JOB_PATHS_ROOT")
+    return resolved
+
+def get_job(job_id: str) -> RenderJob:
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+@router.post("/jobs", response_model=JobInfo)
+def submit_job(
+    manifest: str = Form(..., description="JSON: items [{avatar_id, audio, output_name?}], output_dir?, batch_size?, lip_stride?"),
+    audio_files: List[UploadFile] = File([], description="Audio referenced by filename from manifest items")
+):
+    """
+    Queues a bulk render of many (avatar, audio) pairs. Jobs run one at a time in
+    the background; poll GET /jobs/{job_id} for per-item progress.
+    """
+    try:
+        spec = JobManifest(**json.loads(manifest))
+    except (ValueError, ValidationError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid manifest: {e}")
+    if not spec.items:
+        raise HTTPException(status_code=400, detail="Manifest has no items")
+    if spec.batch_size is not None and not 1 <= spec.batch_size <= 32:
+        raise HTTPException(status_code=400, detail="batch_size must be 1-32")
+    if spec.lip_stride is not None and not 1 <= spec.lip_stride <= 4:
+        raise HTTPException(status_code=400, detail="lip_stride must be 1-4")
+
+    for avatar_id in {item.avatar_id for item in spec.items}:
+        validate_avatar_id(avatar_id)
+        if not avatar_exists(avatar_id):
+            raise HTTPException(status_code=404, detail=f"Avatar {avatar_id} not found. Preprocess it first.")
+
+    job_id = job_manager.new_job_id()
+    job_dir = job_manager.job_dir(job_id)
+    output_dir = server_path(spec.output_dir, "output_dir") if spec.output_dir else os.path.join(job_dir, "outputs")
+
+    # Uploads are stored by content hash, so the same clip attached twice is kept once
+    uploads = {}
+    store = UploadStore(os.path.join(job_dir, "audio"), grace_seconds=0)
+    for upload in audio_files:
+        _, uploads[upload.filename] = store.save(upload.file, upload.filename or "")
+
+    items = []
+    output_names = set()
+    for index, entry in enumerate(spec.items):
+        audio_path = uploads.get(entry.audio) or server_path(entry.audio, "audio")
+        if not os.path.isfile(audio_path):
+            raise HTTPException(status_code=400, detail=f"Item {index}: audio '{entry.audio}' not found")
+        name = os.path.basename(entry.output_name or f"{index:05d}_{entry.avatar_id}.mp4")
+        if name in output_names:
+            raise HTTPException(status_code=400, detail=f"Item {index}: duplicate output name '{name}'")
+        output_names.add(name)
+        items.append({
+            "index": index,
+            "avatar_id": entry.avatar_id,
+            "audio": audio_path,
+            "output_path": os.path.join(output_dir, name),
+            "status": "pending",
+            "frames_done": 0,
+            "frames_total": 0,
+            "error": None,
+        })
+
+    job = RenderJob(job_id, job_dir, items, output_dir, batch_size=spec.batch_size, lip_stride=spec.lip_stride)
+    return JobInfo(**job_manager.submit(job).info())
+
+@router.get("/jobs", response_model=list[JobInfo])
+def list_jobs():
+    return [JobInfo(**job.info()) for job in job_manager.list()]
+
+@router.get("/jobs/{job_id}", response_model=JobInfo)
+def job_info(job_id: str):
+    return JobInfo(**get_job(job_id).info())
+
+@router.delete("/jobs/{job_id}", response_model=JobInfo)
+def cancel_job(job_id: str):
+    """Cancels a queued or running job; items already written are kept."""
+    job = get_job(job_id)
+    job_manager.cancel(job_id)
+    return JobInfo(**job.info())
@@ -0,0 +1,96 @@
+from contextlib import ExitStack
+from typing import Optional
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from fastapi.responses import StreamingResponse
+from musetalk_server.core.model_loader import model_loader, INFERENCE_COMPONENTS
+from musetalk_server.routers.avatars import get_avatar
+from musetalk_server.routers.inference import read_audio_upload, until_disconnected
+from musetalk_server.services.session import session_manager
+from musetalk_server.services.inference import CancelToken
+from musetalk_server.schemas.api import SessionInfo, UtteranceResponse
+from musetalk_server.conf import conf as settings
+
+router = APIRouter()
+
+def get_session(session_id: str):
+    session = session_manager.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found")
+    return session
+
+@router.post("/sessions", response_model=SessionInfo)
+def create_session(
+    avatar_id: str = Form(...),
+    batch_size: Optional[int] = Form(None, description="Override default batch size (1-32)", ge=1, le=32),
+    lip_stride: Optional[int] = Form(None, description="Infer every k-th frame and interpolate the rest (1-4)", ge=1, le=4)
+):
+    """
+    Opens a session: the avatar stays pinned in memory and the inference workers
+    stay up until the session is closed or idle for MUSETALK_SESSION_IDLE_TIMEOUT.
+    """
+    avatar = get_avatar(avatar_id)
+    if not avatar:
+        raise HTTPException(status_code=404, detail=f"Avatar {avatar_id} not found. Preprocess it first.")
+
+    # The models stay held (not unloaded as idle) for the lifetime of the session
+    stack = ExitStack()
+    try:
+        models = stack.enter_context(model_loader.hold(INFERENCE_COMPONENTS))
+        session = session_manager.create(avatar, models, settings, batch_size=batch_size,
+                                         lip_stride=lip_stride, on_close=stack.close)
+    except RuntimeError as e:
+        stack.close()
+        raise HTTPException(status_code=429, detail=str(e))
+    except Exception as e:
+        stack.close()
+        raise HTTPException(status_code=500, detail=f"Failed to open session: {str(e)}")
+    return SessionInfo(**session.info())
+
+@router.get("/sessions", response_model=list[SessionInfo])
+def list_sessions():
+    return [SessionInfo(**session.info()) for session in session_manager.list()]
+
+@router.get("/sessions/{session_id}", response_model=SessionInfo)
+def session_info(session_id: str):
+    return SessionInfo(**get_session(session_id).info())
+
+@router.get("/sessions/{session_id}/stream")
+def stream_session(session_id: str):
+    """
+    Live MJPEG stream of the session at the configured fps: idle frames between
+    utterances, lip-synced frames while one is playing. Ends when the session closes.
+    """
+    session = get_session(session_id)
+    if session.streaming:
+        raise HTTPException(status_code=409, detail=f"Session {session_id} is already being streamed")
+
+    def iterfile():
+        try:
+            for frame_bytes in session.frames():
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+        except Exception as e:
+            print(f"Session stream error: {e}")
+
+    # Closing the generator on disconnect frees the session for the next consumer
+    return StreamingResponse(until_disconnected(iterfile(), CancelToken()), media_type="multipart/x-mixed-replace; boundary=frame")
+
+@router.post("/sessions/{session_id}/utterances", response_model=UtteranceResponse)
+def push_utterance(session_id: str, audio_file: UploadFile = File(...)):
+    """
+    Queues an utterance; it plays on the session stream after the ones before it.
+    """
+    session = get_session(session_id)
+
+    audio, _ = read_audio_upload(audio_file)
+    try:
+        utterance_id = session.push(audio)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return UtteranceResponse(session_id=session_id, utterance_id=utterance_id)
+
+@router.delete("/sessions/{session_id}", response_model=SessionInfo)
+def close_session(session_id: str):
+    session = get_session(session_id)
+    session_manager.close(session_id)
+    return SessionInfo(**session.info())
@@ -1,11 +1,22 @@
 from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from musetalk_server.conf import conf
 from musetalk_server.core.model_loader import model_loader
+from musetalk_server.core.scheduler import gpu_scheduler
 from musetalk_server.routers.avatars import avatars
-from musetalk_server.schemas.api import SystemStatus, ModelStatus
+from musetalk_server.core.metrics import metrics
+from musetalk_server.services.capacity import capacity_report
+from musetalk_server.services.jobs import job_manager
+from musetalk_server.services.session import session_manager
+from musetalk_server.services.warmup import warmup
+from musetalk_server.schemas.api import SystemStatus, ModelStatus, CapacityStatus
 import torch
 
 router = APIRouter()
 
+def is_ready() -> bool:
+    return model_loader.is_loaded() and warmup.is_done
+
 @router.get("/health", response_model=SystemStatus)
 def health_check():
     # model_loader is the instance
@@ -16,9 +27,33 @@ def health_check():
 
     return SystemStatus(
         status="running",
+        ready=models_loaded and warmup.is_done,
         models=ModelStatus(
             loaded=models_loaded,
-            device=device_name
+            device=device_name,
+            role=model_loader.role,
+            components=model_loader.loaded_components()
         ),
-        loaded_avatars=list(avatars.keys())
+        loaded_avatars=list(avatars.keys()),
+        preloading_avatars=list(warmup.pending)
     )
+
+@router.get("/health/ready")
+def readiness_check():
+    """Readiness probe for load balancers: 200 when ready, 503 while models or preloaded avatars are warming up."""
+    ready = is_ready()
+    return JSONResponse({"status": "ready" if ready else "starting"}, status_code=200 if ready else 503)
+
+@router.get("/capacity", response_model=CapacityStatus)
+def capacity():
+    """Load, real-time capacity left and avatars in memory, for load balancers and the affinity router."""
+    return capacity_report(
+        gpu_scheduler, session_manager, job_manager, avatars, model_loader.device, conf.fps,
+        capacity_fps=conf.capacity_fps, max_sessions=conf.max_sessions,
+        status="ready" if is_ready() else "starting",
+    )
+
+@router.get("/metrics")
+def get_metrics():
+    """Counters, gauges and summaries collected by this process (JSON)."""
+    return metrics.snapshot()
@@ -0,0 +1,448 @@
+"""
+Avatar-affinity routing over several server nodes. Requests for an avatar go to
+the first node on a consistent-hash ring that already has the avatar loaded and
+real-time capacity left (GET /capacity), else to the first node on the ring
+that is not saturated. Sessions and jobs stay on the node that created them:
+nodes that know their URL start their ids with its node_tag, and the router
+remembers where it forwarded the creation of the others.
+
+Standalone proxy in front of the nodes:
+
+    python -m musetalk_server.routing --nodes http://gpu-a:8000,http://gpu-b:8000 --port 8080
+
+Or inside every node (MUSETALK_ROUTE_NODES / MUSETALK_ROUTE_SELF_URL), so any
+node can take a request and forwards it when another node is the better fit.
+"""
+import re
+import time
+import json
+import bisect
+import asyncio
+import hashlib
+import argparse
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import parse_qs
+import httpx
+from musetalk_server.core.metrics import metrics
+
+# Marks forwarded requests, so the receiving node serves them instead of routing again
+ROUTED_HEADER = b"x-musetalk-routed"
+AVATAR_HEADER = b"x-avatar-id"
+
+_AVATAR_PATH = re.compile(r"^/(?:inference/(?:stream|batch)/([a-zA-Z0-9_\-]{1,64})$|avatars/([a-zA-Z0-9_\-]{1,64})/)")
+_PINNED_PATH = re.compile(r"^/(sessions|jobs)/([a-zA-Z0-9_\-]+)(?:/|$)")
+_MULTIPART_AVATAR = re.compile(rb'name="avatar_id"\r\n\r\n([a-zA-Z0-9_\-]{1,64})\r\n')
+# Form bodies are read up to the avatar_id field, at most this much; the rest is streamed on
+MAX_ROUTING_PREFIX = 64 * 1024
+
+# Not forwarded in either direction (the proxy's own connection handling)
+_HOP_HEADERS = {b"connection", b"keep-alive", b"proxy-connection", b"proxy-authorization",
+                b"te", b"trailer", b"transfer-encoding", b"upgrade"}
+_REQUEST_SKIP = _HOP_HEADERS | {b"host", b"content-length"}
+
+def _hash(key: str) -> int:
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+def node_tag(url: str) -> str:
+    """Short tag of a node URL; session and job ids created on the node start with "<tag>-"."""
+    return hashlib.md5(url.rstrip("/").encode()).hexdigest()[:8]
+
+class HashRing:
+    """
+    Consistent-hash ring with `replicas` points per node: adding or removing a
+    node only moves the avatars next to its points.
+    """
+    def __init__(self, nodes, replicas: int = 64):
+        self.nodes = list(dict.fromkeys(nodes))
+        self._points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(replicas))
+        self._keys = [point for point, _ in self._points]
+
+    def walk(self, key: str) -> list:
+        """All nodes in ring order starting at `key`'s owner."""
+        if not self._points:
+            return []
+        start = bisect.bisect(self._keys, _hash(key))
+        order = []
+        for i in range(len(self._points)):
+            node = self._points[(start + i) % len(self._points)][1]
+            if node not in order:
+                order.append(node)
+                if len(order) == len(self.nodes):
+                    break
+        return order
+
+class NodeState:
+    """Last /capacity report of a node (None before the first poll)."""
+    def __init__(self, url: str):
+        self.url = url
+        self.capacity: Optional[dict] = None
+        self.healthy = True
+        self.checked = 0.0
+
+    def hot(self, avatar_id: str) -> bool:
+        return any(a["avatar_id"] == avatar_id for a in (self.capacity or {}).get("hot_avatars", ()))
+
+    def saturated(self, min_spare_fps: float = 0) -> bool:
+        """
+        Down, not ready, or less spare fps than `min_spare_fps` (0: one stream at
+        the node's fps). A node that hasn't measured its capacity yet is not saturated.
+        """
+        if not self.healthy:
+            return True
+        capacity = self.capacity
+        if capacity is None:
+            return False
+        if capacity.get("status", "ready") != "ready":
+            return True
+        spare = capacity.get("spare_fps")
+        return spare is not None and spare < (min_spare_fps or capacity.get("fps", 25))
+
+    def assign(self, avatar_id: Optional[str], render: bool = True):
+        """
+        Books a routed request until the next poll, so a burst of requests doesn't
+        all land on the node that looked emptiest: the avatar counts as hot and,
+        for a `render`, one stream's fps is taken off the spare capacity.
+        """
+        capacity = self.capacity
+        if capacity is None:
+            return
+        if avatar_id is not None and not self.hot(avatar_id):
+            capacity.setdefault("hot_avatars", []).append({"avatar_id": avatar_id})
+        if render and capacity.get("spare_fps") is not None:
+            capacity["spare_fps"] = max(0.0, capacity["spare_fps"] - capacity.get("fps", 25))
+
+class AffinityRouter:
+    """
+    Picks the node for a request from the nodes' /capacity reports, polled every
+    `refresh_seconds`. Finds the node that created a session or job from the
+    node_tag its id starts with, or else remembers which node it forwarded the
+    creation to (up to `max_pinned` of them), since their follow-up requests
+    must go there too.
+
+    Metrics: `routing.affinity_hits` (avatar already loaded on the chosen node),
+    `routing.placements` (routed to a node without it), `routing.fallbacks`
+    (every candidate saturated) and `routing.node_errors`.
+    """
+    def __init__(self, nodes, min_spare_fps: float = 0.0, refresh_seconds: float = 2.0,
+                 timeout: float = 2.0, replicas: int = 64, max_pinned: int = 10000):
+        self.ring = HashRing([node.rstrip("/") for node in nodes], replicas)
+        self.nodes = {url: NodeState(url) for url in self.ring.nodes}
+        self.min_spare_fps = min_spare_fps
+        self.refresh_seconds = refresh_seconds
+        self.timeout = timeout
+        self.max_pinned = max_pinned
+        self.refreshed = 0.0
+        self._pinned = OrderedDict()
+        self._tags = {node_tag(url): url for url in self.nodes}
+
+    def update(self, url: str, capacity: Optional[dict]):
+        """Records a node's /capacity report (None: the node could not be reached)."""
+        node = self.nodes[url]
+        node.healthy = capacity is not None
+        if capacity is not None:
+            node.capacity = capacity
+        node.checked = time.monotonic()
+
+    async def refresh(self, client: httpx.AsyncClient):
+        async def poll(url):
+            try:
+                response = await client.get(f"{url}/capacity", headers={ROUTED_HEADER.decode(): "1"},
+                                            timeout=self.timeout)
+                response.raise_for_status()
+                self.update(url, response.json())
+            except (httpx.HTTPError, ValueError):
+                metrics.inc("routing.node_errors")
+                self.update(url, None)
+
+        await asyncio.gather(*(poll(url) for url in self.nodes))
+        self.refreshed = time.monotonic()
+
+    def choose(self, avatar_id: Optional[str] = None, render: bool = True) -> str:
+        """
+        The node for a request about `avatar_id`: the first node in ring order
+        with the avatar loaded and capacity left, else the first with capacity
+        left. Without an avatar, the node with the most spare capacity.
+        If every node is saturated, the first healthy node in ring order.
+        `render`: the request starts a render (books capacity, see NodeState.assign).
+        """
+        if avatar_id is None:
+            order = sorted(self.nodes, key=lambda url: -self._spare(url))
+        else:
+            order = self.ring.walk(avatar_id)
+            for url in order:
+                node = self.nodes[url]
+                if node.hot(avatar_id) and not node.saturated(self.min_spare_fps):
+                    metrics.inc("routing.affinity_hits")
+                    node.assign(avatar_id, render)
+                    return url
+        for url in order:
+            node = self.nodes[url]
+            if not node.saturated(self.min_spare_fps):
+                if avatar_id is not None:
+                    metrics.inc("routing.placements")
+                node.assign(avatar_id, render)
+                return url
+        metrics.inc("routing.fallbacks")
+        healthy = [url for url in order if self.nodes[url].healthy]
+        return (healthy or order)[0]
+
+    def _spare(self, url: str) -> float:
+        node = self.nodes[url]
+        if not node.healthy:
+            return float("-inf")
+        spare = (node.capacity or {}).get("spare_fps")
+        return float("inf") if spare is None else spare
+
+    def pin(self, kind: str, item_id: str, url: str):
+        self._pinned[(kind, item_id)] = url
+        self._pinned.move_to_end((kind, item_id))
+        while len(self._pinned) > self.max_pinned:
+            self._pinned.popitem(last=False)
+
+    def pinned(self, kind: str, item_id: str) -> Optional[str]:
+        return self._pinned.get((kind, item_id)) or self._tags.get(item_id.split("-", 1)[0])
+
+    def status(self) -> dict:
+        return {url: {"healthy": node.healthy, "capacity": node.capacity} for url, node in self.nodes.items()}
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope["headers"]:
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+def routing_key(scope, body: bytes = b"") -> tuple:
+    """
+    (kind, id) a request is routed by: ("avatar", avatar_id) from the
+    X-Avatar-Id header, the path, an `avatar_id` query parameter or form field
+    (in `body`, which may be the start of the body only);
+    ("sessions" / "jobs", id) for requests about an existing session or job;
+    (None, None) for requests about neither.
+    """
+    avatar_id = _header(scope, AVATAR_HEADER)
+    if avatar_id:
+        return "avatar", avatar_id
+    path = scope["path"]
+    match = _AVATAR_PATH.match(path)
+    if match:
+        return "avatar", match.group(1) or match.group(2)
+    match = _PINNED_PATH.match(path)
+    if match:
+        return match.group(1), match.group(2)
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if query.get("avatar_id"):
+        return "avatar", query["avatar_id"][0]
+    content_type = _header(scope, b"content-type") or ""
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        form = parse_qs(body.decode("latin-1"))
+        if form.get("avatar_id"):
+            return "avatar", form["avatar_id"][0]
+    elif content_type.startswith("multipart/form-data"):
+        match = _MULTIPART_AVATAR.search(body)
+        if match:
+            return "avatar", match.group(1).decode()
+    return None, None
+
+class _ClientGone(Exception):
+    """The client disconnected before its request body was complete."""
+
+def _is_form(scope) -> bool:
+    content_type = _header(scope, b"content-type") or ""
+    return content_type.startswith(("application/x-www-form-urlencoded", "multipart/form-data"))
+
+async def _read_start(scope, receive, scan: bool) -> tuple:
+    """
+    Reads the first chunk of the body (most bodies end there). With `scan` (a form
+    post with no other routing key), reads on until routing_key finds its avatar_id
+    field, the body ends or MAX_ROUTING_PREFIX bytes were read.
+    Returns (kind, id, body read so far, more_body).
+    """
+    urlencoded = (_header(scope, b"content-type") or "").startswith("application/x-www-form-urlencoded")
+    prefix = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise _ClientGone()
+        prefix += message.get("body", b"")
+        more_body = message.get("more_body", False)
+        # A urlencoded value may continue in the next chunk: scan complete fields only
+        scanned = prefix[:prefix.rfind(b"&") + 1] if urlencoded and more_body else prefix
+        kind, key = routing_key(scope, scanned) if scan else (None, None)
+        if not scan or kind is not None or not more_body or len(prefix) >= MAX_ROUTING_PREFIX:
+            return kind, key, prefix, more_body
+
+async def _stream_body(prefix: bytes, receive):
+    """The request body for forwarding: the part already read, then the client's remaining chunks."""
+    if prefix:
+        yield prefix
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise _ClientGone()
+        if message.get("body"):
+            yield message["body"]
+        if not message.get("more_body", False):
+            return
+
+async def _send_error(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+class AffinityMiddleware:
+    """
+    ASGI middleware forwarding each request to the node `router` picks. With
+    `self_url` (this node's URL among the router's nodes), the wrapped app serves
+    requests routed here, requests another node forwarded, requests about no
+    avatar and sessions or jobs created here (or not traceable to another node). Without it
+    (standalone proxy) it serves only `local_paths`. Request and response bodies
+    are streamed; a form post with no other routing key is read up to its
+    avatar_id field first (see MAX_ROUTING_PREFIX).
+    """
+    def __init__(self, app, router: AffinityRouter, self_url: str = "", local_paths=(), transport=None):
+        self.app = app
+        self.router = router
+        self.self_url = self_url.rstrip("/")
+        self.local_paths = set(local_paths)
+        self._transport = transport
+        self._client = None
+        self._refreshing = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(transport=self._transport, timeout=httpx.Timeout(None, connect=5.0))
+        return self._client
+
+    async def _ensure_fresh(self):
+        if time.monotonic() - self.router.refreshed < self.router.refresh_seconds:
+            return
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self.router.refresh(self._http()))
+        if not self.router.refreshed:
+            # No reports yet: wait for the first poll instead of routing blind
+            await self._refreshing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.local_paths or _header(scope, ROUTED_HEADER):
+            return await self.app(scope, receive, send)
+
+        kind, key = routing_key(scope)
+        scan = kind is None and _is_form(scope)
+        try:
+            form_kind, form_key, body, more_body = await _read_start(scope, receive, scan)
+        except _ClientGone:
+            return
+        if scan:
+            kind, key = form_kind, form_key
+        node = None
+        if kind in ("sessions", "jobs"):
+            node = self.router.pinned(kind, key)
+        # Inside a node, sessions and jobs with no known owner are its own
+        if node is None and (kind == "avatar" or not self.self_url):
+            await self._ensure_fresh()
+            render = scope["path"].startswith("/inference/") or \
+                (scope["method"] == "POST" and scope["path"] == "/sessions")
+            node = self.router.choose(key if kind == "avatar" else None, render)
+        if node is None or node == self.self_url:
+            return await self.app(scope, _replay(body, more_body, receive), send)
+        await self.forward(node, scope, body, more_body, receive, send)
+
+    async def forward(self, node: str, scope, body: bytes, more_body: bool, receive, send):
+        """Forwards the request; `body` is the part of it already read, `more_body` whether the client has more."""
+        url = node + scope.get("raw_path", scope["path"].encode()).decode("latin-1")
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode("latin-1")
+        headers = [(k, v) for k, v in scope["headers"] if k.lower() not in _REQUEST_SKIP]
+        content = body
+        if more_body:
+            # Streamed on as it arrives; the client's Content-Length (if any) still holds
+            content = _stream_body(body, receive)
+            headers += [(k, v) for k, v in scope["headers"] if k.lower() == b"content-length"]
+        headers.append((ROUTED_HEADER, b"1"))
+        client = self._http()
+        try:
+            response = await client.send(client.build_request(scope["method"], url, headers=headers, content=content),
+                                         stream=True)
+        except _ClientGone:
+            return
+        except httpx.HTTPError as e:
+            metrics.inc("routing.node_errors")
+            self.router.update(node, None)
+            return await _send_error(send, 502, f"Node {node} unavailable: {e}")
+
+        # New sessions and jobs live on this node from now on
+        creates = scope["method"] == "POST" and scope["path"] in ("/sessions", "/jobs")
+        try:
+            await send({"type": "http.response.start", "status": response.status_code,
+                        "headers": [(k, v) for k, v in response.headers.raw if k.lower() not in _HOP_HEADERS]})
+            if creates:
+                data = await response.aread()
+                if response.status_code == 200:
+                    item_id = json.loads(data).get("session_id" if scope["path"] == "/sessions" else "job_id")
+                    if item_id:
+                        self.router.pin(scope["path"].strip("/"), item_id, node)
+                await send({"type": "http.response.body", "body": data})
+                return
+
+            async def relay():
+                async for chunk in response.aiter_raw():
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b""})
+
+            async def disconnected():
+                while (await receive())["type"] != "http.disconnect":
+                    pass
+
+            # Endless streams (MJPEG, sessions) end when the client goes away
+            tasks = [asyncio.ensure_future(relay()), asyncio.ensure_future(disconnected())]
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                task.result()
+        finally:
+            await response.aclose()
+
+def _replay(body: bytes, more_body: bool, receive):
+    """An ASGI receive that delivers the part of the body already read first, then the client's events."""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": more_body}
+        return await receive()
+    return replay
+
+def create_proxy_app(router: AffinityRouter, transport=None):
+    """Standalone proxy: every request is forwarded, except GET /routing (the node reports)."""
+    async def status_app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = json.dumps({"nodes": router.status(), "metrics": metrics.snapshot()}).encode()
+        await send({"type": "http.response.start", "status": 200,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    return AffinityMiddleware(status_app, router, local_paths=("/routing",), transport=transport)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m musetalk_server.routing")
+    parser.add_argument("--nodes", required=True, help="Comma-separated node URLs, e.g. http://gpu-a:8000")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--min-spare-fps", type=float, default=0.0,
+                        help="Spare fps below which a node counts as saturated (0 = one stream at its fps)")
+    parser.add_argument("--refresh-seconds", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    router = AffinityRouter([n.strip() for n in args.nodes.split(",") if n.strip()],
+                            min_spare_fps=args.min_spare_fps, refresh_seconds=args.refresh_seconds)
+    uvicorn.run(create_proxy_app(router), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
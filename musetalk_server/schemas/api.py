@@ -1,14 +1,39 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 class ModelStatus(BaseModel):
     loaded: bool
     device: str
+    role: str
+    components: List[str]
 
 class SystemStatus(BaseModel):
     status: str
+    ready: bool = False  # The role's models and preloaded avatars are warm (see /health/ready)
     models: ModelStatus
     loaded_avatars: List[str]
+    preloading_avatars: List[str] = []
+
+class HotAvatar(BaseModel):
+    avatar_id: str
+    memory_mb: float  # Host memory of the loaded frames, masks, latents and cached encodings
+    pinned: bool  # Held by an open session
+
+class CapacityStatus(BaseModel):
+    status: str  # Same as /health
+    fps: int  # Output frame rate of real-time renders
+    active_streams: int  # Real-time renders in progress (streams and speaking sessions)
+    open_sessions: int
+    max_sessions: int  # 0 = unlimited
+    renders: Dict[str, int]  # Renders in progress per priority class
+    queue_depth: int  # Batches waiting for the device plus queued bulk jobs
+    capacity_fps: Optional[float] = None  # Frames per second the device renders (None until measured)
+    spare_fps: Optional[float] = None  # capacity_fps not needed by real-time renders
+    device_memory_free_mb: Optional[float] = None  # None without a GPU
+    device_memory_total_mb: Optional[float] = None
+    host_memory_free_mb: float
+    host_memory_total_mb: float
+    hot_avatars: List[HotAvatar]
 
 class AvatarInfo(BaseModel):
     avatar_id: str
@@ -20,3 +45,52 @@ class PreprocessResponse(BaseModel):
     message: str
     avatar_id: str
     info: AvatarInfo
+    linked_from: Optional[str] = None  # Avatar whose identical build was reused
+
+class SessionInfo(BaseModel):
+    session_id: str
+    avatar_id: str
+    cycle_position: int
+    pending_frames: int
+    utterances_pushed: int
+    utterances_done: int
+    streaming: bool
+    closed: bool
+
+class UtteranceResponse(BaseModel):
+    session_id: str
+    utterance_id: int
+
+class JobManifestItem(BaseModel):
+    avatar_id: str
+    audio: str  # Name of a file uploaded with the job, or a path under MUSETALK_JOB_PATHS_ROOT
+    output_name: Optional[str] = None  # File name in the output directory (default: {index}_{avatar_id}.mp4)
+
+class JobManifest(BaseModel):
+    items: List[JobManifestItem]
+    output_dir: Optional[str] = None  # Directory under MUSETALK_JOB_PATHS_ROOT (default: the job's outputs/)
+    batch_size: Optional[int] = None
+    lip_stride: Optional[int] = None
+
+class JobItemInfo(BaseModel):
+    index: int
+    avatar_id: str
+    audio: str
+    output_path: str
+    status: str  # pending / done / failed
+    frames_done: int = 0
+    frames_total: int = 0
+    error: Optional[str] = None
+
+class JobInfo(BaseModel):
+    job_id: str
+    status: str  # queued / running / completed / cancelled / failed
+    created: float
+    error: Optional[str] = None
+    output_dir: str
+    batch_size: Optional[int] = None
+    lip_stride: Optional[int] = None
+    items_total: int
+    items_done: int
+    items_failed: int
+    items: List[JobItemInfo]
@@ -0,0 +1,223 @@
+import io
+import math
+import os
+import subprocess
+import tempfile
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+from typing import Iterator
+
+SAMPLE_RATE = 16000
+# Whisper encoder positions per second of audio
+AUDIO_FPS = 50
+# Whisper's context window. Upstream AudioProcessor encodes each 30 s segment
+# independently, so windows aligned to this grid reproduce its features exactly.
+SEGMENT_SECONDS = 30
+
+# Output format of the ffmpeg fallback decoder
+FALLBACK_SAMPLE_RATE = 48000
+FALLBACK_CHANNELS = 2
+
+class AudioDecodeError(ValueError):
+    pass
+
+class AudioClip:
+    """
+    Decoded audio held in memory: float32 PCM of shape (samples, channels) at its
+    native rate. `whisper_input()` is the 16 kHz mono signal the features are
+    computed from; `pcm_bytes()` / `ffmpeg_input_args()` feed the same audio to
+    ffmpeg when muxing, so no request needs a temporary audio file.
+    """
+    def __init__(self, pcm: np.ndarray, sample_rate: int):
+        if pcm.ndim == 1:
+            pcm = pcm[:, None]
+        self.pcm = np.ascontiguousarray(pcm, dtype=np.float32)
+        self.sample_rate = int(sample_rate)
+        self._whisper_input = None
+
+    @property
+    def channels(self) -> int:
+        return self.pcm.shape[1]
+
+    @property
+    def duration(self) -> float:
+        return self.pcm.shape[0] / self.sample_rate
+
+    def whisper_input(self) -> np.ndarray:
+        """
+        16 kHz mono float PCM, computed like librosa.load(path, sr=16000) (channel
+        mean, then soxr_hq resampling) so features match the upstream file path.
+        """
+        if self._whisper_input is None:
+            audio = librosa.to_mono(self.pcm.T)
+            if self.sample_rate != SAMPLE_RATE:
+                audio = librosa.resample(audio, orig_sr=self.sample_rate, target_sr=SAMPLE_RATE, res_type="soxr_hq")
+            self._whisper_input = np.ascontiguousarray(audio, dtype=np.float32)
+        return self._whisper_input
+
+    def ffmpeg_input_args(self) -> list:
+        return ["-f", "f32le", "-ar", str(self.sample_rate), "-ac", str(self.channels)]
+
+    def pcm_bytes(self) -> bytes:
+        return self.pcm.tobytes()
+
+def decode_audio(data: bytes, ffmpeg_path: str = "ffmpeg") -> AudioClip:
+    """
+    Decodes an uploaded audio file from memory. Formats libsndfile reads (WAV,
+    FLAC, OGG, MP3 with libsndfile >= 1.1) are decoded in process like librosa
+    does; anything else goes through an ffmpeg pipe. Containers ffmpeg can't
+    read from a pipe (e.g. MP4 with the index at the end) are spilled to the
+    system temp directory for that one call.
+    """
+    try:
+        pcm, sample_rate = sf.read(io.BytesIO(data), dtype="float32", always_2d=True)
+        return AudioClip(pcm, sample_rate)
+    except RuntimeError:
+        # soundfile.LibsndfileError: format not supported by libsndfile
+        pass
+
+    cmd = [ffmpeg_path, "-v", "error", "-i", "{input}", "-f", "f32le",
+           "-ac", str(FALLBACK_CHANNELS), "-ar", str(FALLBACK_SAMPLE_RATE), "pipe:1"]
+
+    def run(input_arg, stdin_data):
+        args = [input_arg if a == "{input}" else a for a in cmd]
+        return subprocess.run(args, input=stdin_data, capture_output=True)
+
+    proc = run("pipe:0", data)
+    if proc.returncode != 0 or not proc.stdout:
+        with tempfile.NamedTemporaryFile(suffix=".audio", delete=False) as f:
+            f.write(data)
+        try:
+            proc = run(f.name, None)
+        finally:
+            os.remove(f.name)
+    if proc.returncode != 0 or not proc.stdout:
+        raise AudioDecodeError(f"Could not decode audio: {proc.stderr.decode(errors='replace').strip()[-200:]}")
+    pcm = np.frombuffer(proc.stdout, dtype=np.float32).reshape(-1, FALLBACK_CHANNELS)
+    return AudioClip(pcm, FALLBACK_SAMPLE_RATE)
+
+class WhisperChunkStream:
+    """
+    Incremental equivalent of AudioProcessor.get_audio_feature + get_whisper_chunk.
+
+    Audio is encoded one Whisper window at a time and per-frame prompts are
+    yielded as soon as their feature context is complete. A frame's context
+    spans `audio_padding_left` frames before and `audio_padding_right` after it,
+    so frames near a window boundary are held back until the next window is
+    encoded; the overlap is covered by keeping the tail of the previous window.
+    The prompts are identical to the one-shot path, but the first ones are
+    ready after a single window instead of a pass over the whole clip.
+    """
+    def __init__(
+        self,
+        audio_processor,
+        whisper,
+        audio: np.ndarray,
+        device: torch.device,
+        weight_dtype: torch.dtype,
+        fps: int = 25,
+        audio_padding_left: int = 2,
+        audio_padding_right: int = 2,
+    ):
+        self.audio_processor = audio_processor
+        self.whisper = whisper
+        self.audio = audio
+        self.device = device
+        self.weight_dtype = weight_dtype
+        self.fps = int(fps)
+        self.audio_padding_left = audio_padding_left
+        self.audio_padding_right = audio_padding_right
+
+        self.num_frames = math.floor((len(audio) / SAMPLE_RATE) * self.fps)
+        self.windows_encoded = 0
+
+    def __len__(self) -> int:
+        return self.num_frames
+
+    @torch.no_grad()
+    def _encode(self, segment: np.ndarray) -> torch.Tensor:
+        input_feature = self.audio_processor.feature_extractor(
+            segment,
+            return_tensors="pt",
+            sampling_rate=SAMPLE_RATE
+        ).input_features
+        input_feature = input_feature.to(self.device).to(self.weight_dtype)
+        audio_feats = self.whisper.encoder(input_feature, output_hidden_states=True).hidden_states
+        self.windows_encoded += 1
+        return torch.stack(audio_feats, dim=2)
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        """
+        Yields (n, 50, 384) tensors of consecutive per-frame whisper prompts.
+        """
+        feature_length_per_frame = 2 * (self.audio_padding_left + self.audio_padding_right + 1)
+        whisper_idx_multiplier = AUDIO_FPS / self.fps
+        padding_nums = math.ceil(whisper_idx_multiplier)
+        actual_length = math.floor((len(self.audio) / SAMPLE_RATE) * AUDIO_FPS)
+        segment_length = SEGMENT_SECONDS * SAMPLE_RATE
+
+        buffer = None       # padded feature positions [buffer_start, buffer_start + buffer.shape[1])
+        buffer_start = 0
+        real_positions = 0  # real (unpadded) feature positions appended so far
+        frame_index = 0
+
+        segment_starts = list(range(0, len(self.audio), segment_length))
+        for n, seg_start in enumerate(segment_starts):
+            is_last = n == len(segment_starts) - 1
+            feats = self._encode(self.audio[seg_start:seg_start + segment_length])
+            # Trim the padding Whisper adds to the last (short) window
+            feats = feats[:, :max(0, actual_length - real_positions)]
+            real_positions += feats.shape[1]
+
+            parts = [feats]
+            if buffer is None:
+                buffer = feats[:, :0]
+                parts.insert(0, torch.zeros_like(feats[:, :1]).repeat(1, padding_nums * self.audio_padding_left, 1, 1))
+            if is_last:
+                parts.append(torch.zeros_like(feats[:, :1]).repeat(1, padding_nums * 3 * self.audio_padding_right, 1, 1))
+            buffer = torch.cat([buffer] + parts, dim=1)
+
+            prompts = []
+            while frame_index < self.num_frames:
+                audio_index = math.floor(frame_index * whisper_idx_multiplier)
+                end = audio_index + feature_length_per_frame
+                if end > buffer_start + buffer.shape[1]:
+                    break
+                prompts.append(buffer[:, audio_index - buffer_start:end - buffer_start])
+                frame_index += 1
+
+            if prompts:
+                prompts = torch.cat(prompts, dim=0)
+                yield prompts.reshape(prompts.shape[0], -1, prompts.shape[-1])
+
+            # Drop positions no later frame can reach
+            if frame_index < self.num_frames:
+                keep_from = math.floor(frame_index * whisper_idx_multiplier) - buffer_start
+                buffer = buffer[:, keep_from:]
+                buffer_start += keep_from
+
+        if frame_index < self.num_frames:
+            print(f"Audio features ran out at frame {frame_index}/{self.num_frames}")
+            self.num_frames = frame_index
+
+def iter_batches(chunks: Iterator[torch.Tensor], batch_size: int) -> Iterator[torch.Tensor]:
+    """
+    Regroups variable-sized prompt chunks into batches of `batch_size` frames (last one may be short).
+    """
+    pending = []
+    pending_len = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_len += chunk.shape[0]
+        if pending_len < batch_size:
+            continue
+        merged = torch.cat(pending, dim=0) if len(pending) > 1 else pending[0]
+        full = (merged.shape[0] // batch_size) * batch_size
+        for start in range(0, full, batch_size):
+            yield merged[start:start + batch_size]
+        pending = [merged[full:]] if full < merged.shape[0] else []
+        pending_len = merged.shape[0] - full
+    if pending_len:
+        yield torch.cat(pending, dim=0)
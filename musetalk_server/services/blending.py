@@ -0,0 +1,120 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from typing import List, NamedTuple, Tuple
+from musetalk_server.core.buffers import BufferSet
+
+BLEND_BACKENDS = ("cv2", "torch")
+
+# cv2.COLOR_BGR2GRAY weights
+_GRAY_WEIGHTS = (0.114, 0.587, 0.299)
+
+class BlendedRegion(NamedTuple):
+    """
+    A finished mask crop region (`box` = x1, y1, x2, y2 in the frame): the only
+    part of the cycle frame blending changes. Produced by TensorBlender.
+    """
+    box: Tuple[int, int, int, int]
+    pixels: np.ndarray
+
+class TensorBlender:
+    """
+    Batched blend backend: resizes a whole batch of decoded face crops to their
+    boxes and composites them with the masks as tensor ops on `device` (the
+    inference GPU, or batched CPU ops on CPU-only hosts). Only the blended crop
+    regions go back to the host, so the blend thread is left with a paste and
+    the JPEG encode.
+
+    Resizing samples like cv2.resize(INTER_LINEAR) and compositing follows
+    get_image_blending, so results match the cv2 backend to within rounding.
+    """
+    def __init__(self, device: torch.device):
+        self.device = torch.device(device)
+        self._region_sizes = {}
+
+    def _region_size(self, avatar) -> Tuple[int, int]:
+        # Batches are padded to the largest crop box of the cycle, so pooled buffers keep one shape
+        key = (avatar.avatar_id, avatar.content_version)
+        size = self._region_sizes.get(key)
+        if size is None:
+            boxes = avatar.mask_coords_list_cycle
+            size = self._region_sizes[key] = (max(int(y2) - int(y1) for _, y1, _, y2 in boxes),
+                                              max(int(x2) - int(x1) for x1, _, x2, _ in boxes))
+        return size
+
+    @torch.no_grad()
+    def blend(self, avatar, crops, frame_indices, buffers: BufferSet | None = None) -> List[BlendedRegion]:
+        """
+        Blends `crops` ((n, h, w, 3) uint8 BGR, tensor or array) into cycle frames
+        `frame_indices` (taken modulo the cycle length).
+        """
+        buffers = buffers if buffers is not None else BufferSet()
+        cycle_len = len(avatar.coord_list_cycle)
+        cycle = [i % cycle_len for i in frame_indices]
+        crop_boxes = [tuple(int(v) for v in avatar.mask_coords_list_cycle[c]) for c in cycle]
+        height, width = self._region_size(avatar)
+        n = len(cycle)
+
+        # Frame regions and masks, padded to the cycle's largest crop box, in one upload each
+        base = buffers.array("blend_base", (n, height, width, 3), np.uint8)
+        masks = buffers.array("blend_mask", (n, height, width, 3), np.uint8)
+        for i, c in enumerate(cycle):
+            x1, y1, x2, y2 = crop_boxes[i]
+            base[i, :y2 - y1, :x2 - x1] = avatar.frame_list_cycle[c][y1:y2, x1:x2]
+            masks[i, :y2 - y1, :x2 - x1] = avatar.mask_list_cycle[c][:y2 - y1, :x2 - x1]
+        base_t = torch.from_numpy(base).to(self.device, non_blocking=True).permute(0, 3, 1, 2).float()
+        mask_t = torch.from_numpy(masks).to(self.device, non_blocking=True).float()
+        gray = torch.tensor(_GRAY_WEIGHTS, device=self.device)
+        mask_t = ((mask_t * gray).sum(-1).round() / 255).unsqueeze(1)
+
+        if not isinstance(crops, torch.Tensor):
+            crops = torch.from_numpy(np.ascontiguousarray(crops))
+        faces = crops.to(self.device, non_blocking=True).permute(0, 3, 1, 2).float()
+
+        # Face boxes relative to each crop box
+        rel = torch.tensor(
+            [[bx1 - x1, by1 - y1, bx2 - x1, by2 - y1]
+             for (x1, y1, _, _), (bx1, by1, bx2, by2) in zip(crop_boxes, (avatar.coord_list_cycle[c] for c in cycle))],
+            dtype=torch.float32, device=self.device,
+        )[:, :, None, None]
+        u = torch.arange(width, dtype=torch.float32, device=self.device)[None, None, :]
+        v = torch.arange(height, dtype=torch.float32, device=self.device)[None, :, None]
+        bx1, by1, bx2, by2 = rel[:, 0], rel[:, 1], rel[:, 2], rel[:, 3]
+        # Pixel-center mapping of the resize (align_corners=False), as cv2 does
+        gx = (2 * (u - bx1 + 0.5) / (bx2 - bx1) - 1).expand(n, height, width)
+        gy = (2 * (v - by1 + 0.5) / (by2 - by1) - 1).expand(n, height, width)
+        resized = F.grid_sample(faces, torch.stack([gx, gy], dim=-1), mode="bilinear",
+                                padding_mode="border", align_corners=False)
+        inside = ((u >= bx1) & (u < bx2) & (v >= by1) & (v < by2)).unsqueeze(1)
+
+        face_large = torch.where(inside, resized.round(), base_t)
+        blended = face_large * mask_t + base_t * (1 - mask_t)
+        out = blended.round().clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+
+        return [
+            BlendedRegion(box, out[i, :box[3] - box[1], :box[2] - box[0]])
+            for i, box in enumerate(crop_boxes)
+        ]
+
+def make_blender(backend: str, device: torch.device) -> TensorBlender | None:
+    """
+    The blender for MUSETALK_BLEND_BACKEND; None means per-frame cv2 blending.
+    """
+    if backend not in BLEND_BACKENDS:
+        raise ValueError(f"Unknown blend backend '{backend}'; expected one of {BLEND_BACKENDS}")
+    return TensorBlender(device) if backend == "torch" else None
+
+def paste_region(avatar, region: BlendedRegion, cycle_idx: int, buffers: BufferSet | None = None) -> np.ndarray:
+    """
+    Full composited frame: cycle frame `cycle_idx` with the blended region pasted
+    in (into a pooled frame buffer with `buffers`, see blend_frame).
+    """
+    frame = avatar.frame_list_cycle[cycle_idx % len(avatar.frame_list_cycle)]
+    if buffers is None:
+        out = frame.copy()
+    else:
+        out = buffers.array("frame", frame.shape, frame.dtype)
+        np.copyto(out, frame)
+    x1, y1, x2, y2 = region.box
+    out[y1:y2, x1:x2] = region.pixels
+    return out
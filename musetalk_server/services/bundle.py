@@ -0,0 +1,50 @@
+import os
+import glob
+import json
+import zipfile
+
+def frame_name(cycle_idx: int) -> str:
+    return f"frames/{cycle_idx:08d}.jpg"
+
+def bundle_manifest(avatar, fps: int) -> dict:
+    """
+    Describes the avatar cycle for client-side compositing: base frame names,
+    face boxes (`coords`) and the patch boxes patch-mode streams are drawn at.
+    """
+    height, width = avatar.frame_list_cycle[0].shape[:2]
+    return {
+        "avatar_id": avatar.avatar_id,
+        "content_version": avatar.content_version,
+        "fps": fps,
+        "width": int(width),
+        "height": int(height),
+        "cycle_len": len(avatar.frame_list_cycle),
+        "frames": [frame_name(i) for i in range(len(avatar.frame_list_cycle))],
+        "coords": [[int(v) for v in box] for box in avatar.coord_list_cycle],
+        "patch_boxes": [[int(v) for v in box] for box in avatar.mask_coords_list_cycle],
+    }
+
+def bundle_path(avatar) -> str:
+    return os.path.join(avatar.avatar_path, f"bundle_{avatar.content_version}.zip")
+
+def build_bundle(avatar, fps: int) -> str:
+    """
+    Writes the cycle bundle (manifest.json + pre-encoded JPEG base frames) once per
+    avatar content version and returns its path. Bundles of older versions are removed.
+    """
+    path = bundle_path(avatar)
+    if os.path.exists(path):
+        return path
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    # JPEGs don't compress further; store them
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED) as bundle:
+        bundle.writestr("manifest.json", json.dumps(bundle_manifest(avatar, fps)))
+        for i in range(len(avatar.frame_list_cycle)):
+            bundle.writestr(frame_name(i), avatar.encoded_frame(i))
+    os.replace(tmp_path, path)
+
+    for stale in glob.glob(os.path.join(avatar.avatar_path, "bundle_*.zip")):
+        if stale != path:
+            os.remove(stale)
+    return path
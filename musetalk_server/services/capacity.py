@@ -0,0 +1,60 @@
+import os
+import torch
+
+MB = 1024 * 1024
+
+def host_memory() -> tuple:
+    """(available, total) host memory in bytes."""
+    try:
+        with open("/proc/meminfo") as f:
+            info = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f if line.split()}
+        return info.get("MemAvailable", info.get("MemFree", 0)), info.get("MemTotal", 0)
+    except (OSError, ValueError, IndexError):
+        page = os.sysconf("SC_PAGE_SIZE")
+        return os.sysconf("SC_AVPHYS_PAGES") * page, os.sysconf("SC_PHYS_PAGES") * page
+
+def device_memory(device: torch.device) -> tuple:
+    """(free, total) memory of a CUDA device in bytes, (None, None) for other devices."""
+    if device.type != "cuda":
+        return None, None
+    return torch.cuda.mem_get_info(device)
+
+def _mb(nbytes):
+    return None if nbytes is None else round(nbytes / MB, 1)
+
+def capacity_report(scheduler, sessions, jobs, avatars: dict, device: torch.device, fps: int,
+                    capacity_fps: float = 0, max_sessions: int = 0, status: str = "ready") -> dict:
+    """
+    What a load balancer needs to place the next request: current load, the
+    real-time capacity left and which avatars are already in memory.
+
+    `capacity_fps` (frames per second the device renders) defaults to the
+    scheduler's measurement; spare fps is that minus the frame rate real-time
+    renders (streams, speaking sessions) need. Batch and bulk renders yield to
+    them, so they don't reduce it.
+    """
+    load = scheduler.load()
+    capacity = capacity_fps or load["throughput_fps"]
+    spare = None if capacity is None else max(0.0, capacity - load["realtime_fps"])
+    device_free, device_total = device_memory(device)
+    host_free, host_total = host_memory()
+    hot = sorted(list(avatars.values()), key=lambda a: a.avatar_id)
+    return {
+        "status": status,
+        "fps": fps,
+        "active_streams": load["realtime_renders"],
+        "open_sessions": len(sessions.list()),
+        "max_sessions": max_sessions,
+        "renders": load["renders"],
+        "queue_depth": load["waiting"] + jobs.pending(),
+        "capacity_fps": None if capacity is None else round(capacity, 1),
+        "spare_fps": None if spare is None else round(spare, 1),
+        "device_memory_free_mb": _mb(device_free),
+        "device_memory_total_mb": _mb(device_total),
+        "host_memory_free_mb": _mb(host_free),
+        "host_memory_total_mb": _mb(host_total),
+        "hot_avatars": [
+            {"avatar_id": a.avatar_id, "memory_mb": _mb(a.memory_bytes), "pinned": a.is_pinned}
+            for a in hot if a.is_loaded
+        ],
+    }
@@ -1,37 +1,81 @@
 import queue
 import threading
 import time
-import copy
 import cv2
 import torch
 import numpy as np
 import os
 import subprocess
 import shutil
-import gc
-from typing import Generator
-from musetalk.utils.utils import datagen
+import tempfile
+from typing import Generator, Iterator, NamedTuple, Tuple
 from musetalk.utils.blending import get_image_blending
+from musetalk_server.core.buffers import BufferSet, buffer_pool, memory_policy
+from musetalk_server.core.engine import EagerEngine
+from musetalk_server.core.metrics import metrics
+from musetalk_server.core.scheduler import Ticket, gpu_scheduler
+from musetalk_server.services.audio import AudioClip, WhisperChunkStream, iter_batches
+from musetalk_server.services.blending import BlendedRegion, make_blender, paste_region
 
 class InferenceModels:
     """
     Container for the loaded models required for inference.
+    The per-batch PE -> UNet -> VAE decode path runs through `engine`
+    (see musetalk_server.core.engine); the eager modules stay available.
     """
-    def __init__(self, vae, unet, pe, audio_processor, whisper, timesteps):
+    def __init__(self, vae, unet, pe, audio_processor, whisper, timesteps, engine=None):
         self.vae = vae
         self.unet = unet
         self.pe = pe
         self.audio_processor = audio_processor
         self.whisper = whisper
         self.timesteps = timesteps
+        self.engine = engine if engine is not None else EagerEngine(pe, unet, vae, timesteps)
+
+class FramePatch(NamedTuple):
+    """
+    Patch stream item: the blended region of one frame, to be drawn at `box`
+    (x1, y1, x2, y2) over base frame `cycle_index` of the avatar bundle.
+    """
+    frame_index: int
+    cycle_index: int
+    box: Tuple[int, int, int, int]
+    jpeg: bytes
+
+class InferenceCancelled(RuntimeError):
+    pass
+
+class CancelToken:
+    """
+    Cooperative cancellation of one render. Set by the router when the client
+    disconnects, or expires by itself `timeout` seconds after creation (0 = never).
+    Workers check it at batch boundaries and whenever they wait on a queue.
+    """
+    def __init__(self, timeout: float = 0):
+        self._event = threading.Event()
+        self.reason: str | None = None
+        self.deadline = time.monotonic() + timeout if timeout > 0 else None
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("timeout")
+        return self._event.is_set()
 
 class InferenceService:
-    def __init__(self, models: dict, settings, batch_size_override: int | None = None):
+    def __init__(self, models: dict, settings, batch_size_override: int | None = None,
+                 lip_stride_override: int | None = None):
         """
         Args:
             models: Dict containing loaded models from ModelLoader
             settings: Configuration object
             batch_size_override: Optional per-request batch size (falls back to settings.batch_size)
+            lip_stride_override: Optional per-request lip stride (falls back to settings.lip_stride)
         """
         self.models = InferenceModels(
             vae=models['vae'],
@@ -39,59 +83,108 @@ class InferenceService:
             pe=models['pe'],
             audio_processor=models['audio_processor'],
             whisper=models['whisper'],
-            timesteps=models['timesteps']
+            timesteps=models['timesteps'],
+            engine=models.get('engine')
         )
         self.device = models['device'] if 'device' in models else torch.device('cuda')
+        self.precision = models.get('precision')
         self.settings = settings
         self.batch_size = batch_size_override if batch_size_override is not None else settings.batch_size
+        self.lip_stride = lip_stride_override if lip_stride_override is not None else settings.lip_stride
 
-    def inference_stream(self, avatar, audio_path: str) -> Generator[bytes, None, None]:
+    def inference_stream(self, avatar, audio: AudioClip, patch_mode: bool = False,
+                         cancel: CancelToken | None = None,
+                         priority: str = "interactive") -> Generator[bytes, None, None]:
         return inference_stream(
             avatar=avatar,
-            audio_path=audio_path,
+            audio=audio,
             models=self.models,
             fps=self.settings.fps,
             batch_size=self.batch_size,
             audio_padding_left=self.settings.audio_padding_length_left,
             audio_padding_right=self.settings.audio_padding_length_right,
-            device=self.device
+            device=self.device,
+            latent_budget_mb=self.settings.latent_device_budget_mb,
+            lip_stride=self.lip_stride,
+            blend_backend=self.settings.blend_backend,
+            jpeg_splice=self.settings.jpeg_splice,
+            patch_mode=patch_mode,
+            cancel=cancel,
+            # Stream batches are due at playback speed
+            ticket=gpu_scheduler.ticket(priority, fps=self.settings.fps)
         )
 
-    def inference_batch(self, avatar, audio_path: str) -> str:
+    def render_settings(self) -> dict:
+        """
+        Settings that change the rendered video (part of the result cache key).
+        Batch size only affects throughput and is deliberately left out.
+        """
+        return {
+            "version": self.settings.version,
+            "fps": self.settings.fps,
+            "audio_padding_left": self.settings.audio_padding_length_left,
+            "audio_padding_right": self.settings.audio_padding_length_right,
+            "engine": self.models.engine.name,
+            "precision": self.precision,
+            "lip_stride": self.lip_stride,
+            "blend_backend": self.settings.blend_backend,
+        }
+
+    def inference_batch(self, avatar, audio: AudioClip, output_path: str | None = None,
+                        cancel: CancelToken | None = None, priority: str = "standard") -> str:
         # Generate output path
-        output_dir = os.path.join(self.settings.result_dir, "inference")
-        os.makedirs(output_dir, exist_ok=True)
-        filename = f"{avatar.avatar_id}_{os.path.basename(audio_path).split('.')[0]}.mp4"
-        output_path = os.path.join(output_dir, filename)
+        if output_path is None:
+            output_dir = os.path.join(self.settings.result_dir, "inference")
+            filename = f"{avatar.avatar_id}_{int(time.time() * 1000)}.mp4"
+            output_path = os.path.join(output_dir, filename)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
         return inference_batch(
             avatar=avatar,
-            audio_path=audio_path,
+            audio=audio,
             output_path=output_path,
             models=self.models,
             fps=self.settings.fps,
             batch_size=self.batch_size,
-            ffmpeg_path=self.settings.ffmpeg_path
+            ffmpeg_path=self.settings.ffmpeg_path,
+            device=self.device,
+            latent_budget_mb=self.settings.latent_device_budget_mb,
+            lip_stride=self.lip_stride,
+            blend_backend=self.settings.blend_backend,
+            jpeg_splice=self.settings.jpeg_splice,
+            cancel=cancel,
+            ticket=gpu_scheduler.ticket(priority)
         )
 
-def inference_stream(
-    avatar, # musetalk_server.core.avatar.Avatar
-    audio_path: str,
-    models: InferenceModels,
-    fps: int = 25,
-    batch_size: int = 4,
-    audio_padding_left: int = 2,
-    audio_padding_right: int = 2,
-    device: torch.device = torch.device('cuda')
-) -> Generator[bytes, None, None]:
+    def inference_progressive(self, avatar, audio: AudioClip, output_path: str,
+                              cancel: CancelToken | None = None,
+                              priority: str = "standard") -> Generator[bytes, None, None]:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        return inference_progressive(
+            avatar=avatar,
+            audio=audio,
+            output_path=output_path,
+            models=self.models,
+            fps=self.settings.fps,
+            batch_size=self.batch_size,
+            ffmpeg_path=self.settings.ffmpeg_path,
+            device=self.device,
+            latent_budget_mb=self.settings.latent_device_budget_mb,
+            lip_stride=self.lip_stride,
+            blend_backend=self.settings.blend_backend,
+            jpeg_splice=self.settings.jpeg_splice,
+            cancel=cancel,
+            ticket=gpu_scheduler.ticket(priority)
+        )
+
+def validate_avatar(avatar) -> int:
     """
-    Generates a stream of JPEG bytes for the given avatar and audio.
+    Loads the avatar if needed and validates its state before starting workers.
+    Returns the cycle length.
     """
-    
     if not avatar.is_loaded:
         avatar.load_state()
 
-    # Validate avatar state before starting workers
     required_lists = [
         ("coord_list_cycle", avatar.coord_list_cycle),
         ("frame_list_cycle", avatar.frame_list_cycle),
@@ -105,28 +198,243 @@ def inference_stream(
     cycle_len = len(avatar.coord_list_cycle)
     if any(len(lst) != cycle_len for _, lst in required_lists):
         raise ValueError(f"Avatar {avatar.avatar_id} has inconsistent cycle lengths; please re-preprocess.")
+    return cycle_len
+
+def predict_batches(
+    models: InferenceModels,
+    whisper_batches: Iterator[torch.Tensor],
+    latent_cycle: torch.Tensor,
+    cycle_index: torch.Tensor,
+    device: torch.device,
+    lip_stride: int = 1,
+    buffers: BufferSet | None = None,
+    as_tensor: bool = False
+) -> Iterator[np.ndarray]:
+    """
+    Runs PE -> UNet -> VAE decode for each whisper batch, pairing frame i with
+    latent `cycle_index[i]`. Yields the decoded (n, 256, 256, 3) face crops per batch,
+    as a uint8 tensor left on the device with `as_tensor` (for the torch blend backend).
+    With `lip_stride` k > 1 only every k-th frame is inferred (see predict_strided).
+    Latent batches are gathered into `buffers` (a fresh set if None).
+    """
+    buffers = buffers if buffers is not None else BufferSet()
+    if lip_stride > 1:
+        yield from predict_strided(models, whisper_batches, latent_cycle, cycle_index, device, lip_stride, buffers,
+                                   as_tensor)
+        return
+
+    start = 0
+    for whisper_batch in whisper_batches:
+        latent_batch = gather_latents(latent_cycle, cycle_index[start:start + whisper_batch.shape[0]], device, buffers)
+        start += whisper_batch.shape[0]
+
+        audio_feature_batch = models.engine.encode_audio(whisper_batch.to(device))
+
+        pred_latents = models.engine.predict(latent_batch, audio_feature_batch)
+        yield models.engine.decode_tensor(pred_latents) if as_tensor else models.engine.decode(pred_latents)
+
+        # Clean up tensors after each batch
+        del whisper_batch, latent_batch, audio_feature_batch, pred_latents
+
+def gather_latents(latent_cycle: torch.Tensor, index: torch.Tensor, device: torch.device,
+                   buffers: BufferSet) -> torch.Tensor:
+    """
+    Gathers latents `index` of the cycle into a pooled batch buffer on `device`.
+    Cycles kept in host memory are gathered into a pinned staging buffer first;
+    it is only rewritten for the next batch, once the previous batch's results
+    have been copied back to the host.
+    """
+    shape = (index.shape[0],) + tuple(latent_cycle.shape[1:])
+    out = buffers.tensor("latents", shape, latent_cycle.dtype, device)
+    if latent_cycle.device == out.device:
+        return torch.index_select(latent_cycle, 0, index, out=out)
+    staging = buffers.tensor("latents_host", shape, latent_cycle.dtype, latent_cycle.device, pinned=True)
+    torch.index_select(latent_cycle, 0, index, out=staging)
+    return out.copy_(staging, non_blocking=True)
+
+def predict_strided(
+    models: InferenceModels,
+    whisper_batches: Iterator[torch.Tensor],
+    latent_cycle: torch.Tensor,
+    cycle_index: torch.Tensor,
+    device: torch.device,
+    lip_stride: int,
+    buffers: BufferSet | None = None,
+    as_tensor: bool = False
+) -> Iterator[np.ndarray]:
+    """
+    Reduced-rate variant of predict_batches: UNet and VAE run on anchor frames
+    (every `lip_stride`-th frame plus the last one), batched like the input, and
+    the face crops in between are linearly blended from the two surrounding
+    anchors. The blend stage still composites every frame onto its own cycle frame.
+    """
+    anchors = []        # (frame index, whisper prompt) waiting for inference
+    last = None         # most recent (frame index, whisper prompt)
+    previous = None     # most recent decoded (frame index, crop)
+    batch_size = None
+    frame = 0
+    buffers = buffers if buffers is not None else BufferSet()
+
+    def infer(batch):
+        nonlocal previous
+        frame_index = torch.tensor([i for i, _ in batch], device=cycle_index.device)
+        latent_batch = gather_latents(latent_cycle, cycle_index.index_select(0, frame_index), device, buffers)
+        whisper_batch = torch.stack([prompt for _, prompt in batch])
+
+        audio_feature_batch = models.engine.encode_audio(whisper_batch.to(device))
+        pred_latents = models.engine.predict(latent_batch, audio_feature_batch)
+        recon = models.engine.decode_tensor(pred_latents) if as_tensor else models.engine.decode(pred_latents)
+
+        out = []
+        for (anchor, _), crop in zip(batch, recon):
+            if previous is not None:
+                prev_anchor, prev_crop = previous
+                span = anchor - prev_anchor
+                for i in range(prev_anchor + 1, anchor):
+                    t = (i - prev_anchor) / span
+                    if as_tensor:
+                        out.append(torch.lerp(prev_crop.float(), crop.float(), t).round().to(torch.uint8))
+                    else:
+                        out.append(cv2.addWeighted(prev_crop, 1 - t, crop, t, 0))
+            out.append(crop)
+            previous = (anchor, crop)
+        return torch.stack(out) if as_tensor else np.stack(out)
+
+    for whisper_batch in whisper_batches:
+        batch_size = batch_size or whisper_batch.shape[0]
+        for prompt in whisper_batch:
+            if frame % lip_stride == 0:
+                anchors.append((frame, prompt))
+            last = (frame, prompt)
+            frame += 1
+        while len(anchors) >= batch_size:
+            yield infer(anchors[:batch_size])
+            anchors = anchors[batch_size:]
+
+    # The last frame is always inferred so the tail has a right-hand anchor
+    if last is not None and last[0] % lip_stride != 0:
+        anchors.append(last)
+    if anchors:
+        yield infer(anchors)
+
+def blend_frame(avatar, res_frame: np.ndarray, cycle_idx: int, buffers: BufferSet | None = None) -> np.ndarray:
+    """
+    Pastes a decoded face crop back into cycle frame `cycle_idx` of the avatar.
+    With `buffers` the composite is built in a pooled frame buffer, which the
+    next call overwrites: encode the result before blending the next frame.
+    """
+    cycle_idx = cycle_idx % len(avatar.coord_list_cycle)
+    bbox = avatar.coord_list_cycle[cycle_idx]
+    frame = avatar.frame_list_cycle[cycle_idx]
+    if buffers is None:
+        ori_frame = frame.copy()
+    else:
+        ori_frame = buffers.array("frame", frame.shape, frame.dtype)
+        np.copyto(ori_frame, frame)
+    x1, y1, x2, y2 = bbox
+    res_frame = cv2.resize(res_frame.astype(np.uint8), (x2 - x1, y2 - y1))
+    mask = avatar.mask_list_cycle[cycle_idx]
+    mask_crop_box = avatar.mask_coords_list_cycle[cycle_idx]
+    return get_image_blending(ori_frame, res_frame, bbox, mask, mask_crop_box)
+
+def blend_patch(avatar, res_frame: np.ndarray, cycle_idx: int) -> Tuple[Tuple[int, int, int, int], np.ndarray]:
+    """
+    Like blend_frame, but only produces the mask crop box (the only region
+    get_image_blending changes) instead of a full-resolution copy.
+    Returns (crop_box, blended patch).
+    """
+    cycle_idx = cycle_idx % len(avatar.coord_list_cycle)
+    x1, y1, x2, y2 = avatar.coord_list_cycle[cycle_idx]
+    x_s, y_s, x_e, y_e = avatar.mask_coords_list_cycle[cycle_idx]
+    region = avatar.frame_list_cycle[cycle_idx][y_s:y_e, x_s:x_e].copy()
+    res_frame = cv2.resize(res_frame.astype(np.uint8), (x2 - x1, y2 - y1))
+    mask = avatar.mask_list_cycle[cycle_idx]
+    # Same blend, with boxes expressed relative to the crop
+    patch = get_image_blending(region, res_frame, (x1 - x_s, y1 - y_s, x2 - x_s, y2 - y_s), mask,
+                               (0, 0, x_e - x_s, y_e - y_s))
+    return (int(x_s), int(y_s), int(x_e), int(y_e)), patch
+
+def encode_frame(avatar, res_frame, frame_idx: int, jpeg_splice: bool = False,
+                 buffers: BufferSet | None = None) -> bytes | None:
+    """
+    JPEG of output frame `frame_idx` from a decoded face crop, or from a region the
+    torch blend backend already composited. Returns None if encoding fails.
+    """
+    if jpeg_splice:
+        if isinstance(res_frame, BlendedRegion):
+            box, patch = res_frame
+        else:
+            box, patch = blend_patch(avatar, res_frame, frame_idx)
+        # Only the MCUs around the box are encoded, into the pre-encoded cycle frame
+        return avatar.jpeg_splicer().encode(frame_idx, box, patch)
+    if isinstance(res_frame, BlendedRegion):
+        frame = paste_region(avatar, res_frame, frame_idx, buffers)
+    else:
+        frame = blend_frame(avatar, res_frame, frame_idx, buffers)
+    ret, buffer = cv2.imencode('.jpg', frame)
+    return buffer.tobytes() if ret else None
+
+def inference_stream(
+    avatar, # musetalk_server.core.avatar.Avatar
+    audio: AudioClip,
+    models: InferenceModels,
+    fps: int = 25,
+    batch_size: int = 4,
+    audio_padding_left: int = 2,
+    audio_padding_right: int = 2,
+    device: torch.device = torch.device('cuda'),
+    latent_budget_mb: int = 0,
+    lip_stride: int = 1,
+    patch_mode: bool = False,
+    cancel: CancelToken | None = None,
+    blend_backend: str = "cv2",
+    jpeg_splice: bool = False,
+    ticket: Ticket | None = None
+) -> Generator[bytes, None, None]:
+    """
+    Generates a stream of JPEG bytes for the given avatar and audio.
+    With `lip_stride` k > 1 the UNet/VAE run on every k-th frame only.
+    With the "torch" `blend_backend`, crops are resized and blended per batch on
+    the device in the prediction worker (see TensorBlender); "cv2" blends each
+    frame on the CPU in the blending worker.
+    With `jpeg_splice`, full frames are encoded by splicing the re-encoded face
+    region into the avatar's pre-encoded cycle frame (see JpegSplicer).
+    With `patch_mode`, yields FramePatch items (blended face region only) for
+    clients that composite onto the avatar's cycle bundle themselves.
+    With a scheduler `ticket`, every batch waits for its turn on the device
+    (see GpuScheduler), so higher-priority renders can run in between.
+
+    Closing the generator or setting `cancel` stops both workers at the next
+    batch boundary; a cancelled stream raises InferenceCancelled to a consumer
+    that is still iterating. A worker error (prediction, blending or encoding of
+    any frame) ends the stream with that error; a stream that ends normally has
+    yielded exactly one item per audio frame.
+    """
+    cancel = cancel if cancel is not None else CancelToken()
+    blender = make_blender(blend_backend, device)
+    
+    cycle_len = validate_avatar(avatar)
 
-    print(f"Start inference stream for audio: {audio_path}")
+    print(f"Start inference stream for {audio.duration:.2f}s of audio")
     start_time = time.time()
 
     # 1. Audio Processing
-    ap = models.audio_processor
-    whisper = models.whisper
-    weight_dtype = models.unet.model.dtype 
+    # The clip is decoded up front; Whisper windows are encoded lazily inside the
+    # prediction worker so the first batch starts after one window, not the whole clip.
+    weight_dtype = models.unet.model.dtype
 
-    whisper_input_features, librosa_length = ap.get_audio_feature(audio_path, weight_dtype=weight_dtype)
-    whisper_chunks = ap.get_whisper_chunk(
-        whisper_input_features,
+    whisper_chunks = WhisperChunkStream(
+        models.audio_processor,
+        models.whisper,
+        audio.whisper_input(),
         device,
         weight_dtype,
-        whisper,
-        librosa_length,
         fps=fps,
-        audio_padding_length_left=audio_padding_left,
-        audio_padding_length_right=audio_padding_right,
+        audio_padding_left=audio_padding_left,
+        audio_padding_right=audio_padding_right,
     )
 
-    print(f"Audio processing costs {(time.time() - start_time) * 1000:.2f}ms")
+    print(f"Audio decoding costs {(time.time() - start_time) * 1000:.2f}ms")
 
     video_num = len(whisper_chunks)
     
@@ -139,76 +447,124 @@ def inference_stream(
     result_queue = queue.Queue(maxsize=batch_size * 4)
     SENTINEL = object()
     
+    # Latents are stacked once per avatar in the model dtype (and kept on the device
+    # when the budget allows); batches are formed by gathering cycle indices.
+    latent_cycle = avatar.latents_for(device, weight_dtype, latent_budget_mb)
+    cycle_index = (torch.arange(video_num) % latent_cycle.shape[0]).to(latent_cycle.device)
+
+    # Frames predicted by the UNet/VAE, and delivered to the consumer
+    progress = {"predicted": 0, "delivered": 0}
+    # First worker exception; re-raised to the consumer instead of ending the stream early
+    errors = []
+
+    def put(q: queue.Queue, item) -> bool:
+        """Blocking put that gives up once the render is cancelled."""
+        while not cancel.cancelled:
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(q: queue.Queue):
+        """Blocking get that returns SENTINEL once the render is cancelled."""
+        while not cancel.cancelled:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return SENTINEL
+
     def prediction_worker():
-        gen = datagen(whisper_chunks, avatar.input_latent_list_cycle, batch_size)
+        with buffer_pool.lease() as buffers:
+            predict(buffers)
 
+    def predict(buffers: BufferSet):
+        predictions = None
         try:
-            for i, (whisper_batch, latent_batch) in enumerate(gen):
-                audio_feature_batch = models.pe(whisper_batch.to(device))
-                latent_batch = latent_batch.to(device=device, dtype=weight_dtype)
-
-                pred_latents = models.unet.model(
-                    latent_batch,
-                    models.timesteps,
-                    encoder_hidden_states=audio_feature_batch
-                ).sample
-                
-                pred_latents = pred_latents.to(device=device, dtype=models.vae.vae.dtype)
-                recon = models.vae.decode_latents(pred_latents)
-                
+            first = True
+            batches = iter_batches(iter(whisper_chunks), batch_size)
+            predictions = predict_batches(models, batches, latent_cycle, cycle_index, device, lip_stride, buffers,
+                                          as_tensor=blender is not None)
+
+            def rendered():
+                # All device work of a batch, so it runs within one scheduler turn
+                for recon in predictions:
+                    if blender is not None:
+                        start = progress["predicted"]
+                        recon = blender.blend(avatar, recon, range(start, start + len(recon)), buffers)
+                    yield recon
+
+            batches = ticket.iterate(rendered(), lambda: cancel.cancelled) if ticket is not None else rendered()
+            for recon in batches:
+                if first:
+                    elapsed = (time.time() - start_time) * 1000
+                    print(f"First batch ready after {elapsed:.2f}ms")
+                    if ticket is not None:
+                        metrics.observe(f"inference.first_batch_ms.{ticket.priority}", elapsed)
+                    first = False
+                progress["predicted"] += len(recon)
                 for res_frame in recon:
-                    recon_queue.put(res_frame)
-                
-                # Clean up tensors after each batch
-                del whisper_batch, latent_batch, audio_feature_batch, pred_latents, recon
+                    if not put(recon_queue, res_frame):
+                        break
+                # Batch boundary: don't start the next batch for a cancelled render
+                if cancel.cancelled:
+                    break
                     
-            recon_queue.put(SENTINEL)
+            put(recon_queue, SENTINEL)
         except Exception as e:
             print(f"Prediction worker error: {e}")
-            recon_queue.put(SENTINEL) # Ensure consumer doesn't hang
+            errors.append(e)
+            put(recon_queue, SENTINEL) # Ensure consumer doesn't hang
         finally:
-            # Clean up after prediction worker completes
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            gc.collect()
+            # Drop the suspended prediction pipeline (and its device tensors) before returning the buffers
+            if predictions is not None:
+                predictions.close()
 
     def blending_worker():
+        with buffer_pool.lease() as buffers:
+            blend(buffers)
+
+    def blend(buffers: BufferSet):
         idx = 0
         while True:
-            res_frame = recon_queue.get()
+            res_frame = get(recon_queue)
             if res_frame is SENTINEL:
-                result_queue.put(SENTINEL)
+                put(result_queue, SENTINEL)
                 break
             
             if idx >= video_num:
                 continue
 
-            # Blending logic
-            # Use local copies of avatar lists to avoid any weird shared state issues (though lists are read-only here)
-            cycle_len = len(avatar.coord_list_cycle)
-            if cycle_len == 0:
-                result_queue.put(SENTINEL)
-                break
-            bbox = avatar.coord_list_cycle[idx % cycle_len]
-            ori_frame = copy.deepcopy(avatar.frame_list_cycle[idx % cycle_len])
-            x1, y1, x2, y2 = bbox
-            
             try:
-                res_frame = cv2.resize(res_frame.astype(np.uint8), (x2 - x1, y2 - y1))
-                mask = avatar.mask_list_cycle[idx % cycle_len]
-                mask_crop_box = avatar.mask_coords_list_cycle[idx % cycle_len]
-                combine_frame = get_image_blending(ori_frame, res_frame, bbox, mask, mask_crop_box)
-                
-                # Encode to JPEG
-                ret, buffer = cv2.imencode('.jpg', combine_frame)
-                if ret:
-                    result_queue.put(buffer.tobytes())
+                if patch_mode:
+                    if isinstance(res_frame, BlendedRegion):
+                        box, patch = res_frame
+                    else:
+                        box, patch = blend_patch(avatar, res_frame, idx)
+                    ret, buffer = cv2.imencode('.jpg', patch)
+                    if not ret:
+                        raise RuntimeError("JPEG encoding failed")
+                    put(result_queue, FramePatch(idx, idx % cycle_len, box, buffer.tobytes()))
+                    idx += 1
+                    continue
+
+                data = encode_frame(avatar, res_frame, idx, jpeg_splice, buffers)
+                if data is None:
+                    raise RuntimeError("JPEG encoding failed")
+                put(result_queue, data)
             except Exception as e:
+                # A dropped frame would shift the video against the audio: fail the render
                 print(f"Error blending frame {idx}: {e}")
-            
+                errors.append(e)
+                put(result_queue, SENTINEL)
+                break
+
             idx += 1
 
-    # Start threads
+    # Start threads (the memory policy may release cached memory once the render is over)
+    memory_policy.begin()
     pred_thread = threading.Thread(target=prediction_worker, daemon=True)
     blend_thread = threading.Thread(target=blending_worker, daemon=True)
     
@@ -216,42 +572,73 @@ def inference_stream(
     blend_thread.start()
     
     # Yield results
-    while True:
-        data = result_queue.get()
-        if data is SENTINEL:
-            break
-        yield data
+    completed = False
+    try:
+        while True:
+            data = get(result_queue)
+            if data is SENTINEL:
+                if not errors and not cancel.cancelled and progress["delivered"] != video_num:
+                    errors.append(RuntimeError(f"Rendered {progress['delivered']} of {video_num} frames"))
+                completed = not errors and not cancel.cancelled
+                break
+            yield data
+            progress["delivered"] += 1
+    finally:
+        if not completed:
+            # Consumer closed the generator (GeneratorExit), the render was cancelled or a worker failed
+            cancel.cancel("failed" if errors else "closed")
+        pred_thread.join()
+        blend_thread.join()
+        if errors:
+            metrics.inc("inference.failed")
+            print(f"Inference stream failed after {progress['delivered']}/{video_num} frames: {errors[0]}")
+        elif not completed:
+            metrics.inc("inference.cancelled")
+            metrics.inc(f"inference.cancelled.{cancel.reason}")
+            # Audio frames never rendered, and frames rendered but never delivered
+            metrics.inc("inference.cancelled_frames", video_num - progress["predicted"])
+            metrics.inc("inference.wasted_frames", max(0, progress["predicted"] - progress["delivered"]))
+            print(f"Inference stream cancelled ({cancel.reason}) after {progress['delivered']}/{video_num} frames")
 
-    pred_thread.join()
-    blend_thread.join()
+        # Both workers are done with their buffers
+        memory_policy.end()
 
-    # Clean up after all threads have finished
-    if torch.cuda.is_available():
-        torch.cuda.empty_cache()
-    gc.collect()
+    if errors:
+        raise errors[0]
+    if not completed:
+        raise InferenceCancelled(f"Inference cancelled: {cancel.reason}")
 
 
 def inference_batch(
     avatar, # musetalk_server.core.avatar.Avatar
-    audio_path: str,
+    audio: AudioClip,
     output_path: str,
     models: InferenceModels,
     fps: int = 25,
     batch_size: int = 4,
-    ffmpeg_path: str = "ffmpeg"
+    ffmpeg_path: str = "ffmpeg",
+    device: torch.device = torch.device('cuda'),
+    latent_budget_mb: int = 0,
+    lip_stride: int = 1,
+    cancel: CancelToken | None = None,
+    blend_backend: str = "cv2",
+    jpeg_splice: bool = False,
+    ticket: Ticket | None = None
 ) -> str:
     """
     Generates a full video file for the given avatar and audio.
-    Returns the path to the output video.
+    Returns the path to the output video. Raises InferenceCancelled if `cancel` is set.
     """
     # Use the stream to get frames, save them, then ffmpeg
     
-    temp_dir = os.path.join(os.path.dirname(output_path), f"tmp_{int(time.time())}")
-    os.makedirs(temp_dir, exist_ok=True)
+    # Unique per render: concurrent renders share the output directory
+    temp_dir = tempfile.mkdtemp(prefix="tmp_", dir=os.path.dirname(output_path) or ".")
     
     try:
         frame_gen = inference_stream(
-            avatar, audio_path, models, fps, batch_size
+            avatar, audio, models, fps, batch_size,
+            device=device, latent_budget_mb=latent_budget_mb, lip_stride=lip_stride, cancel=cancel,
+            blend_backend=blend_backend, jpeg_splice=jpeg_splice, ticket=ticket
         )
         
         idx = 0
@@ -260,26 +647,132 @@ def inference_batch(
                 f.write(jpeg_bytes)
             idx += 1
             
-        # Compile with ffmpeg
-        temp_mp4 = os.path.join(temp_dir, "temp.mp4")
-        cmd_img2video = [
-            ffmpeg_path, "-y", "-v", "warning", "-r", str(fps), 
-            "-f", "image2", "-i", f"{temp_dir}/%08d.jpg", 
-            "-vcodec", "libx264", "-vf", "format=yuv420p", "-crf", "18", 
-            temp_mp4
-        ]
-        subprocess.run(cmd_img2video, check=True)
-        
-        # Combine Audio
-        cmd_combine = [
-            ffmpeg_path, "-y", "-v", "warning", 
-            "-i", audio_path, "-i", temp_mp4, 
-            output_path
-        ]
-        subprocess.run(cmd_combine, check=True)
-        
+        mux_frames(temp_dir, audio, output_path, fps, ffmpeg_path)
         return output_path
         
     finally:
         if os.path.exists(temp_dir):
             shutil.rmtree(temp_dir)
+
+def mux_frames(frame_dir: str, audio: AudioClip, output_path: str, fps: int = 25, ffmpeg_path: str = "ffmpeg"):
+    """
+    Compiles the numbered JPEG frames in `frame_dir` into an H.264 MP4 with `audio`.
+    """
+    # Compile with ffmpeg
+    temp_mp4 = os.path.join(frame_dir, "temp.mp4")
+    cmd_img2video = [
+        ffmpeg_path, "-y", "-v", "warning", "-r", str(fps), 
+        "-f", "image2", "-i", f"{frame_dir}/%08d.jpg", 
+        "-vcodec", "libx264", "-vf", "format=yuv420p", "-crf", "18", 
+        temp_mp4
+    ]
+    subprocess.run(cmd_img2video, check=True)
+    
+    # Combine Audio (decoded PCM piped in from memory)
+    cmd_combine = [
+        ffmpeg_path, "-y", "-v", "warning", 
+        *audio.ffmpeg_input_args(), "-i", "pipe:0", "-i", temp_mp4, 
+        output_path
+    ]
+    subprocess.run(cmd_combine, input=audio.pcm_bytes(), check=True)
+
+
+def inference_progressive(
+    avatar, # musetalk_server.core.avatar.Avatar
+    audio: AudioClip,
+    output_path: str,
+    models: InferenceModels,
+    fps: int = 25,
+    batch_size: int = 4,
+    ffmpeg_path: str = "ffmpeg",
+    device: torch.device = torch.device('cuda'),
+    latent_budget_mb: int = 0,
+    lip_stride: int = 1,
+    chunk_size: int = 64 * 1024,
+    cancel: CancelToken | None = None,
+    blend_backend: str = "cv2",
+    jpeg_splice: bool = False,
+    ticket: Ticket | None = None
+) -> Generator[bytes, None, None]:
+    """
+    Like inference_batch, but yields a fragmented MP4 while frames are still being
+    rendered. A single ffmpeg pass reads JPEG frames from stdin, muxes the audio
+    (PCM written to an extra pipe) and writes through the tee muxer to both stdout (fragmented, one fragment per
+    second of video) and `output_path` (regular faststart MP4, complete once the
+    generator is exhausted).
+    """
+    frame_gen = inference_stream(
+        avatar, audio, models, fps, batch_size,
+        device=device, latent_budget_mb=latent_budget_mb, lip_stride=lip_stride, cancel=cancel,
+        blend_backend=blend_backend, jpeg_splice=jpeg_splice, ticket=ticket
+    )
+    tee_outputs = "|".join([
+        "[f=mp4:movflags=frag_keyframe+empty_moov+default_base_moof:onfail=ignore]pipe:1",
+        f"[f=mp4:movflags=+faststart]{output_path}",
+    ])
+    audio_read, audio_write = os.pipe()
+    cmd = [
+        ffmpeg_path, "-y", "-v", "warning",
+        "-f", "image2pipe", "-framerate", str(fps), "-c:v", "mjpeg", "-i", "pipe:0",
+        *audio.ffmpeg_input_args(), "-i", f"pipe:{audio_read}",
+        "-map", "0:v", "-map", "1:a",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", "18", "-g", str(fps),
+        "-c:a", "aac",
+        # The tee muxer can't request global headers from the encoders itself
+        "-flags", "+global_header",
+        "-f", "tee", tee_outputs
+    ]
+    try:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, pass_fds=(audio_read,))
+    except Exception:
+        os.close(audio_write)
+        raise
+    finally:
+        os.close(audio_read)
+    feed_error = []
+
+    def audio_feeder():
+        try:
+            with os.fdopen(audio_write, "wb") as pipe:
+                pipe.write(audio.pcm_bytes())
+        except BrokenPipeError:
+            pass
+
+    def feeder():
+        # Every frame must reach ffmpeg (BrokenPipeError included), or the render fails
+        try:
+            for jpeg_bytes in frame_gen:
+                proc.stdin.write(jpeg_bytes)
+        except Exception as e:
+            feed_error.append(e)
+        finally:
+            frame_gen.close()
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    feed_thread = threading.Thread(target=feeder, daemon=True)
+    feed_thread.start()
+    threading.Thread(target=audio_feeder, daemon=True).start()
+
+    finished = False
+    try:
+        while True:
+            chunk = proc.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        feed_thread.join()
+        if proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {proc.returncode}")
+        if feed_error:
+            raise feed_error[0]
+        finished = True
+    finally:
+        if not finished:
+            # Client went away or rendering failed: drop the partial output
+            proc.kill()
+            proc.wait()
+            if os.path.exists(output_path):
+                os.remove(output_path)
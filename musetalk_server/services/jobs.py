@@ -0,0 +1,565 @@
+import os
+import json
+import time
+import uuid
+import queue
+import shutil
+import hashlib
+import threading
+import torch
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from musetalk_server.conf import conf
+from musetalk_server.core.buffers import BufferSet, buffer_pool, memory_policy
+from musetalk_server.core.metrics import metrics
+from musetalk_server.core.scheduler import Ticket
+from musetalk_server.routing import node_tag
+from musetalk_server.services.audio import AudioClip, WhisperChunkStream, decode_audio, iter_batches
+from musetalk_server.services.blending import make_blender
+from musetalk_server.services.inference import (
+    CancelToken, InferenceCancelled, validate_avatar, predict_batches, encode_frame, mux_frames
+)
+
+JOB_FILE = "job.json"
+# Videos muxed by ffmpeg while the GPU renders the next clips
+MUX_WORKERS = 2
+
+class RenderJob:
+    """
+    A bulk render: `items` are dicts with avatar_id, audio (path), output_path and
+    their progress (status pending/done/failed, frames_done, frames_total, error).
+    The state is persisted to `{job_dir}/job.json` (written atomically), so a job
+    interrupted by a restart is resumed from its unfinished items.
+    """
+    def __init__(self, job_id: str, job_dir: str, items: list, output_dir: str,
+                 batch_size: int | None = None, lip_stride: int | None = None,
+                 status: str = "queued", created: float | None = None, error: str | None = None):
+        self.job_id = job_id
+        self.job_dir = job_dir
+        self.items = items
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.lip_stride = lip_stride
+        self.status = status
+        self.created = created if created is not None else time.time()
+        self.error = error
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.job_dir, JOB_FILE)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("completed", "cancelled", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "created": self.created,
+            "error": self.error,
+            "output_dir": self.output_dir,
+            "batch_size": self.batch_size,
+            "lip_stride": self.lip_stride,
+            "items": [dict(item) for item in self.items],
+        }
+
+    def info(self) -> dict:
+        counts = Counter(item["status"] for item in self.items)
+        return {
+            **self.to_dict(),
+            "items_total": len(self.items),
+            "items_done": counts["done"],
+            "items_failed": counts["failed"],
+        }
+
+    def save(self, min_interval: float = 0.0):
+        """Writes job.json; with `min_interval`, skips the write if the last one is more recent."""
+        with self._lock:
+            now = time.monotonic()
+            if min_interval and now - self._saved_at < min_interval:
+                return
+            self._saved_at = now
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.to_dict(), f)
+            os.replace(tmp_path, self.path)
+
+    @classmethod
+    def load(cls, job_dir: str) -> "RenderJob":
+        with open(os.path.join(job_dir, JOB_FILE), "r") as f:
+            data = json.load(f)
+        return cls(
+            data["job_id"], job_dir, data["items"], data["output_dir"],
+            batch_size=data.get("batch_size"), lip_stride=data.get("lip_stride"),
+            status=data.get("status", "queued"), created=data.get("created"), error=data.get("error"),
+        )
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FeatureCache:
+    """
+    Decoded audio and Whisper prompts of a job's clips, keyed by content digest,
+    so a clip used by several items is encoded once. `expect` registers each
+    item that will use a clip; the entry is dropped once the last of them has
+    released it. Entries still waiting for a later item are evicted (least
+    recently used first) when the cache outgrows `max_bytes`, and encoded
+    again if needed. Hits and misses are counted in `jobs.feature_hits` /
+    `jobs.feature_misses`.
+    """
+    def __init__(self, encode: Callable[[AudioClip], torch.Tensor], max_bytes: int, ffmpeg_path: str = "ffmpeg"):
+        self.encode = encode
+        self.max_bytes = max_bytes
+        self.ffmpeg_path = ffmpeg_path
+        self.refs = Counter()
+        self._entries = OrderedDict()  # digest -> (audio, prompts, nbytes)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(nbytes for _, _, nbytes in self._entries.values())
+
+    def expect(self, digest: str):
+        self.refs[digest] += 1
+
+    def acquire(self, digest: str, path: str):
+        """(AudioClip, (frames, 50, 384) prompts on the host) of the clip at `path`."""
+        entry = self._entries.get(digest)
+        if entry is not None:
+            self._entries.move_to_end(digest)
+            metrics.inc("jobs.feature_hits")
+            return entry[:2]
+        metrics.inc("jobs.feature_misses")
+        with open(path, "rb") as f:
+            audio = decode_audio(f.read(), self.ffmpeg_path)
+        prompts = self.encode(audio)
+        nbytes = audio.pcm.nbytes + prompts.numel() * prompts.element_size()
+        if self.refs[digest] > 1:
+            self._entries[digest] = (audio, prompts, nbytes)
+            while len(self._entries) > 1 and self.nbytes > self.max_bytes:
+                self._entries.popitem(last=False)
+        return audio, prompts
+
+    def release(self, digest: str):
+        self.refs[digest] -= 1
+        if self.refs[digest] <= 0:
+            del self.refs[digest]
+            self._entries.pop(digest, None)
+
+class _Clip:
+    """An item being rendered: frames go to `frame_dir` until all `num_frames` are written."""
+    def __init__(self, item: dict, digest: str, avatar, frame_dir: str):
+        self.item = item
+        self.digest = digest
+        self.avatar = avatar
+        self.frame_dir = frame_dir
+        self.audio: AudioClip | None = None
+        self.num_frames = 0
+        self.queued = 0
+        self.failed = False
+
+def render_job(job: RenderJob, service, get_avatar: Callable, cancel: CancelToken | None = None,
+               feature_cache_mb: int = 1024, ticket: Ticket | None = None):
+    """
+    Renders the unfinished items of `job` with one InferenceService (models,
+    device, batch size and lip stride of the job).
+
+    Items are grouped by avatar, so each avatar is loaded, pinned and has its
+    latents placed once. Within a group, items sharing an audio clip are
+    adjacent, and Whisper prompts are computed once per clip for the whole job
+    (see FeatureCache). With lip stride 1 the group's clips are packed into one
+    stream of batches, so a batch spans clip boundaries and only the last batch
+    of an avatar runs short; strided clips are predicted one at a time, since
+    interpolation must not cross clips.
+
+    Frames are encoded on a writer thread (cv2 or torch blending, JPEG splicing
+    as configured) into a frame directory per item; finished items are muxed on
+    a small pool while rendering continues, and written to a temporary file that
+    replaces `output_path` when complete. Raises InferenceCancelled if `cancel`
+    is set; finished items stay done. With a scheduler `ticket` every batch
+    waits for its device turn, so live renders preempt the job between batches.
+    """
+    cancel = cancel if cancel is not None else CancelToken()
+    settings = service.settings
+    models = service.models
+    device = service.device
+    batch_size = service.batch_size
+    lip_stride = service.lip_stride
+    blender = make_blender(settings.blend_backend, device)
+    weight_dtype = models.unet.model.dtype
+
+    def encode(audio: AudioClip) -> torch.Tensor:
+        stream = WhisperChunkStream(
+            models.audio_processor, models.whisper, audio.whisper_input(), device, weight_dtype,
+            fps=settings.fps,
+            audio_padding_left=settings.audio_padding_length_left,
+            audio_padding_right=settings.audio_padding_length_right,
+        )
+        chunks = [chunk.cpu() for chunk in stream]
+        return torch.cat(chunks) if chunks else torch.zeros(0, 50, 384, dtype=weight_dtype)
+
+    features = FeatureCache(encode, feature_cache_mb * 1024 * 1024, settings.ffmpeg_path)
+
+    def fail(item: dict, error: str):
+        item["status"] = "failed"
+        item["error"] = error
+        metrics.inc("jobs.items_failed")
+        print(f"Job {job.job_id} item {item['index']} failed: {error}")
+
+    # Group by avatar (in manifest order), then by audio clip
+    groups = OrderedDict()
+    for item in job.items:
+        if item["status"] == "done":
+            continue
+        item.update(status="pending", error=None, frames_done=0)
+        try:
+            digest = file_digest(item["audio"])
+        except OSError as e:
+            fail(item, f"Cannot read audio: {e}")
+            continue
+        features.expect(digest)
+        groups.setdefault(item["avatar_id"], []).append((digest, item))
+    job.save()
+
+    SENTINEL = object()
+    frame_queue = queue.Queue(maxsize=batch_size * 4)
+    mux_pool = ThreadPoolExecutor(max_workers=MUX_WORKERS, thread_name_prefix="job-mux")
+    writer_error = []
+
+    def put(item) -> bool:
+        while not cancel.cancelled:
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def on_device(batches):
+        """Runs each batch's device work in a scheduler turn when the job has a `ticket`."""
+        return ticket.iterate(batches, lambda: cancel.cancelled) if ticket is not None else batches
+
+    def mux(clip: _Clip):
+        output_path = clip.item["output_path"]
+        base, ext = os.path.splitext(output_path)
+        tmp_path = f"{base}.partial{ext}"
+        try:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            mux_frames(clip.frame_dir, clip.audio, tmp_path, settings.fps, settings.ffmpeg_path)
+            os.replace(tmp_path, output_path)
+            clip.item["status"] = "done"
+            metrics.inc("jobs.items_done")
+        except Exception as e:
+            fail(clip.item, f"Muxing failed: {e}")
+        finally:
+            shutil.rmtree(clip.frame_dir, ignore_errors=True)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            clip.audio = None
+            job.save()
+
+    def writer():
+        with buffer_pool.lease() as buffers:
+            write(buffers)
+
+    def write(buffers: BufferSet):
+        while True:
+            try:
+                entry = frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                if cancel.cancelled:
+                    return
+                continue
+            if entry is SENTINEL:
+                return
+            kind, target, idx, crop = entry
+            if kind == "unpin":
+                target.unpin()
+                continue
+            clip = target
+            if clip.failed:
+                continue
+            try:
+                data = encode_frame(clip.avatar, crop, idx, settings.jpeg_splice, buffers)
+                if data is None:
+                    raise ValueError(f"Failed to encode frame {idx}")
+                with open(os.path.join(clip.frame_dir, f"{idx:08d}.jpg"), "wb") as f:
+                    f.write(data)
+            except Exception as e:
+                clip.failed = True
+                fail(clip.item, f"Frame {idx}: {e}")
+                shutil.rmtree(clip.frame_dir, ignore_errors=True)
+                continue
+            clip.item["frames_done"] = idx + 1
+            metrics.inc("jobs.frames")
+            if idx + 1 == clip.num_frames:
+                mux_pool.submit(mux, clip)
+
+    def open_clip(clip: _Clip) -> Optional[torch.Tensor]:
+        """Prompts of the clip (None if it can't be rendered); its frame directory starts empty."""
+        try:
+            clip.audio, prompts = features.acquire(clip.digest, clip.item["audio"])
+        except Exception as e:
+            features.release(clip.digest)
+            fail(clip.item, f"Audio processing failed: {e}")
+            return None
+        if len(prompts) == 0:
+            features.release(clip.digest)
+            fail(clip.item, "Audio is shorter than one frame")
+            return None
+        shutil.rmtree(clip.frame_dir, ignore_errors=True)
+        os.makedirs(clip.frame_dir)
+        clip.num_frames = clip.item["frames_total"] = len(prompts)
+        return prompts
+
+    def emit(avatar, latent_cycle, batch_size_used: int, segments: list, buffers: BufferSet):
+        """Runs one batch of (clip, first frame, prompts) segments and queues its frames."""
+        cycle_len = latent_cycle.shape[0]
+        whisper_batch = torch.cat([prompts for _, _, prompts in segments])
+        frame_indices = [start + i for _, start, prompts in segments for i in range(len(prompts))]
+        index = (torch.tensor(frame_indices) % cycle_len).to(latent_cycle.device)
+
+        def predicted():
+            for recon in predict_batches(models, iter([whisper_batch]), latent_cycle, index, device, 1, buffers,
+                                         as_tensor=blender is not None):
+                yield blender.blend(avatar, recon, frame_indices, buffers) if blender is not None else recon
+
+        recon = next(on_device(predicted()), None)
+        if recon is None:
+            return
+        metrics.observe("jobs.batch_fill", whisper_batch.shape[0] / batch_size_used)
+        position = 0
+        for clip, start, prompts in segments:
+            for i in range(len(prompts)):
+                if not put(("frame", clip, start + i, recon[position])):
+                    return
+                clip.queued += 1
+                position += 1
+
+    def render_group(avatar, clips: list, buffers: BufferSet):
+        latent_cycle = avatar.latents_for(device, weight_dtype, settings.latent_device_budget_mb)
+        cycle_len = latent_cycle.shape[0]
+        if lip_stride > 1:
+            for clip in clips:
+                prompts = open_clip(clip)
+                if prompts is None:
+                    continue
+                features.release(clip.digest)
+                cycle_index = (torch.arange(len(prompts)) % cycle_len).to(latent_cycle.device)
+
+                def predicted():
+                    batches = iter_batches(iter([prompts]), batch_size)
+                    frame = 0
+                    for recon in predict_batches(models, batches, latent_cycle, cycle_index, device, lip_stride,
+                                                 buffers, as_tensor=blender is not None):
+                        if blender is not None:
+                            recon = blender.blend(avatar, recon, range(frame, frame + len(recon)), buffers)
+                        frame += len(recon)
+                        yield recon
+
+                frame = 0
+                for recon in on_device(predicted()):
+                    for crop in recon:
+                        if not put(("frame", clip, frame, crop)):
+                            break
+                        clip.queued += 1
+                        frame += 1
+                    if cancel.cancelled:
+                        raise InferenceCancelled(f"Inference cancelled: {cancel.reason}")
+                    job.save(min_interval=2.0)
+            return
+
+        # Pack consecutive clips into full batches
+        segments, filled = [], 0
+        for clip in clips:
+            prompts = open_clip(clip)
+            if prompts is None:
+                continue
+            start = 0
+            while start < len(prompts):
+                take = min(batch_size - filled, len(prompts) - start)
+                segments.append((clip, start, prompts[start:start + take]))
+                filled += take
+                start += take
+                if filled == batch_size:
+                    emit(avatar, latent_cycle, batch_size, segments, buffers)
+                    segments, filled = [], 0
+                    if cancel.cancelled:
+                        raise InferenceCancelled(f"Inference cancelled: {cancel.reason}")
+                    job.save(min_interval=2.0)
+            features.release(clip.digest)
+        if segments:
+            emit(avatar, latent_cycle, batch_size, segments, buffers)
+
+    print(f"Job {job.job_id}: {sum(len(g) for g in groups.values())} item(s) across {len(groups)} avatar(s)")
+    start_time = time.time()
+    memory_policy.begin()
+    write_thread = threading.Thread(target=writer, daemon=True, name="job-writer")
+    write_thread.start()
+    try:
+        with buffer_pool.lease() as buffers:
+            for avatar_id, entries in groups.items():
+                if cancel.cancelled:
+                    break
+                # Clips sharing audio back to back, so their prompts are reused while cached
+                entries.sort(key=lambda entry: entry[0])
+                avatar = get_avatar(avatar_id)
+                try:
+                    if not avatar:
+                        raise ValueError(f"Avatar {avatar_id} not found")
+                    validate_avatar(avatar)
+                except Exception as e:
+                    for digest, item in entries:
+                        features.release(digest)
+                        fail(item, str(e))
+                    continue
+                clips = [
+                    _Clip(item, digest, avatar, os.path.join(job.job_dir, "frames", str(item["index"])))
+                    for digest, item in entries
+                ]
+                avatar.pin()
+                try:
+                    render_group(avatar, clips, buffers)
+                except InferenceCancelled:
+                    raise
+                except Exception as e:
+                    print(f"Job {job.job_id}: rendering avatar {avatar_id} failed: {e}")
+                    # Clips whose frames were all queued are still written and muxed
+                    for clip in clips:
+                        if clip.item["status"] == "pending" and not clip.failed and clip.queued < max(1, clip.num_frames):
+                            clip.failed = True
+                            fail(clip.item, f"Inference failed: {e}")
+                finally:
+                    # Unpinned by the writer once the group's queued frames are encoded
+                    if not put(("unpin", avatar, None, None)):
+                        avatar.unpin()
+        put(SENTINEL)
+    finally:
+        write_thread.join()
+        mux_pool.shutdown(wait=True)
+        memory_policy.end()
+        # Frames of items that were cut short (cancellation, errors)
+        shutil.rmtree(os.path.join(job.job_dir, "frames"), ignore_errors=True)
+        job.save()
+
+    if cancel.cancelled:
+        raise InferenceCancelled(f"Inference cancelled: {cancel.reason}")
+    print(f"Job {job.job_id} rendered in {time.time() - start_time:.1f}s")
+
+class JobManager:
+    """
+    Queue of bulk render jobs under `root` (one directory per job). Jobs run one
+    at a time on a worker thread, since each one keeps the GPU busy by itself.
+    `start` reloads the jobs of previous runs and requeues unfinished ones.
+    Job ids start with `id_prefix` (the node tag when routing between nodes).
+    """
+    def __init__(self, root: str, id_prefix: str = ""):
+        self.root = root
+        self.id_prefix = id_prefix
+        self._jobs = {}
+        self._cancels = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._run = None
+
+    def job_dir(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def new_job_id(self) -> str:
+        return f"{self.id_prefix}-{uuid.uuid4().hex}" if self.id_prefix else uuid.uuid4().hex
+
+    def start(self, run: Callable[[RenderJob, CancelToken], None]):
+        """
+        Starts the worker; `run(job, cancel)` renders one job.
+        """
+        if self._thread is not None:
+            return
+        self._run = run
+        resumed = []
+        if os.path.isdir(self.root):
+            for job_id in os.listdir(self.root):
+                try:
+                    job = RenderJob.load(self.job_dir(job_id))
+                except (OSError, ValueError, KeyError):
+                    continue
+                self._jobs[job.job_id] = job
+                if not job.finished:
+                    # Interrupted by a restart: items already written stay done
+                    job.status = "queued"
+                    job.save()
+                    resumed.append(job)
+        for job in sorted(resumed, key=lambda j: j.created):
+            self._queue.put(job.job_id)
+        if resumed:
+            print(f"Resuming {len(resumed)} unfinished job(s)")
+        self._thread = threading.Thread(target=self._worker, daemon=True, name="render-jobs")
+        self._thread.start()
+
+    def submit(self, job: RenderJob) -> RenderJob:
+        os.makedirs(job.job_dir, exist_ok=True)
+        job.save()
+        with self._lock:
+            self._jobs[job.job_id] = job
+        self._queue.put(job.job_id)
+        metrics.inc("jobs.submitted")
+        return job
+
+    def get(self, job_id: str) -> Optional[RenderJob]:
+        return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        return sorted(self._jobs.values(), key=lambda job: job.created)
+
+    def pending(self) -> int:
+        """Jobs waiting for the worker."""
+        return self._queue.qsize()
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return False
+            cancel = self._cancels.get(job_id)
+            if cancel is None:
+                job.status = "cancelled"
+                job.save()
+                return True
+        cancel.cancel("cancelled")
+        return True
+
+    def _worker(self):
+        while True:
+            job = self._jobs.get(self._queue.get())
+            if job is None:
+                continue
+            with self._lock:
+                if job.status != "queued":
+                    continue
+                cancel = self._cancels[job.job_id] = CancelToken()
+                job.status = "running"
+            job.save()
+            try:
+                self._run(job, cancel)
+                job.status = "completed"
+            except InferenceCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                print(f"Job {job.job_id} failed: {e}")
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                with self._lock:
+                    self._cancels.pop(job.job_id, None)
+                job.save()
+
+# Global instance for results/jobs
+job_manager = JobManager(os.path.join(conf.result_dir, "jobs"),
+                         id_prefix=node_tag(conf.route_self_url) if conf.route_self_url else "")
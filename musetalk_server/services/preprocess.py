@@ -5,16 +5,22 @@ import cv2
 import torch
 import pickle
 import json
+import hashlib
+import numpy as np
 from tqdm import tqdm
 
 # Core imports (assuming these exist in the environment as per existing scripts)
-from musetalk.utils.preprocessing import get_landmark_and_bbox
+# musetalk.utils.preprocessing (DWPose) is handed in by the model loader so that
+# importing this module does not load the pose models on inference-only nodes.
 from musetalk.utils.blending import get_image_prepare_material
 
+COORD_PLACEHOLDER = (0.0, 0.0, 0.0, 0.0)
+
 class AvatarPreprocessor:
-    def __init__(self, vae, face_parser):
+    def __init__(self, vae, face_parser, dwpose=None):
         self.vae = vae
         self.face_parser = face_parser
+        self.dwpose = dwpose
 
     def process_avatar(
         self,
@@ -25,19 +31,30 @@ class AvatarPreprocessor:
         force_recreation: bool = False,
         extra_margin: int = 10,
         parsing_mode: str = "jaw",
-        version: str = "v15"
+        version: str = "v15",
+        left_cheek_width: int = 90,
+        right_cheek_width: int = 90,
+        source_digest: str = None,
+        keyframe_interval: int = 0,
+        motion_threshold: float = 0.05
     ):
-        process_avatar(
+        return process_avatar(
             avatar_id=avatar_id,
             video_path=video_path,
             vae=self.vae,
             face_parser=self.face_parser,
+            dwpose=self.dwpose,
             bbox_shift=bbox_shift,
             results_dir=results_dir,
             force_recreation=force_recreation,
             extra_margin=extra_margin,
             parsing_mode=parsing_mode,
-            version=version
+            version=version,
+            left_cheek_width=left_cheek_width,
+            right_cheek_width=right_cheek_width,
+            source_digest=source_digest,
+            keyframe_interval=keyframe_interval,
+            motion_threshold=motion_threshold
         )
 
 def video2imgs(vid_path: str, save_path: str, ext: str = '.png', cut_frame: int = 10000000):
@@ -57,21 +74,355 @@ def video2imgs(vid_path: str, save_path: str, ext: str = '.png', cut_frame: int
             break
     cap.release()
 
+def fingerprint(*parts) -> str:
+    """
+    Stable hash of stage inputs (upstream fingerprints and parameters).
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+def source_fingerprint(video_path: str) -> str:
+    """
+    Content hash of the source video, or of the PNG listing of a frame directory.
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(video_path):
+        for filename in sorted(f for f in os.listdir(video_path) if f.lower().endswith('.png')):
+            stat = os.stat(os.path.join(video_path, filename))
+            digest.update(f"{filename}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    else:
+        with open(video_path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+class StageCache:
+    """
+    Records which stage outputs of an avatar directory are current (stages.json):
+    stage name -> fingerprint of everything the stage was computed from.
+    A stage is invalidated before its outputs are rewritten, so an interrupted
+    run never leaves a stale output marked current.
+    """
+    def __init__(self, base_path: str):
+        self.path = os.path.join(base_path, "stages.json")
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.stages = json.load(f)
+
+    def is_current(self, stage: str, fp: str) -> bool:
+        return self.stages.get(stage) == fp
+
+    def invalidate(self, stage: str):
+        if self.stages.pop(stage, None) is not None:
+            self._save()
+
+    def mark(self, stage: str, fp: str):
+        self.stages[stage] = fp
+        self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.stages, f)
+        os.replace(tmp_path, self.path)
+
+def _clear_dir(path: str):
+    os.makedirs(path, exist_ok=True)
+    for filename in os.listdir(path):
+        os.remove(os.path.join(path, filename))
+
+def _write_atomic(path: str, write):
+    """
+    Writes a file through a temporary name and os.replace, so a hard link to the
+    previous version (a deduplicated avatar) keeps its content.
+    """
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def _write_info(path: str, info: dict):
+    """
+    Writes avator_info.json only when its contents change: its mtime is part of
+    Avatar.content_version, so rewriting it on a skipped build would invalidate
+    cached renders, shared-store mappings and bundles of an unchanged avatar.
+    """
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                if json.load(f) == info:
+                    return
+        except ValueError:
+            pass
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(info, f)
+    _write_atomic(path, write)
+
+def _pickle_atomic(path: str, obj):
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(obj, f)
+    _write_atomic(path, write)
+
+# Build artifacts shared by deduplicated avatars (avator_info.json and stages.json are per avatar)
+LINKED_DIRS = ("full_imgs", "mask", os.path.join("stages", "frames"))
+LINKED_FILES = ("coords.pkl", "latents.pt", "mask_coords.pkl", os.path.join("stages", "landmarks.pkl"))
+
+def find_equivalent_avatar(avatars_root: str, avatar_id: str, masks_fp: str, latents_fp: str) -> str:
+    """
+    Id of another avatar whose current build has the same fingerprints, i.e. the
+    same source video content and preprocessing parameters; None if there is none.
+    """
+    if not os.path.isdir(avatars_root):
+        return None
+    for other_id in sorted(os.listdir(avatars_root)):
+        other_path = os.path.join(avatars_root, other_id)
+        if other_id == avatar_id or not os.path.exists(os.path.join(other_path, "stages.json")):
+            continue
+        try:
+            stages = StageCache(other_path)
+        except ValueError:
+            continue
+        if (stages.is_current("masks", masks_fp) and stages.is_current("latents", latents_fp)
+                and all(os.path.exists(os.path.join(other_path, name)) for name in LINKED_FILES)):
+            return other_id
+    return None
+
+def link_avatar(src_path: str, dst_path: str):
+    """
+    Makes dst_path share src_path's build artifacts through hard links (copies when
+    the filesystem doesn't support them). Outputs are always replaced, never
+    rewritten in place, so reprocessing either avatar later doesn't affect the other.
+    """
+    def link(src, dst):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+    for name in LINKED_DIRS:
+        dst_dir = os.path.join(dst_path, name)
+        _clear_dir(dst_dir)
+        for filename in sorted(os.listdir(os.path.join(src_path, name))):
+            link(os.path.join(src_path, name, filename), os.path.join(dst_dir, filename))
+    for name in LINKED_FILES:
+        dst = os.path.join(dst_path, name)
+        tmp_path = f"{dst}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        link(os.path.join(src_path, name), tmp_path)
+        os.replace(tmp_path, dst)
+    _write_atomic(os.path.join(dst_path, "stages.json"),
+                  lambda tmp_path: shutil.copyfile(os.path.join(src_path, "stages.json"), tmp_path))
+
+def detect_landmarks(dwpose, img_list: list) -> list:
+    """
+    Raw per-frame detections, independent of bbox_shift: (68 face landmarks as int32
+    array, face detector box or None when no face was found). Same models and calls
+    as upstream get_landmark_and_bbox (musetalk.utils.preprocessing).
+    """
+    return [_detect(dwpose, cv2.imread(img_path)) for img_path in tqdm(img_list)]
+
+def _detect(dwpose, frame) -> tuple:
+    results = dwpose.merge_data_samples(dwpose.inference_topdown(dwpose.model, frame))
+    face_land_mark = results.pred_instances.keypoints[0][23:91].astype(np.int32)
+    bbox = dwpose.fa.get_detections_for_batch(np.asarray([frame]))[0]
+    return face_land_mark, None if bbox is None else tuple(bbox)
+
+def _face_box(detection) -> tuple:
+    """Landmark box (bbox_shift 0) of a detection, None without a face."""
+    return None if detection[1] is None else landmarks_to_boxes([detection])[0]
+
+def _thumbnail(frame, box, size: int = 32) -> np.ndarray:
+    """Small grayscale crop of the face region (whole frame without a box) for appearance checks."""
+    if box is not None:
+        x1, y1, x2, y2 = (int(round(v)) for v in box)
+        x1, y1 = max(x1, 0), max(y1, 0)
+        crop = frame[y1:y2, x1:x2]
+        frame = crop if crop.size else frame
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32) / 255.0
+
+def _interpolate(start, end, t: float) -> tuple:
+    """Detection between two detections with the same face presence, at fraction t."""
+    (lm_a, bbox_a), (lm_b, bbox_b) = start, end
+    landmarks = np.rint((1 - t) * lm_a + t * lm_b).astype(np.int32)
+    if bbox_a is None or bbox_b is None:
+        return landmarks, None
+    return landmarks, tuple(int(round((1 - t) * a + t * b)) for a, b in zip(bbox_a, bbox_b))
+
+def detect_landmarks_keyframes(dwpose, img_list: list, interval: int = 10, motion_threshold: float = 0.05,
+                               appearance_threshold: float = 0.06) -> tuple:
+    """
+    detect_landmarks on keyframes only, for footage where the face barely moves.
+
+    Every `interval`-th frame and the last one are detected. A span between two
+    detected frames is bisected (its middle frame detected) while tracking across
+    it can't be trusted:
+    - the face is found at one end only;
+    - the face box moves by more than `motion_threshold` of the face size;
+    - a frame's face region (at the interpolated box) differs by more than
+      `appearance_threshold` (mean absolute grayscale difference) from the blend
+      of the two ends, e.g. the mouth opens and closes again in between.
+    Landmarks and detector boxes of the remaining frames are interpolated
+    linearly. Returns (raw detections as detect_landmarks, indices of the frames
+    that were detected).
+    """
+    count = len(img_list)
+    raw = [None] * count
+    if count == 0:
+        return raw, []
+    keyframes = sorted(set(range(0, count, max(interval, 1))) | {count - 1})
+    for i in tqdm(keyframes):
+        raw[i] = _detect(dwpose, cv2.imread(img_list[i]))
+
+    spans = list(zip(keyframes, keyframes[1:]))
+    tracked = []
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+        if _needs_detection(img_list, raw, start, end, motion_threshold, appearance_threshold):
+            middle = (start + end) // 2
+            raw[middle] = _detect(dwpose, cv2.imread(img_list[middle]))
+            spans += [(start, middle), (middle, end)]
+        else:
+            tracked.append((start, end))
+
+    for start, end in tracked:
+        for i in range(start + 1, end):
+            raw[i] = _interpolate(raw[start], raw[end], (i - start) / (end - start))
+    detected = sorted(set(range(count)) - {i for start, end in tracked for i in range(start + 1, end)})
+    print(f"Landmarks: detected {len(detected)} of {count} frames")
+    return raw, detected
+
+def _needs_detection(img_list, raw, start, end, motion_threshold, appearance_threshold) -> bool:
+    box_a, box_b = _face_box(raw[start]), _face_box(raw[end])
+    if (box_a is None) != (box_b is None):
+        return True
+    if box_a is not None:
+        size = max(box_a[2] - box_a[0], box_a[3] - box_a[1], 1)
+        if max(abs(a - b) for a, b in zip(box_a, box_b)) / size > motion_threshold:
+            return True
+    thumb_a = _thumbnail(cv2.imread(img_list[start]), box_a)
+    thumb_b = _thumbnail(cv2.imread(img_list[end]), box_b)
+    for i in range(start + 1, end):
+        t = (i - start) / (end - start)
+        box = _face_box(_interpolate(raw[start], raw[end], t))
+        expected = (1 - t) * thumb_a + t * thumb_b
+        if np.mean(np.abs(_thumbnail(cv2.imread(img_list[i]), box) - expected)) > appearance_threshold:
+            return True
+    return False
+
+def _iou(a, b) -> float:
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    inter = max(width, 0) * max(height, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+def keyframe_report(full: list, tracked: list, bbox_shift: int = 0) -> dict:
+    """
+    Accuracy of keyframe detection against detection on every frame: overlap and
+    corner deviation of the boxes preprocessing derives, mean landmark error, and
+    frames where only one of them found a face.
+    """
+    ious, deviations, errors = [], [], []
+    mismatches = 0
+    full_boxes, tracked_boxes = landmarks_to_boxes(full, bbox_shift), landmarks_to_boxes(tracked, bbox_shift)
+    for (lm_full, bbox_full), (lm_tracked, bbox_tracked), box_full, box_tracked in zip(full, tracked, full_boxes, tracked_boxes):
+        if (bbox_full is None) != (bbox_tracked is None):
+            mismatches += 1
+            continue
+        if bbox_full is None:
+            continue
+        ious.append(_iou(box_full, box_tracked))
+        deviations.append(max(abs(float(a) - float(b)) for a, b in zip(box_full, box_tracked)))
+        errors.append(float(np.mean(np.linalg.norm(lm_full.astype(np.float32) - lm_tracked, axis=1))))
+    return {
+        "frames": len(full),
+        "face_mismatches": mismatches,
+        "box_iou_mean": round(float(np.mean(ious)), 4) if ious else None,
+        "box_iou_min": round(float(np.min(ious)), 4) if ious else None,
+        "box_max_deviation_px": round(max(deviations), 1) if deviations else None,
+        "landmark_error_px": round(float(np.mean(errors)), 2) if errors else None,
+    }
+
+def landmarks_to_boxes(raw: list, bbox_shift: int = 0) -> list:
+    """
+    Face boxes from raw detections, as upstream get_landmark_and_bbox computes them
+    with `upperbondrange=bbox_shift` (frames without a face get the zero placeholder).
+    """
+    coords_list = []
+    for face_land_mark, bbox in raw:
+        if bbox is None:
+            coords_list.append(COORD_PLACEHOLDER)
+            continue
+        # Upstream shifts landmark 29 in place before measuring; work on a copy
+        face_land_mark = face_land_mark.copy()
+        half_face_coord = face_land_mark[29]
+        if bbox_shift != 0:
+            half_face_coord[1] = bbox_shift + half_face_coord[1]
+        half_face_dist = np.max(face_land_mark[:, 1]) - half_face_coord[1]
+        # Upstream v1.5 clamps at the top of the frame; a negative y1 would slice from the bottom
+        upper_bond = max(0, half_face_coord[1] - half_face_dist)
+
+        f_landmark = (np.min(face_land_mark[:, 0]), int(upper_bond), np.max(face_land_mark[:, 0]), np.max(face_land_mark[:, 1]))
+        x1, y1, x2, y2 = f_landmark
+        if y2 - y1 <= 0 or x2 - x1 <= 0 or x1 < 0:
+            # Landmark box unusable; fall back to the detector box
+            coords_list.append(bbox)
+        else:
+            coords_list.append(f_landmark)
+    return coords_list
+
+def bbox_shift_range(raw: list) -> tuple:
+    """
+    Suggested bbox_shift adjustment range, as printed by upstream get_landmark_and_bbox.
+    """
+    faces = [face_land_mark for face_land_mark, bbox in raw if bbox is not None]
+    if not faces:
+        return 0, 0
+    range_minus = [(lm[30] - lm[29])[1] for lm in faces]
+    range_plus = [(lm[29] - lm[28])[1] for lm in faces]
+    return -int(sum(range_minus) / len(range_minus)), int(sum(range_plus) / len(range_plus))
+
 def process_avatar(
     avatar_id: str,
     video_path: str,
     vae: torch.nn.Module,
     face_parser: object,
+    dwpose: object = None,
     bbox_shift: int = 0,
     results_dir: str = "./results",
     force_recreation: bool = False,
     extra_margin: int = 10,
     parsing_mode: str = "jaw",
-    version: str = "v15"
+    version: str = "v15",
+    left_cheek_width: int = 90,
+    right_cheek_width: int = 90,
+    source_digest: str = None,
+    dedupe: bool = True,
+    keyframe_interval: int = 0,
+    motion_threshold: float = 0.05
 ):
     """
     Preprocesses an avatar from a video source.
     Generates frames, landmarks, latents, and masks.
+
+    Each stage is cached in the avatar directory with a fingerprint of its inputs
+    (see StageCache), so changing bbox_shift / extra_margin only recomputes boxes,
+    latents and masks, and changing parsing_mode or the cheek widths only the masks.
+    The cheek widths are those the face parser was built with.
+
+    `source_digest` is the content hash of the video when the caller already has it
+    (content-addressed uploads); it is computed otherwise. With `dedupe`, an avatar
+    whose inputs match another avatar's current build hard-links that build instead
+    of being processed. Returns the id of that avatar, or None.
+
+    With `keyframe_interval` above 1, landmarks are detected on keyframes and
+    interpolated in between (see detect_landmarks_keyframes).
     """
     
     # Define paths
@@ -83,128 +434,157 @@ def process_avatar(
     mask_coords_path = os.path.join(base_path, "mask_coords.pkl")
     avatar_info_path = os.path.join(base_path, "avator_info.json")
     video_out_path = os.path.join(base_path, "vid_output") # Needed for structure compatibility
+    source_frames_path = os.path.join(base_path, "stages", "frames")
+    landmarks_path = os.path.join(base_path, "stages", "landmarks.pkl")
 
-    avatar_info = {
+    if not os.path.exists(video_path):
+        raise FileNotFoundError(f"Video path not found: {video_path}")
+
+    if force_recreation and os.path.exists(base_path):
+        shutil.rmtree(base_path)
+
+    print(f"Preparing avatar: {avatar_id}")
+    for p in [base_path, full_imgs_path, video_out_path, mask_out_path, source_frames_path]:
+        os.makedirs(p, exist_ok=True)
+
+    _write_info(avatar_info_path, {
         "avatar_id": avatar_id,
         "video_path": video_path,
         "bbox_shift": bbox_shift,
         "version": version
-    }
+    })
 
-    # Check if exists
-    if os.path.exists(base_path):
-        if not force_recreation:
-            # Check consistency and required outputs
-            required_paths = [coords_path, latents_out_path, mask_coords_path, avatar_info_path]
-            has_required = all(os.path.exists(p) for p in required_paths)
-            has_masks = os.path.isdir(mask_out_path) and len(os.listdir(mask_out_path)) > 0
-            has_frames = os.path.isdir(full_imgs_path) and len(os.listdir(full_imgs_path)) > 0
-
-            if os.path.exists(avatar_info_path):
-                with open(avatar_info_path, "r") as f:
-                    existing_info = json.load(f)
-                if existing_info.get('bbox_shift') == bbox_shift and has_required and has_masks and has_frames:
-                    print(f"Avatar {avatar_id} already exists with matching bbox_shift. Skipping.")
-                    return
-                else:
-                    print(f"Avatar {avatar_id} exists but is incomplete or bbox_shift mismatch. Recreating...")
-            else:
-                print(f"Avatar {avatar_id} exists but info missing. Recreating...")
-
-        # Clean up
-        shutil.rmtree(base_path)
+    stages = StageCache(base_path)
+    frames_fp = fingerprint("frames", (source_digest or source_fingerprint(video_path))[:16])
+    landmarks_fp = fingerprint("landmarks", frames_fp)
+    if keyframe_interval > 1:
+        landmarks_fp = fingerprint("landmarks", frames_fp, "keyframes", keyframe_interval, motion_threshold)
+    # "clamped": boxes from before the upper bound was clamped at the frame top are stale
+    boxes_fp = fingerprint("boxes", landmarks_fp, bbox_shift, extra_margin if version == "v15" else 0, "clamped")
+    masks_fp = fingerprint("masks", boxes_fp, version, parsing_mode, left_cheek_width, right_cheek_width)
+    outputs_present = all(os.path.exists(p) for p in (coords_path, latents_out_path, mask_coords_path))
 
-    print(f"Creating avatar: {avatar_id}")
-    for p in [base_path, full_imgs_path, video_out_path, mask_out_path]:
-        os.makedirs(p, exist_ok=True)
+    if outputs_present and stages.is_current("masks", masks_fp) and stages.is_current("latents", boxes_fp):
+        print(f"Avatar {avatar_id} is up to date. Skipping.")
+        return None
 
-    with open(avatar_info_path, "w") as f:
-        json.dump(avatar_info, f)
+    avatars_root = os.path.dirname(base_path)
+    donor_id = find_equivalent_avatar(avatars_root, avatar_id, masks_fp, boxes_fp) if dedupe else None
+    if donor_id is not None:
+        print(f"Avatar {avatar_id} matches the build of {donor_id}; linking its artifacts.")
+        link_avatar(os.path.join(avatars_root, donor_id), base_path)
+        return donor_id
 
     # 1. Extract Frames
-    if os.path.isfile(video_path):
-        print(f"Extracting frames from {video_path}...")
-        video2imgs(video_path, full_imgs_path, ext='.png')
-    elif os.path.isdir(video_path):
-        print(f"Copying frames from {video_path}...")
-        files = sorted([f for f in os.listdir(video_path) if f.lower().endswith('.png')])
-        for filename in files:
-            shutil.copyfile(os.path.join(video_path, filename), os.path.join(full_imgs_path, filename))
+    if not stages.is_current("frames", frames_fp):
+        stages.invalidate("frames")
+        _clear_dir(source_frames_path)
+        if os.path.isfile(video_path):
+            print(f"Extracting frames from {video_path}...")
+            video2imgs(video_path, source_frames_path, ext='.png')
+        else:
+            print(f"Copying frames from {video_path}...")
+            files = sorted([f for f in os.listdir(video_path) if f.lower().endswith('.png')])
+            for filename in files:
+                shutil.copyfile(os.path.join(video_path, filename), os.path.join(source_frames_path, filename))
+        stages.mark("frames", frames_fp)
     else:
-        raise FileNotFoundError(f"Video path not found: {video_path}")
+        print("Frames: cached")
 
-    input_img_list = sorted(glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]')))
-    
-    # 2. Extract Landmarks & BBox
-    print("Extracting landmarks...")
-    # coord_list is a list of [x1, y1, x2, y2]
-    coord_list, frame_list = get_landmark_and_bbox(input_img_list, bbox_shift)
+    input_img_list = sorted(glob.glob(os.path.join(source_frames_path, '*.[jpJP][pnPN]*[gG]')))
     
-    input_latent_list = []
-    valid_coord_list = []
-    valid_frame_list = []
-    coord_placeholder = (0.0, 0.0, 0.0, 0.0)
-
-    # 3. Process Frames (Crop -> Resize -> VAE Latents)
-    print("Processing latents...")
-    for bbox, frame in zip(coord_list, frame_list):
-        if bbox == coord_placeholder:
-            continue
-
-        x1, y1, x2, y2 = bbox
-        if version == "v15":
-            y2 = y2 + extra_margin
-            y2 = min(y2, frame.shape[0])
-        adjusted_bbox = [x1, y1, x2, y2]
+    # 2. Extract Landmarks (independent of bbox_shift)
+    if not stages.is_current("landmarks", landmarks_fp):
+        stages.invalidate("landmarks")
+        print("Extracting landmarks...")
+        if dwpose is None:
+            # Through the model loader, which can unload it again
+            from musetalk_server.core.model_loader import model_loader
+            dwpose = model_loader.get_models(("dwpose",))["dwpose"]
+        if keyframe_interval > 1:
+            raw_landmarks, _ = detect_landmarks_keyframes(dwpose, input_img_list, keyframe_interval, motion_threshold)
+        else:
+            raw_landmarks = detect_landmarks(dwpose, input_img_list)
+        _pickle_atomic(landmarks_path, raw_landmarks)
+        stages.mark("landmarks", landmarks_fp)
+    else:
+        print("Landmarks: cached")
+        with open(landmarks_path, 'rb') as f:
+            raw_landmarks = pickle.load(f)
 
-        crop_frame = frame[y1:y2, x1:x2]
-        resized_crop_frame = cv2.resize(crop_frame, (256, 256), interpolation=cv2.INTER_LANCZOS4)
+    low, high = bbox_shift_range(raw_landmarks)
+    print(f"Total frame: {len(input_img_list)}. Manually adjust range: [{low} ~ {high}], the current bbox_shift: {bbox_shift}")
 
-        # Calculate latents
-        # Assuming vae.get_latents_for_unet exists and handles device transfer if needed
-        latents = vae.get_latents_for_unet(resized_crop_frame)
-        input_latent_list.append(latents)
-        valid_coord_list.append(adjusted_bbox)
-        valid_frame_list.append(frame)
+    # 3. Boxes (cheap, always derived)
+    valid_coord_list = []
+    valid_img_list = []
+    for bbox, img_path in zip(landmarks_to_boxes(raw_landmarks, bbox_shift), input_img_list):
+        if bbox == COORD_PLACEHOLDER:
+            continue
+        valid_coord_list.append(bbox)
+        valid_img_list.append(img_path)
 
     if not valid_coord_list:
         raise ValueError("No valid face detections found; cannot create avatar.")
 
+    valid_frame_list = [cv2.imread(img_path) for img_path in valid_img_list]
+    if version == "v15":
+        valid_coord_list = [
+            [x1, y1, x2, min(y2 + extra_margin, frame.shape[0])]
+            for (x1, y1, x2, y2), frame in zip(valid_coord_list, valid_frame_list)
+        ]
+    else:
+        valid_coord_list = [list(bbox) for bbox in valid_coord_list]
+
     # 4. Cycle Lists (Forward + Backward for smooth looping)
+    # Frames without a face are dropped, so the cycle only changes with the landmarks
     frame_list_cycle = valid_frame_list + valid_frame_list[::-1]
     coord_list_cycle = valid_coord_list + valid_coord_list[::-1]
-    input_latent_list_cycle = input_latent_list + input_latent_list[::-1]
 
-    # Replace stored frames with the cycled list so load_state matches lengths
-    for filename in os.listdir(full_imgs_path):
-        os.remove(os.path.join(full_imgs_path, filename))
-    for idx, frame in enumerate(frame_list_cycle):
-        cv2.imwrite(os.path.join(full_imgs_path, f"{idx:08d}.png"), frame)
-    
-    mask_coords_list_cycle = []
-    mask_list_cycle = []
-
-    # 5. Generate Masks
-    print("Generating masks...")
-    for i, frame in enumerate(tqdm(frame_list_cycle)):
-        x1, y1, x2, y2 = coord_list_cycle[i]
-        
+    if not stages.is_current("cycle_frames", landmarks_fp):
+        stages.invalidate("cycle_frames")
+        _clear_dir(full_imgs_path)
+        for idx, frame in enumerate(frame_list_cycle):
+            cv2.imwrite(os.path.join(full_imgs_path, f"{idx:08d}.png"), frame)
+        stages.mark("cycle_frames", landmarks_fp)
+
+    _pickle_atomic(coords_path, coord_list_cycle)
+
+    # 5. Process Frames (Crop -> Resize -> VAE Latents)
+    if not (stages.is_current("latents", boxes_fp) and os.path.exists(latents_out_path)):
+        stages.invalidate("latents")
+        print("Processing latents...")
+        input_latent_list = []
+        for (x1, y1, x2, y2), frame in zip(valid_coord_list, valid_frame_list):
+            crop_frame = frame[y1:y2, x1:x2]
+            resized_crop_frame = cv2.resize(crop_frame, (256, 256), interpolation=cv2.INTER_LANCZOS4)
+            input_latent_list.append(vae.get_latents_for_unet(resized_crop_frame))
+        _write_atomic(latents_out_path, lambda tmp_path: torch.save(input_latent_list + input_latent_list[::-1], tmp_path))
+        stages.mark("latents", boxes_fp)
+    else:
+        print("Latents: cached")
+
+    # 6. Generate Masks
+    # The backward half of the cycle repeats the forward one, so masks are computed once per frame
+    if not (stages.is_current("masks", masks_fp) and os.path.exists(mask_coords_path)):
+        stages.invalidate("masks")
+        print("Generating masks...")
         mask_mode = parsing_mode if version == "v15" else "raw"
-        
-        # get_image_prepare_material returns (mask_array, crop_box)
-        mask, crop_box = get_image_prepare_material(frame, [x1, y1, x2, y2], fp=face_parser, mode=mask_mode)
-        
-        cv2.imwrite(os.path.join(mask_out_path, f"{i:08d}.png"), mask)
-        mask_coords_list_cycle.append(crop_box)
-        mask_list_cycle.append(mask)
-
-    # 6. Save State
-    print("Saving state...")
-    with open(mask_coords_path, 'wb') as f:
-        pickle.dump(mask_coords_list_cycle, f)
-
-    with open(coords_path, 'wb') as f:
-        pickle.dump(coord_list_cycle, f)
-
-    torch.save(input_latent_list_cycle, latents_out_path)
+        mask_list = []
+        mask_coords_list = []
+        for (x1, y1, x2, y2), frame in zip(tqdm(valid_coord_list), valid_frame_list):
+            # get_image_prepare_material returns (mask_array, crop_box)
+            mask, crop_box = get_image_prepare_material(frame, [x1, y1, x2, y2], fp=face_parser, mode=mask_mode)
+            mask_list.append(mask)
+            mask_coords_list.append(crop_box)
+
+        _clear_dir(mask_out_path)
+        for i, mask in enumerate(mask_list + mask_list[::-1]):
+            cv2.imwrite(os.path.join(mask_out_path, f"{i:08d}.png"), mask)
+        _pickle_atomic(mask_coords_path, mask_coords_list + mask_coords_list[::-1])
+        stages.mark("masks", masks_fp)
+    else:
+        print("Masks: cached")
+
     print(f"Avatar {avatar_id} preprocessing complete.")
+    return None
@@ -0,0 +1,159 @@
+import math
+import time
+import queue
+import threading
+import numpy as np
+from collections import deque
+from typing import Iterator, NamedTuple
+from musetalk_server.core.metrics import metrics
+from musetalk_server.services.audio import AudioClip
+
+_END = object()
+
+class StreamPart(NamedTuple):
+    """
+    Item of a real-time stream. Video frame `index` and audio chunk `index` share
+    the presentation timestamp `pts` (seconds from stream start, index / fps).
+    `payload` is JPEG bytes or a FramePatch for video, 16-bit big-endian PCM (L16) for audio.
+    """
+    kind: str
+    index: int
+    pts: float
+    payload: object
+
+def audio_chunks(audio: AudioClip, fps: int, num_frames: int) -> list:
+    """
+    Splits the clip into one L16 chunk per video frame; the last chunk carries any remainder.
+    """
+    pcm = (np.clip(audio.pcm, -1.0, 1.0) * 32767).astype(">i2")
+    bounds = [round(i * audio.sample_rate / fps) for i in range(num_frames)] + [len(pcm)]
+    return [pcm[bounds[i]:max(bounds[i], bounds[i + 1])].tobytes() for i in range(num_frames)]
+
+class RealtimePacer:
+    """
+    Paces a frame generator at `fps` against a jitter buffer and interleaves the
+    matching audio chunk before every frame.
+
+    A producer thread pulls frames into the buffer while the consumer waits for
+    deadlines, so the bursts the pipeline produces (a batch at a time) play out
+    evenly. `prebuffer` frames are buffered before the clock starts, and again
+    after an underrun (no frame buffered at its deadline): playback then stalls
+    and the clock is re-anchored, so later frames keep even spacing. `stats`
+    holds the per-stream counters once iteration ends.
+    """
+    def __init__(self, frames: Iterator, audio: AudioClip, fps: int, prebuffer: int, on_close=None):
+        self.frames = frames
+        self.interval = 1.0 / fps
+        self.prebuffer = max(1, prebuffer)
+        self.chunks = audio_chunks(audio, fps, math.floor(audio.duration * fps))
+        self.on_close = on_close
+        # Bounded so the pipeline runs at most a couple of jitter buffers ahead of playback
+        self._queue = queue.Queue(maxsize=2 * self.prebuffer)
+        self._stop = threading.Event()
+        self.error = None
+        self.stats = {
+            "frames": 0,
+            "prebuffer_frames": self.prebuffer,
+            "startup_ms": 0.0,
+            "underruns": 0,
+            "stall_ms": 0.0,
+            "late_frames": 0,
+            "max_lateness_ms": 0.0,
+        }
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self):
+        try:
+            for frame in self.frames:
+                if not self._put(frame):
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            close = getattr(self.frames, "close", None)
+            if close is not None:
+                close()
+            self._put(_END)
+
+    def _fill(self, buffer: deque, count: int) -> bool:
+        """Waits until `count` frames are buffered; False once the source is exhausted."""
+        while len(buffer) < count:
+            item = self._queue.get()
+            if item is _END:
+                return False
+            buffer.append(item)
+        return True
+
+    def _drain(self, buffer: deque) -> bool:
+        """Moves frames that are ready into the buffer without waiting."""
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return True
+            if item is _END:
+                return False
+            buffer.append(item)
+
+    def __iter__(self) -> Iterator[StreamPart]:
+        stats = self.stats
+        producer = threading.Thread(target=self._produce, daemon=True, name="realtime-producer")
+        producer.start()
+        buffer = deque()
+        started = time.monotonic()
+        try:
+            more = self._fill(buffer, self.prebuffer)
+            anchor = time.monotonic()
+            stats["startup_ms"] = round((anchor - started) * 1000, 2)
+            metrics.observe("realtime.startup_ms", stats["startup_ms"])
+            # Frame i is due at anchor + (i - anchor_index) / fps
+            anchor_index = 0
+            index = 0
+            while True:
+                if more:
+                    more = self._drain(buffer)
+                if not buffer:
+                    if not more:
+                        break
+                    # Underrun: the pipeline fell behind real time
+                    stall_start = time.monotonic()
+                    stats["underruns"] += 1
+                    metrics.inc("realtime.underruns")
+                    more = self._fill(buffer, self.prebuffer)
+                    if not buffer:
+                        break
+                    anchor = time.monotonic()
+                    anchor_index = index
+                    stats["stall_ms"] = round(stats["stall_ms"] + (anchor - stall_start) * 1000, 2)
+
+                due = anchor + (index - anchor_index) * self.interval
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                lateness = time.monotonic() - due
+                if lateness > self.interval / 2:
+                    stats["late_frames"] += 1
+                    metrics.inc("realtime.late_frames")
+                    stats["max_lateness_ms"] = max(stats["max_lateness_ms"], round(lateness * 1000, 2))
+                    metrics.observe("realtime.lateness_ms", lateness * 1000)
+
+                pts = index * self.interval
+                if index < len(self.chunks):
+                    yield StreamPart("audio", index, pts, self.chunks[index])
+                yield StreamPart("video", index, pts, buffer.popleft())
+                stats["frames"] += 1
+                index += 1
+            if self.error is not None:
+                raise self.error
+        finally:
+            self._stop.set()
+            if self.on_close is not None:
+                self.on_close()
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Optional
+from musetalk_server.conf import conf
+from musetalk_server.core.metrics import metrics
+
+class ResultCache:
+    """
+    Disk-backed cache of rendered batch videos, keyed by content (avatar id and
+    version, audio hash, render settings). It also owns eviction of the inference
+    output directory: files not requested for `ttl_seconds` are removed, then the
+    least recently used ones until the directory fits into `max_bytes`.
+    """
+    def __init__(self, root: str, max_bytes: int, ttl_seconds: float, enabled: bool = True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(avatar_id: str, avatar_version: str, audio_sha256: str, render_settings: dict) -> str:
+        """
+        Content-addressed key. `render_settings` must only hold settings that change
+        the rendered output (fps, version, ...), not throughput knobs like batch size.
+        """
+        payload = json.dumps({
+            "avatar_id": avatar_id,
+            "avatar_version": avatar_version,
+            "audio_sha256": audio_sha256,
+            "render": render_settings,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.mp4")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the cached file for `key` (refreshing its last-use time) or None.
+        """
+        path = self.path_for(key)
+        if self.enabled and os.path.isfile(path) and not self._expired(path, time.time()):
+            os.utime(path)
+            metrics.inc("result_cache.hits")
+            return path
+        metrics.inc("result_cache.misses")
+        return None
+
+    def put(self, key: str, rendered_path: str) -> str:
+        """
+        Moves a finished render into the cache and evicts old entries. The new
+        entry itself is kept, even when it alone exceeds the size limit, so the
+        caller can serve it; the next store evicts it.
+        """
+        path = self.path_for(key)
+        os.makedirs(self.root, exist_ok=True)
+        os.replace(rendered_path, path)
+        metrics.inc("result_cache.stores")
+        self.evict(keep=key)
+        return path
+
+    def _expired(self, path: str, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - os.path.getmtime(path) > self.ttl_seconds
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """
+        Applies TTL and size limits to the output directory, sparing the entry of
+        `keep`. Returns bytes freed.
+        """
+        if not os.path.isdir(self.root):
+            return 0
+        with self._lock:
+            now = time.time()
+            kept = self.path_for(keep) if keep is not None else None
+            entries = []
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                # Renders in progress live in tmp_* files/directories; leave them alone
+                if not os.path.isfile(path) or name.startswith("tmp_") or path == kept:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            freed = 0
+            total = sum(size for _, size, _ in entries)
+            if kept is not None and os.path.isfile(kept):
+                total += os.path.getsize(kept)
+            # Oldest first: expired entries, then LRU until under the size limit
+            for mtime, size, path in sorted(entries):
+                expired = self.ttl_seconds > 0 and now - mtime > self.ttl_seconds
+                oversize = self.max_bytes > 0 and total > self.max_bytes
+                if not (expired or oversize):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                freed += size
+                metrics.inc("result_cache.evictions")
+
+            metrics.inc("result_cache.evicted_bytes", freed)
+            metrics.set("result_cache.bytes", total)
+            return freed
+
+# Global instance for the batch inference output directory
+result_cache = ResultCache(
+    root=os.path.join(conf.result_dir, "inference"),
+    max_bytes=conf.result_cache_max_mb * 1024 * 1024,
+    ttl_seconds=conf.result_cache_ttl,
+    enabled=conf.result_cache_enabled,
+)
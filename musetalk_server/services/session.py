@@ -0,0 +1,372 @@
+import time
+import uuid
+import queue
+import threading
+import torch
+from typing import Callable, Generator, Optional
+from musetalk_server.conf import conf
+from musetalk_server.core.buffers import BufferSet
+from musetalk_server.core.metrics import metrics
+from musetalk_server.core.scheduler import gpu_scheduler
+from musetalk_server.routing import node_tag
+from musetalk_server.services.audio import AudioClip, WhisperChunkStream, iter_batches
+from musetalk_server.services.blending import make_blender
+from musetalk_server.services.inference import InferenceModels, validate_avatar, predict_batches, encode_frame
+
+_CLOSE = object()
+
+class AvatarSession:
+    """
+    A long-lived conversation with one avatar.
+
+    The avatar is validated, pinned and its latents placed once; the prediction
+    and blending workers run for the lifetime of the session and pick up
+    utterances as they are pushed. The cycle position carries over between
+    utterances, and while nothing is being said `frames()` plays the untouched
+    cycle frames (idle), so the avatar never jumps back to frame 0.
+
+    Frame accounting: an utterance reserves its frames at the cycle position
+    where the previous one (or the idle loop) will end; `pending_frames` counts
+    reserved frames not yet handed to the client. Idle frames are only emitted
+    while nothing is pending.
+    """
+    def __init__(
+        self,
+        session_id: str,
+        avatar, # musetalk_server.core.avatar.Avatar
+        models: InferenceModels,
+        device: torch.device,
+        fps: int = 25,
+        batch_size: int = 4,
+        audio_padding_left: int = 2,
+        audio_padding_right: int = 2,
+        latent_budget_mb: int = 0,
+        lip_stride: int = 1,
+        blend_backend: str = "cv2",
+        jpeg_splice: bool = False,
+        on_close: Optional[Callable[[], None]] = None
+    ):
+        self.session_id = session_id
+        self.avatar = avatar
+        self.models = models
+        self.device = device
+        self.fps = fps
+        self.batch_size = batch_size
+        self.lip_stride = lip_stride
+        self.blender = make_blender(blend_backend, device)
+        self.jpeg_splice = jpeg_splice
+        self.audio_padding_left = audio_padding_left
+        self.audio_padding_right = audio_padding_right
+        self._on_close = on_close
+
+        self.cycle_len = validate_avatar(avatar)
+        self.weight_dtype = models.unet.model.dtype
+        self.latent_cycle = avatar.latents_for(device, self.weight_dtype, latent_budget_mb)
+        avatar.pin()
+
+        self._lock = threading.Lock()
+        self.cycle_pos = 0
+        self.pending_frames = 0
+        self.utterances_pushed = 0
+        self.utterances_done = 0
+        self.streaming = False
+        self.created_at = self.last_active = time.time()
+
+        self._closed = threading.Event()
+        self._utterances = queue.Queue()
+        self._recon_queue = queue.Queue(maxsize=batch_size * 2)
+        self._frames = queue.Queue(maxsize=batch_size * 4)
+        # Each worker reuses its own buffers for the lifetime of the session
+        self._pred_buffers = BufferSet()
+        self._blend_buffers = BufferSet()
+
+        self._pred_thread = threading.Thread(target=self._prediction_worker, name=f"session-{session_id}-predict", daemon=True)
+        self._blend_thread = threading.Thread(target=self._blending_worker, name=f"session-{session_id}-blend", daemon=True)
+        self._pred_thread.start()
+        self._blend_thread.start()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def push(self, audio: AudioClip) -> int:
+        """
+        Queues decoded audio for lip-sync. Returns the utterance id.
+        """
+        if self.closed:
+            raise RuntimeError(f"Session {self.session_id} is closed")
+        with self._lock:
+            utterance_id = self.utterances_pushed
+            self.utterances_pushed += 1
+            self.last_active = time.time()
+        self._utterances.put((utterance_id, audio))
+        return utterance_id
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "session_id": self.session_id,
+                "avatar_id": self.avatar.avatar_id,
+                "cycle_position": self.cycle_pos % self.cycle_len,
+                "pending_frames": self.pending_frames,
+                "utterances_pushed": self.utterances_pushed,
+                "utterances_done": self.utterances_done,
+                "streaming": self.streaming,
+                "closed": self.closed,
+            }
+
+    def frames(self) -> Generator[bytes, None, None]:
+        """
+        Yields JPEG frames paced at `fps` until the session is closed: lip-synced
+        frames while an utterance is playing, idle cycle frames otherwise.
+        Only one consumer may read a session at a time.
+        """
+        with self._lock:
+            if self.streaming:
+                raise RuntimeError(f"Session {self.session_id} is already being streamed")
+            self.streaming = True
+        interval = 1.0 / self.fps
+        next_time = time.monotonic()
+        try:
+            while not self.closed:
+                delay = next_time - time.monotonic()
+                if delay > 0 and self._closed.wait(delay):
+                    break
+                data = self._next_frame(interval)
+                if data is None:
+                    # Waiting for the first batch of an utterance; don't build up a backlog
+                    metrics.inc("session.stall_ticks")
+                    next_time = time.monotonic()
+                    continue
+                next_time = max(next_time + interval, time.monotonic() - interval)
+                yield data
+        finally:
+            with self._lock:
+                self.streaming = False
+                self.last_active = time.time()
+
+    def _next_frame(self, timeout: float) -> Optional[bytes]:
+        with self._lock:
+            idle_idx = None
+            if self.pending_frames == 0:
+                idle_idx = self.cycle_pos
+                self.cycle_pos += 1
+        if idle_idx is not None:
+            metrics.inc("session.idle_frames")
+            return self.avatar.encoded_frame(idle_idx)
+        try:
+            data = self._frames.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            self.cycle_pos += 1
+            self.pending_frames -= 1
+            self.last_active = time.time()
+        return data
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """Blocking put that gives up once the session is closed."""
+        while not self.closed:
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _prediction_worker(self):
+        while True:
+            item = self._utterances.get()
+            if item is _CLOSE or self.closed:
+                break
+            utterance_id, audio = item
+            reserved = produced = 0
+            try:
+                start_time = time.time()
+                whisper_chunks = WhisperChunkStream(
+                    self.models.audio_processor,
+                    self.models.whisper,
+                    audio.whisper_input(),
+                    self.device,
+                    self.weight_dtype,
+                    fps=self.fps,
+                    audio_padding_left=self.audio_padding_left,
+                    audio_padding_right=self.audio_padding_right,
+                )
+                reserved = len(whisper_chunks)
+                with self._lock:
+                    start = self.cycle_pos + self.pending_frames
+                    self.pending_frames += reserved
+                cycle_index = torch.arange(start, start + reserved, device=self.latent_cycle.device) % self.cycle_len
+
+                # Utterances are live audio: interactive batches, due at playback speed
+                ticket = gpu_scheduler.ticket("interactive", fps=self.fps)
+                for recon in ticket.iterate(self._render(whisper_chunks, start, cycle_index), lambda: self.closed):
+                    if produced == 0:
+                        metrics.observe("session.first_frame_ms", (time.time() - start_time) * 1000)
+                    for res_frame in recon:
+                        if produced >= reserved:
+                            break
+                        if not self._put(self._recon_queue, (start + produced, res_frame)):
+                            return
+                        produced += 1
+            except Exception as e:
+                print(f"Session {self.session_id} utterance {utterance_id} failed: {e}")
+            finally:
+                if produced < reserved:
+                    # Give back frames that will never arrive so idle playback resumes
+                    with self._lock:
+                        self.pending_frames -= reserved - produced
+                with self._lock:
+                    self.utterances_done += 1
+
+    def _render(self, whisper_chunks: WhisperChunkStream, start: int, cycle_index: torch.Tensor):
+        """Device work of an utterance, one batch per item (a scheduler turn each)."""
+        batches = iter_batches(iter(whisper_chunks), self.batch_size)
+        frame = start
+        for recon in predict_batches(self.models, batches, self.latent_cycle, cycle_index, self.device,
+                                     self.lip_stride, self._pred_buffers, as_tensor=self.blender is not None):
+            if self.blender is not None:
+                recon = self.blender.blend(self.avatar, recon, range(frame, frame + len(recon)), self._pred_buffers)
+            frame += len(recon)
+            yield recon
+
+    def _blending_worker(self):
+        while True:
+            try:
+                item = self._recon_queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.closed:
+                    break
+                continue
+            cycle_idx, res_frame = item
+            try:
+                data = encode_frame(self.avatar, res_frame, cycle_idx, self.jpeg_splice, self._blend_buffers)
+            except Exception as e:
+                print(f"Session {self.session_id}: error blending frame {cycle_idx}: {e}")
+                data = None
+            if data is None:
+                # Every reserved frame must be delivered; fall back to the idle frame
+                data = self.avatar.encoded_frame(cycle_idx)
+            if not self._put(self._frames, data):
+                break
+
+    def close(self):
+        """
+        Stops the workers, drops queued utterances and unpins the avatar.
+        """
+        if self.closed:
+            return
+        self._closed.set()
+        while True:
+            try:
+                self._utterances.get_nowait()
+            except queue.Empty:
+                break
+        self._utterances.put(_CLOSE)
+        self._pred_thread.join(timeout=5)
+        self._blend_thread.join(timeout=5)
+        self.avatar.unpin()
+        if self._on_close is not None:
+            self._on_close()
+
+class SessionManager:
+    """
+    Registry of open sessions, with a limit and an idle timeout. Session ids
+    start with `id_prefix` (the node tag when routing between nodes).
+    """
+    def __init__(self, max_sessions: int, idle_timeout: float, id_prefix: str = ""):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.id_prefix = id_prefix
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def create(self, avatar, models: dict, settings, batch_size: int | None = None,
+               lip_stride: int | None = None, on_close: Optional[Callable[[], None]] = None) -> AvatarSession:
+        with self._lock:
+            if self.max_sessions > 0 and len(self._sessions) >= self.max_sessions:
+                raise RuntimeError(f"Session limit reached ({self.max_sessions})")
+            session_id = f"{self.id_prefix}-{uuid.uuid4().hex}" if self.id_prefix else uuid.uuid4().hex
+            session = AvatarSession(
+                session_id,
+                avatar,
+                InferenceModels(
+                    vae=models['vae'],
+                    unet=models['unet'],
+                    pe=models['pe'],
+                    audio_processor=models['audio_processor'],
+                    whisper=models['whisper'],
+                    timesteps=models['timesteps'],
+                    engine=models.get('engine')
+                ),
+                device=models['device'],
+                fps=settings.fps,
+                batch_size=batch_size if batch_size is not None else settings.batch_size,
+                audio_padding_left=settings.audio_padding_length_left,
+                audio_padding_right=settings.audio_padding_length_right,
+                latent_budget_mb=settings.latent_device_budget_mb,
+                lip_stride=lip_stride if lip_stride is not None else settings.lip_stride,
+                blend_backend=settings.blend_backend,
+                jpeg_splice=settings.jpeg_splice,
+                on_close=on_close
+            )
+            self._sessions[session_id] = session
+            metrics.set("session.open", len(self._sessions))
+        return session
+
+    def get(self, session_id: str) -> Optional[AvatarSession]:
+        return self._sessions.get(session_id)
+
+    def close(self, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            metrics.set("session.open", len(self._sessions))
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def list(self) -> list:
+        return list(self._sessions.values())
+
+    def close_idle(self, timeout: float | None = None) -> list:
+        """
+        Closes sessions nobody streamed from or pushed to for `timeout` seconds.
+        """
+        timeout = self.idle_timeout if timeout is None else timeout
+        now = time.time()
+        idle = [s.session_id for s in self.list() if not s.streaming and now - s.last_active > timeout]
+        for session_id in idle:
+            print(f"Closing idle session {session_id}")
+            self.close(session_id)
+        return idle
+
+    def start_idle_reaper(self):
+        """
+        Starts a daemon thread that closes idle sessions.
+        Disabled when MUSETALK_SESSION_IDLE_TIMEOUT is 0.
+        """
+        if self.idle_timeout <= 0 or self._reaper is not None:
+            return
+        interval = min(max(self.idle_timeout / 4, 1.0), 30.0)
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.close_idle()
+                except Exception as e:
+                    print(f"Idle session reaper error: {e}")
+
+        self._reaper = threading.Thread(target=reap, name="session-idle-reaper", daemon=True)
+        self._reaper.start()
+
+    def close_all(self):
+        for session in self.list():
+            self.close(session.session_id)
+
+# Global registry of open sessions
+session_manager = SessionManager(max_sessions=conf.max_sessions, idle_timeout=conf.session_idle_timeout,
+                                 id_prefix=node_tag(conf.route_self_url) if conf.route_self_url else "")
@@ -0,0 +1,98 @@
+import os
+import json
+import glob
+import time
+import uuid
+import hashlib
+import threading
+from typing import BinaryIO, Tuple
+from musetalk_server.conf import conf
+from musetalk_server.core.metrics import metrics
+
+class UploadStore:
+    """
+    Content-addressed storage for uploaded source videos: files are hashed while
+    they stream to disk and stored as `{sha256}{ext}`, so the same video uploaded
+    twice (under any avatar id or filename) is kept once. Uploads no avatar refers
+    to (avator_info.json "video_path") are garbage-collected after a grace period.
+    """
+    def __init__(self, root: str, grace_seconds: float):
+        self.root = root
+        self.grace_seconds = grace_seconds
+        self._lock = threading.Lock()
+
+    def save(self, fileobj: BinaryIO, filename: str = "") -> Tuple[str, str]:
+        """
+        Streams `fileobj` into the store. Returns (sha256 hex digest, stored path).
+        """
+        os.makedirs(self.root, exist_ok=True)
+        ext = os.path.splitext(filename)[1].lower()
+        tmp_path = os.path.join(self.root, f"tmp_{uuid.uuid4().hex}{ext}")
+        digest = hashlib.sha256()
+        try:
+            with open(tmp_path, "wb") as buffer:
+                while chunk := fileobj.read(1024 * 1024):
+                    digest.update(chunk)
+                    buffer.write(chunk)
+            sha256 = digest.hexdigest()
+            path = os.path.join(self.root, f"{sha256}{ext}")
+            with self._lock:
+                if os.path.exists(path):
+                    metrics.inc("uploads.deduplicated")
+                    # Refresh so a pending GC doesn't collect it before it is referenced
+                    os.utime(path)
+                else:
+                    os.replace(tmp_path, path)
+                    metrics.inc("uploads.stored")
+            return sha256, path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def referenced(self, results_dir: str) -> set:
+        """
+        Absolute paths of uploads referenced by any avatar (all versions).
+        """
+        paths = set()
+        for info_path in glob.glob(os.path.join(results_dir, "*", "avatars", "*", "avator_info.json")):
+            try:
+                with open(info_path, "r") as f:
+                    video_path = json.load(f).get("video_path")
+            except (OSError, ValueError):
+                continue
+            if video_path:
+                paths.add(os.path.abspath(video_path))
+        return paths
+
+    def gc(self, results_dir: str) -> list:
+        """
+        Removes uploads no avatar refers to and older than the grace period
+        (which covers uploads whose preprocessing is still running).
+        """
+        if not os.path.isdir(self.root):
+            return []
+        with self._lock:
+            referenced = self.referenced(results_dir)
+            now = time.time()
+            removed = []
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                if not os.path.isfile(path) or os.path.abspath(path) in referenced:
+                    continue
+                try:
+                    if now - os.path.getmtime(path) < self.grace_seconds:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed.append(name)
+            metrics.inc("uploads.collected", len(removed))
+            if removed:
+                print(f"Removed {len(removed)} unreferenced upload(s)")
+            return removed
+
+# Global instance for results/uploads
+upload_store = UploadStore(
+    root=os.path.join(conf.result_dir, "uploads"),
+    grace_seconds=conf.upload_gc_grace,
+)
@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from musetalk_server.core.metrics import metrics
+
+# Touched whenever an avatar is served; its mtime orders avatars for MUSETALK_PRELOAD_RECENT
+LAST_USED_FILE = "last_used"
+
+def mark_used(avatar_path: str):
+    path = os.path.join(avatar_path, LAST_USED_FILE)
+    try:
+        with open(path, "a"):
+            pass
+        os.utime(path)
+    except OSError:
+        pass
+
+def recent_avatars(avatars_root: str, count: int) -> list:
+    """
+    Ids of the `count` most recently used avatars (never used ones by build time).
+    """
+    if count <= 0 or not os.path.isdir(avatars_root):
+        return []
+
+    def last_used(avatar_id):
+        for name in (LAST_USED_FILE, "avator_info.json"):
+            path = os.path.join(avatars_root, avatar_id, name)
+            if os.path.exists(path):
+                return os.path.getmtime(path)
+        return 0.0
+
+    ids = [d for d in os.listdir(avatars_root) if os.path.isdir(os.path.join(avatars_root, d))]
+    return sorted(ids, key=last_used, reverse=True)[:count]
+
+def preload_list(avatar_ids: str, recent: int, avatars_root: str) -> list:
+    """
+    Avatars to warm up: the configured ids (comma-separated) followed by the most recently used ones.
+    """
+    ids = [a.strip() for a in avatar_ids.split(",") if a.strip()]
+    for avatar_id in recent_avatars(avatars_root, recent):
+        if avatar_id not in ids:
+            ids.append(avatar_id)
+    return ids
+
+class Warmup:
+    """
+    Loads avatars in the background after startup and reports when they are warm.
+    Avatars load concurrently (`parallel` at a time); each decodes its images on
+    its own thread pool (see Avatar.load_state). Failures are logged and don't
+    block readiness.
+    """
+    def __init__(self):
+        self.pending: list = []
+        self.loaded: list = []
+        self.failed: list = []
+        self._done = threading.Event()
+        self._done.set()
+
+    @property
+    def is_done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def run(self, avatar_ids: list, load, parallel: int = 2):
+        """
+        Calls `load(avatar_id)` for each id; `load` returns a falsy value on failure.
+        """
+        self.pending = list(avatar_ids)
+        self._done.clear()
+        start = time.perf_counter()
+
+        def warm(avatar_id):
+            try:
+                ok = load(avatar_id)
+            except Exception as e:
+                print(f"Failed to preload avatar {avatar_id}: {e}")
+                ok = False
+            (self.loaded if ok else self.failed).append(avatar_id)
+            self.pending.remove(avatar_id)
+
+        try:
+            if avatar_ids:
+                with ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix="avatar-warmup") as pool:
+                    list(pool.map(warm, avatar_ids))
+                elapsed = time.perf_counter() - start
+                metrics.set("warmup.seconds", elapsed)
+                print(f"Preloaded {len(self.loaded)}/{len(avatar_ids)} avatar(s) in {elapsed:.1f}s")
+        finally:
+            self._done.set()
+
+    def start(self, avatar_ids: list, load, parallel: int = 2) -> threading.Thread:
+        self.pending = list(avatar_ids)
+        self._done.clear()
+        thread = threading.Thread(target=self.run, args=(avatar_ids, load, parallel),
+                                  daemon=True, name="avatar-warmup")
+        thread.start()
+        return thread
+
+warmup = Warmup()
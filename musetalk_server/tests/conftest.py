@@ -0,0 +1,127 @@
+import os
+import pickle
+import types
+import cv2
+import numpy as np
+import pytest
+import torch
+from musetalk_server.services.audio import SAMPLE_RATE
+
+# Stand-ins shared across test modules. Import the helpers from here
+# (from musetalk_server.tests.conftest import write_avatar); fixtures are
+# picked up by pytest.
+
+
+# A tiny synthetic avatar directory laid out like services/preprocess.py writes it.
+
+CYCLE_LEN = 6
+
+
+def write_avatar(results_dir, avatar_id="tiny", version="v15", cycle_len=CYCLE_LEN, size=(48, 64)):
+    base = os.path.join(results_dir, version, "avatars", avatar_id)
+    os.makedirs(os.path.join(base, "full_imgs"))
+    os.makedirs(os.path.join(base, "mask"))
+    h, w = size
+    coords, mask_coords, latents = [], [], []
+    for i in range(cycle_len):
+        frame = np.full((h, w, 3), i * 10, dtype=np.uint8)
+        cv2.imwrite(os.path.join(base, "full_imgs", f"{i:08d}.png"), frame)
+        cv2.imwrite(os.path.join(base, "mask", f"{i:08d}.png"), np.full((24, 24, 3), 255, dtype=np.uint8))
+        coords.append([8, 8, 40, 40])
+        mask_coords.append([4, 4, 28, 28])
+        latents.append(torch.full((1, 8, 32, 32), float(i)))
+    with open(os.path.join(base, "coords.pkl"), "wb") as f:
+        pickle.dump(coords, f)
+    with open(os.path.join(base, "mask_coords.pkl"), "wb") as f:
+        pickle.dump(mask_coords, f)
+    torch.save(latents, os.path.join(base, "latents.pt"))
+    with open(os.path.join(base, "avator_info.json"), "w") as f:
+        f.write('{"avatar_id": "%s", "bbox_shift": 0, "version": "%s"}' % (avatar_id, version))
+    return base
+
+
+# Whisper stand-ins keeping its shapes (30 s windows, 3000 mel frames -> 1500
+# positions, 5 hidden states) with position-dependent values.
+
+
+class FakeFeatureExtractor:
+    def __call__(self, segment, return_tensors="pt", sampling_rate=SAMPLE_RATE):
+        padded = np.zeros(30 * SAMPLE_RATE, dtype=np.float32)
+        padded[:len(segment)] = segment
+        mel = torch.from_numpy(padded.reshape(3000, 160).mean(axis=1))
+        return types.SimpleNamespace(input_features=mel.reshape(1, 1, 3000).repeat(1, 80, 1))
+
+
+class FakeEncoder:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, input_features, output_hidden_states=True):
+        self.calls += 1
+        pos = input_features[:, 0].reshape(1, 1500, 2).mean(dim=2)
+        hidden = [pos[..., None] * (layer + 1) + torch.arange(384) * 1e-3 for layer in range(5)]
+        return types.SimpleNamespace(hidden_states=tuple(hidden))
+
+
+# Tiny modules with the same call signatures as the upstream PE / UNet / VAE,
+# so engine tests run on CPU without model weights.
+
+
+class _TinyPE(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.register_buffer("pe", torch.linspace(-1, 1, 50 * 384).reshape(1, 50, 384))
+
+    def forward(self, x):
+        return x + self.pe[:, :x.size(1)]
+
+
+class _DtypeMixin:
+    """diffusers ModelMixin exposes the parameter dtype."""
+
+    @property
+    def dtype(self):
+        return next(self.parameters()).dtype
+
+
+class _TinyUNetModel(_DtypeMixin, torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(8, 4, 3, padding=1)
+        self.proj = torch.nn.Linear(384, 4)
+
+    def forward(self, sample, timestep, encoder_hidden_states):
+        bias = self.proj(encoder_hidden_states).mean(dim=1)[:, :, None, None]
+        return types.SimpleNamespace(sample=self.conv(sample) + bias + timestep.float().mean())
+
+
+class _TinyAutoencoder(_DtypeMixin, torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.up = torch.nn.ConvTranspose2d(4, 3, 8, stride=8)
+
+    def decode(self, z):
+        return types.SimpleNamespace(sample=torch.tanh(self.up(z)))
+
+
+class _TinyVAE:
+    """Mirrors musetalk.models.vae.VAE.decode_latents."""
+    scaling_factor = 0.18215
+
+    def __init__(self):
+        self.vae = _TinyAutoencoder().eval()
+
+    def decode_latents(self, latents):
+        latents = (1 / self.scaling_factor) * latents
+        image = self.vae.decode(latents.to(self.vae.dtype)).sample
+        image = (image / 2 + 0.5).clamp(0, 1)
+        image = image.detach().cpu().permute(0, 2, 3, 1).float().numpy()
+        image = (image * 255).round().astype("uint8")
+        return image[..., ::-1]
+
+
+@pytest.fixture
+def tiny_models():
+    torch.manual_seed(0)
+    unet = types.SimpleNamespace(model=_TinyUNetModel().eval())
+    return _TinyPE().eval(), unet, _TinyVAE(), torch.tensor([0])
@@ -1,6 +1,18 @@
+import json
+import time
+import types
+import asyncio
+import threading
+import contextlib
+import httpx
 import pytest
 from fastapi.testclient import TestClient
 from musetalk_server.app import app
+from musetalk_server.routers import avatars, inference, jobs
+from musetalk_server.core.avatar_store import AvatarStore, FileBackend
+from musetalk_server.core.model_loader import model_loader
+from musetalk_server.services.result_cache import ResultCache
+from musetalk_server.services.inference import InferenceCancelled
 
 # Tests run without GPU — verify API contract, validation, and error handling.
 # Full integration tests (preprocessing, inference) require models and GPU.
@@ -20,10 +32,32 @@ class TestHealthEndpoint:
     def test_response_schema(self):
         data = client.get("/health").json()
         assert data["status"] == "running"
+        assert isinstance(data["ready"], bool)
         assert isinstance(data["models"]["loaded"], bool)
         assert isinstance(data["models"]["device"], str)
         assert isinstance(data["loaded_avatars"], list)
 
+    def test_reports_role(self):
+        data = client.get("/health").json()
+        assert data["models"]["role"] in ("inference", "preprocess", "all")
+        assert isinstance(data["models"]["components"], list)
+
+
+    def test_not_ready_without_models(self):
+        # The lifespan (model loading) doesn't run for this client
+        data = client.get("/health").json()
+        assert data["status"] == "running"
+        assert data["ready"] is False
+        response = client.get("/health/ready")
+        assert response.status_code == 503
+        assert response.json() == {"status": "starting"}
+
+
+class TestMetricsEndpoint:
+    def test_returns_registry_snapshot(self):
+        data = client.get("/metrics").json()
+        assert set(data) == {"counters", "gauges", "summaries"}
+
 
 # ---------------------------------------------------------------------------
 # Avatars - Listing
@@ -210,3 +244,238 @@ class TestBatchInference:
             files={"audio_file": ("test.wav", b"fake audio", "audio/wav")},
         )
         assert response.status_code == 404
+
+    def test_accepts_progressive_flag(self):
+        """progressive is a boolean form field (404 because avatar doesn't exist)."""
+        response = client.post(
+            "/inference/batch/nonexistent_avatar",
+            data={"progressive": "true"},
+            files={"audio_file": ("test.wav", b"fake audio", "audio/wav")},
+        )
+        assert response.status_code == 404
+
+    def test_rejects_invalid_progressive_flag(self):
+        response = client.post(
+            "/inference/batch/nonexistent_avatar",
+            data={"progressive": "sometimes"},
+            files={"audio_file": ("test.wav", b"fake audio", "audio/wav")},
+        )
+        assert response.status_code == 422
+
+
+class _FakeService:
+    """InferenceService stand-in; `renders` gates when batch renders may finish."""
+
+    def __init__(self, models, settings, **overrides):
+        self.batch_size = 4
+
+    def render_settings(self):
+        return {}
+
+    def inference_batch(self, avatar, audio, output_path, cancel=None, priority=None):
+        self.renders.wait(timeout=5)
+        with open(output_path, "wb") as f:
+            f.write(b"mp4")
+        self.finished.append("batch")
+
+    def inference_stream(self, avatar, audio, patch_mode=False, cancel=None, priority=None):
+        yield b"jpeg"
+        self.finished.append("stream")
+        self.renders.set()
+
+
+@pytest.fixture
+def fake_renders(tmp_path, monkeypatch):
+    """Routes the inference endpoints to _FakeService for an avatar "anna"."""
+    avatar = types.SimpleNamespace(avatar_id="anna", content_version="v1")
+    monkeypatch.setattr(inference, "get_avatar", lambda avatar_id: avatar)
+    monkeypatch.setattr(inference, "decode_audio", lambda data, ffmpeg_path: object())
+    monkeypatch.setattr(inference, "InferenceService", _FakeService)
+    monkeypatch.setattr(inference, "result_cache", ResultCache(str(tmp_path), 0, 0))
+    monkeypatch.setattr(model_loader, "get_models", lambda components=None: {})
+    monkeypatch.setattr(model_loader, "hold", lambda components=None: contextlib.nullcontext())
+    monkeypatch.setattr(_FakeService, "renders", threading.Event(), raising=False)
+    monkeypatch.setattr(_FakeService, "finished", [], raising=False)
+    return _FakeService
+
+
+async def _post_together(*paths):
+    """Posts to the paths concurrently on one event loop, like clients of one server."""
+    files = {"audio_file": ("test.wav", b"fake audio", "audio/wav")}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+        return await asyncio.gather(*(http.post(path, files=files) for path in paths))
+
+
+class TestRendersShareTheEventLoop:
+    def test_stream_is_served_while_a_batch_renders(self, fake_renders):
+        # The batch render only finishes once the stream has been served
+        batch, stream = asyncio.run(_post_together("/inference/batch/anna", "/inference/stream/anna"))
+        assert batch.status_code == 200 and batch.content == b"mp4"
+        assert stream.status_code == 200 and b"jpeg" in stream.content
+        assert fake_renders.finished == ["stream", "batch"]
+
+    def test_vanished_cache_hit_is_rendered_again(self, fake_renders, monkeypatch, tmp_path):
+        fake_renders.renders.set()
+        monkeypatch.setattr(inference.result_cache, "get", lambda key: str(tmp_path / "evicted.mp4"))
+        response = client.post("/inference/batch/anna", files={"audio_file": ("test.wav", b"fake audio", "audio/wav")})
+        assert response.status_code == 200 and response.content == b"mp4"
+        assert response.headers["x-cache"] == "MISS"
+        assert fake_renders.finished == ["batch"]
+
+    def test_client_disconnect_cancels_a_batch_render(self, fake_renders, monkeypatch):
+        monkeypatch.setattr(inference, "DISCONNECT_POLL_INTERVAL", 0.05)
+        cancels = []
+
+        def inference_batch(self, avatar, audio, output_path, cancel=None, priority=None):
+            cancels.append(cancel)
+            deadline = time.monotonic() + 5
+            while not cancel.cancelled and time.monotonic() < deadline:
+                time.sleep(0.01)
+            raise InferenceCancelled(f"Inference cancelled: {cancel.reason}")
+
+        monkeypatch.setattr(fake_renders, "inference_batch", inference_batch)
+        upload = httpx.Request("POST", "http://test/inference/batch/anna",
+                               files={"audio_file": ("test.wav", b"fake audio", "audio/wav")})
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+                 "scheme": "http", "path": "/inference/batch/anna", "raw_path": b"/inference/batch/anna",
+                 "query_string": b"", "root_path": "", "server": ("test", 80), "client": ("client", 1),
+                 "headers": [(k.lower().encode(), v.encode()) for k, v in upload.headers.items()]}
+        hang_up = time.monotonic() + 0.2
+        body = [{"type": "http.request", "body": upload.read(), "more_body": False}]
+
+        async def receive():
+            if body:
+                return body.pop()
+            if time.monotonic() < hang_up:
+                await asyncio.sleep(3600)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            pass
+
+        started = time.monotonic()
+        asyncio.run(app(scope, receive, send))
+        assert cancels[0].reason == "disconnect"
+        assert time.monotonic() - started < 2
+
+
+# ---------------------------------------------------------------------------
+# Jobs
+# ---------------------------------------------------------------------------
+
+class TestJobs:
+    def _submit(self, avatar_id):
+        manifest = {"items": [{"avatar_id": avatar_id, "audio": "a.wav"}]}
+        return client.post("/jobs", data={"manifest": json.dumps(manifest)},
+                           files=[("audio_files", ("a.wav", b"fake audio", "audio/wav"))])
+
+    def test_missing_avatar_returns_404(self):
+        assert self._submit("nonexistent_avatar").status_code == 404
+
+    def test_accepts_avatar_only_in_the_store(self, tmp_path, monkeypatch):
+        backend = FileBackend(str(tmp_path / "remote"))
+        backend.write("v15/avatars/anna.json", json.dumps({"avatar_id": "anna", "sha256": "0"}).encode())
+        monkeypatch.setattr(avatars, "avatar_store", AvatarStore(backend, str(tmp_path / "avatars")))
+        submitted = []
+        monkeypatch.setattr(jobs.job_manager, "submit", lambda job: submitted.append(job) or job)
+        assert self._submit("anna").status_code == 200
+        assert [item["avatar_id"] for item in submitted[0].items] == ["anna"]
+
+
+# ---------------------------------------------------------------------------
+# Sessions (missing avatar / session & validation)
+# ---------------------------------------------------------------------------
+
+class TestSessions:
+    def test_create_with_missing_avatar_returns_404(self):
+        response = client.post("/sessions", data={"avatar_id": "nonexistent_avatar"})
+        assert response.status_code == 404
+
+    def test_create_rejects_invalid_avatar_id(self):
+        response = client.post("/sessions", data={"avatar_id": "../etc/passwd"})
+        assert response.status_code == 400
+
+    @pytest.mark.parametrize("bad_batch_size", [0, 33])
+    def test_create_rejects_invalid_batch_size(self, bad_batch_size):
+        response = client.post("/sessions", data={"avatar_id": "nonexistent_avatar", "batch_size": str(bad_batch_size)})
+        assert response.status_code == 422
+
+    def test_list_sessions(self):
+        response = client.get("/sessions")
+        assert response.status_code == 200
+        assert isinstance(response.json(), list)
+
+    @pytest.mark.parametrize("method, path", [
+        ("get", "/sessions/unknown"),
+        ("get", "/sessions/unknown/stream"),
+        ("delete", "/sessions/unknown"),
+    ])
+    def test_unknown_session_returns_404(self, method, path):
+        assert getattr(client, method)(path).status_code == 404
+
+    def test_push_to_unknown_session_returns_404(self):
+        response = client.post(
+            "/sessions/unknown/utterances",
+            files={"audio_file": ("test.wav", b"fake audio", "audio/wav")},
+        )
+        assert response.status_code == 404
+
+
+class TestLipStride:
+    @pytest.mark.parametrize("path", ["/inference/stream/nonexistent_avatar", "/inference/batch/nonexistent_avatar"])
+    @pytest.mark.parametrize("bad_stride", [0, 5])
+    def test_rejects_invalid_lip_stride(self, path, bad_stride):
+        response = client.post(
+            path,
+            data={"lip_stride": str(bad_stride)},
+            files={"audio_file": ("test.wav", b"fake audio", "audio/wav")},
+        )
+        assert response.status_code == 422
+
+    @pytest.mark.parametrize("path", ["/inference/stream/nonexistent_avatar", "/inference/batch/nonexistent_avatar"])
+    def test_accepts_valid_lip_stride(self, path):
+        response = client.post(
+            path,
+            data={"lip_stride": "2"},
+            files={"audio_file": ("test.wav", b"fake audio", "audio/wav")},
+        )
+        assert response.status_code == 404
+
+
+class TestPatchMode:
+    def test_rejects_unknown_stream_mode(self):
+        response = client.post(
+            "/inference/stream/nonexistent_avatar",
+            data={"mode": "tiles"},
+            files={"audio_file": ("test.wav", b"fake audio", "audio/wav")},
+        )
+        assert response.status_code == 422
+
+    def test_accepts_patch_mode(self):
+        response = client.post(
+            "/inference/stream/nonexistent_avatar",
+            data={"mode": "patch"},
+            files={"audio_file": ("test.wav", b"fake audio", "audio/wav")},
+        )
+        assert response.status_code == 404
+
+    @pytest.mark.parametrize("path", [
+        "/avatars/nonexistent_avatar/bundle",
+        "/avatars/nonexistent_avatar/bundle/manifest",
+        "/avatars/nonexistent_avatar/bundle/frames/0",
+    ])
+    def test_bundle_of_missing_avatar_returns_404(self, path):
+        assert client.get(path).status_code == 404
+
+    def test_bundle_rejects_invalid_avatar_id(self):
+        assert client.get(f"/avatars/{'a' * 65}/bundle").status_code == 400
+
+
+class TestReprocess:
+    def test_missing_avatar_returns_404(self):
+        response = client.post("/avatars/nonexistent_avatar/reprocess", data={"bbox_shift": "5"})
+        assert response.status_code == 404
+
+    def test_rejects_invalid_avatar_id(self):
+        response = client.post(f"/avatars/{'a' * 65}/reprocess", data={"bbox_shift": "5"})
+        assert response.status_code == 400
@@ -0,0 +1,119 @@
+import math
+import shutil
+import subprocess
+import types
+import librosa
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+from musetalk_server.services.audio import (
+    SAMPLE_RATE, AudioDecodeError, WhisperChunkStream, decode_audio, iter_batches
+)
+from musetalk_server.tests.conftest import FakeEncoder, FakeFeatureExtractor
+
+# The chunked path must reproduce upstream AudioProcessor.get_audio_feature +
+# get_whisper_chunk exactly, checked here with the Whisper stand-ins from conftest.
+
+
+def _reference_chunks(ap, whisper, audio, fps=25, pad_left=2, pad_right=2):
+    """One-shot path, as in upstream musetalk/utils/audio_processor.py."""
+    segment_length = 30 * SAMPLE_RATE
+    segments = [audio[i:i + segment_length] for i in range(0, len(audio), segment_length)]
+    features = [ap.feature_extractor(s, return_tensors="pt", sampling_rate=SAMPLE_RATE).input_features for s in segments]
+
+    feature_length_per_frame = 2 * (pad_left + pad_right + 1)
+    whisper_feature = torch.cat(
+        [torch.stack(whisper.encoder(f, output_hidden_states=True).hidden_states, dim=2) for f in features], dim=1
+    )
+    whisper_idx_multiplier = 50 / fps
+    num_frames = math.floor((len(audio) / SAMPLE_RATE) * fps)
+    actual_length = math.floor((len(audio) / SAMPLE_RATE) * 50)
+    whisper_feature = whisper_feature[:, :actual_length, ...]
+    padding_nums = math.ceil(whisper_idx_multiplier)
+    whisper_feature = torch.cat([
+        torch.zeros_like(whisper_feature[:, :padding_nums * pad_left]),
+        whisper_feature,
+        torch.zeros_like(whisper_feature[:, :padding_nums * 3 * pad_right]),
+    ], 1)
+    prompts = []
+    for frame_index in range(num_frames):
+        audio_index = math.floor(frame_index * whisper_idx_multiplier)
+        prompts.append(whisper_feature[:, audio_index:audio_index + feature_length_per_frame])
+    prompts = torch.cat(prompts, dim=0)
+    return prompts.reshape(prompts.shape[0], -1, prompts.shape[-1])
+
+
+@pytest.fixture
+def models():
+    ap = types.SimpleNamespace(feature_extractor=FakeFeatureExtractor())
+    whisper = types.SimpleNamespace(encoder=FakeEncoder())
+    return ap, whisper
+
+
+def _audio(seconds):
+    rng = np.random.default_rng(0)
+    return rng.standard_normal(int(seconds * SAMPLE_RATE)).astype(np.float32)
+
+
+class TestWhisperChunkStream:
+    @pytest.mark.parametrize("seconds", [3.3, 30.0, 65.7])
+    def test_matches_one_shot_features(self, models, seconds):
+        ap, whisper = models
+        audio = _audio(seconds)
+        expected = _reference_chunks(ap, whisper, audio)
+
+        stream = WhisperChunkStream(ap, whisper, audio, torch.device("cpu"), torch.float32)
+        chunked = torch.cat(list(stream), dim=0)
+
+        assert len(stream) == expected.shape[0]
+        assert torch.equal(chunked, expected)
+
+    def test_first_frames_need_one_window(self, models):
+        ap, whisper = models
+        whisper.encoder.calls = 0
+        stream = WhisperChunkStream(ap, whisper, _audio(95), torch.device("cpu"), torch.float32)
+        first = next(iter(stream))
+        assert whisper.encoder.calls == 1
+        assert first.shape[1:] == (50, 384)
+
+
+def test_iter_batches_regroups_chunks():
+    chunks = [torch.arange(n).float().reshape(n, 1) for n in (3, 5, 1, 2)]
+    batches = list(iter_batches(iter(chunks), 4))
+    assert [b.shape[0] for b in batches] == [4, 4, 3]
+    assert torch.equal(torch.cat(batches), torch.cat(chunks))
+
+
+def _tone(seconds, sample_rate, channels):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    return np.stack([np.sin(2 * np.pi * 220 * (c + 1) * t) * 0.3 for c in range(channels)], axis=1).astype(np.float32)
+
+
+class TestDecodeAudio:
+    def test_matches_librosa_file_path(self, tmp_path):
+        path = tmp_path / "clip.wav"
+        sf.write(path, _tone(1.3, 22050, 2), 22050)
+        expected, _ = librosa.load(path, sr=SAMPLE_RATE)
+        clip = decode_audio(path.read_bytes())
+        assert (clip.sample_rate, clip.channels) == (22050, 2)
+        np.testing.assert_array_equal(clip.whisper_input(), expected)
+
+    def test_native_16k_mono_is_passed_through(self, tmp_path):
+        path = tmp_path / "clip.flac"
+        audio = _tone(0.5, SAMPLE_RATE, 1)
+        sf.write(path, audio, SAMPLE_RATE)
+        np.testing.assert_allclose(decode_audio(path.read_bytes()).whisper_input(), audio[:, 0], atol=1e-4)
+
+    @pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+    def test_ffmpeg_fallback_for_other_containers(self, tmp_path):
+        wav, m4a = tmp_path / "clip.wav", tmp_path / "clip.m4a"
+        sf.write(wav, _tone(1.0, 44100, 1), 44100)
+        subprocess.run(["ffmpeg", "-v", "error", "-i", str(wav), "-c:a", "aac", str(m4a)], check=True)
+        clip = decode_audio(m4a.read_bytes())
+        assert clip.channels == 2
+        assert abs(clip.duration - 1.0) < 0.1
+
+    def test_rejects_garbage(self):
+        with pytest.raises(AudioDecodeError):
+            decode_audio(b"fake audio")
@@ -0,0 +1,76 @@
+import sys
+import threading
+import numpy as np
+import pytest
+import torch
+from musetalk_server.core.avatar import Avatar
+from musetalk_server.tests.conftest import CYCLE_LEN, write_avatar
+
+# Avatar state tests run against a tiny synthetic avatar directory laid out
+# like services/preprocess.py writes it (conftest.write_avatar).
+
+
+@pytest.fixture
+def avatar(tmp_path):
+    write_avatar(str(tmp_path))
+    avatar = Avatar("tiny", results_dir=str(tmp_path))
+    avatar.load_state()
+    return avatar
+
+
+class TestLatentCycle:
+    def test_latents_are_stacked_on_load(self, avatar):
+        assert avatar.latent_cycle.shape == (CYCLE_LEN, 8, 32, 32)
+        assert avatar.latent_cycle[3, 0, 0, 0].item() == 3.0
+
+    def test_latents_for_converts_once(self, avatar):
+        latents = avatar.latents_for(torch.device("cpu"), torch.float16)
+        assert latents.dtype == torch.float16
+        assert avatar.latents_for(torch.device("cpu"), torch.float16) is latents
+
+    def test_index_gather_matches_cycle(self, avatar):
+        latents = avatar.latents_for(torch.device("cpu"), torch.float32)
+        index = torch.arange(CYCLE_LEN + 2) % CYCLE_LEN
+        batch = latents.index_select(0, index[CYCLE_LEN - 1:CYCLE_LEN + 1])
+        assert batch[:, 0, 0, 0].tolist() == [CYCLE_LEN - 1, 0]
+
+    def test_release_latents(self, avatar):
+        avatar.release_latents()
+        assert avatar.latent_cycle is None
+
+
+def test_parallel_decode_matches_sequential(tmp_path):
+    write_avatar(str(tmp_path))
+    sequential = Avatar("tiny", results_dir=str(tmp_path))
+    sequential.load_state()
+    parallel = Avatar("tiny", results_dir=str(tmp_path))
+    parallel.load_state(workers=4)
+    for a, b in zip(sequential.frame_list_cycle + sequential.mask_list_cycle,
+                    parallel.frame_list_cycle + parallel.mask_list_cycle):
+        assert np.array_equal(a, b)
+    assert [f[0, 0, 0] for f in parallel.frame_list_cycle] == [i * 10 for i in range(CYCLE_LEN)]
+
+
+def test_concurrent_pins_balance(avatar):
+    # Sessions open and close from worker threads; a lost update would leave
+    # the avatar pinned (never evicted) or unpinned while still in use.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        def churn():
+            for _ in range(2000):
+                avatar.pin()
+                avatar.unpin()
+
+        avatar.pin()
+        threads = [threading.Thread(target=churn) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert avatar.pins == 1
+    assert avatar.is_pinned
+    avatar.unpin()
+    assert not avatar.is_pinned
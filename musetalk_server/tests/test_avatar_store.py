@@ -0,0 +1,163 @@
+import os
+import io
+import json
+import time
+import hashlib
+import tarfile
+import threading
+import pytest
+from musetalk_server.core.avatar import Avatar
+from musetalk_server.core.metrics import metrics
+from musetalk_server.core.avatar_store import AvatarStore, FileBackend, MARKER_FILE
+from musetalk_server.tests.conftest import write_avatar, CYCLE_LEN
+
+# Two nodes (separate results dirs) sharing a FileBackend directory as the remote store.
+
+
+class _CountingBackend(FileBackend):
+    """FileBackend that counts (and can slow down) archive downloads."""
+
+    def __init__(self, root, delay=0.0):
+        super().__init__(root)
+        self.delay = delay
+        self.downloads = 0
+
+    def get_file(self, key, local_path):
+        self.downloads += 1
+        time.sleep(self.delay)
+        return super().get_file(key, local_path)
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    backend = _CountingBackend(str(tmp_path / "remote"))
+
+    def node(name, **kwargs):
+        results = str(tmp_path / name)
+        return results, AvatarStore(backend, os.path.join(results, "v15", "avatars"), **kwargs)
+
+    return backend, node
+
+
+def _load(results, avatar_id, store):
+    avatar = Avatar(avatar_id, results_dir=results)
+    avatar.load_state(remote=store)
+    return avatar
+
+
+def test_published_avatar_loads_on_a_cold_node(nodes):
+    backend, node = nodes
+    builder_results, builder = node("builder")
+    write_avatar(builder_results, avatar_id="anna")
+    manifest = builder.publish("anna")
+    assert builder.remote_ids() == ["anna"]
+
+    results, store = node("fresh")
+    avatar = _load(results, "anna", store)
+    assert avatar.latent_cycle.shape[0] == CYCLE_LEN
+    assert store.local_marker("anna")["sha256"] == manifest["sha256"]
+    # Already current: no second download
+    _load(results, "anna", store)
+    assert backend.downloads == 1
+
+
+def test_concurrent_fetches_share_one_download(nodes):
+    backend, node = nodes
+    builder_results, builder = node("builder")
+    write_avatar(builder_results, avatar_id="anna")
+    builder.publish("anna")
+    backend.delay = 0.1
+
+    results, store = node("fresh")
+    shared = metrics.get("avatar_store.shared_fetches")
+    outcomes = []
+    threads = [threading.Thread(target=lambda: outcomes.append(store.fetch("anna"))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert outcomes == [True] * 4
+    assert backend.downloads == 1
+    assert metrics.get("avatar_store.shared_fetches") - shared == 3
+
+
+def test_corrupted_archive_is_rejected(nodes):
+    backend, node = nodes
+    builder_results, builder = node("builder")
+    write_avatar(builder_results, avatar_id="anna")
+    manifest = builder.publish("anna")
+    with open(backend._path(f"v15/avatars/anna/{manifest['sha256']}.tar"), "r+b") as f:
+        f.seek(2000)
+        f.write(b"garbage")
+
+    results, store = node("fresh")
+    with pytest.raises(ValueError, match="Checksum"):
+        store.fetch("anna")
+    assert not os.path.exists(os.path.join(results, "v15", "avatars", "anna"))
+
+
+def test_unsafe_archive_entries_are_rejected(nodes):
+    backend, node = nodes
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        info = tarfile.TarInfo("../escape.txt")
+        info.size = 1
+        tar.addfile(info, io.BytesIO(b"x"))
+    sha256 = hashlib.sha256(archive.getvalue()).hexdigest()
+    backend.write(f"v15/avatars/evil/{sha256}.tar", archive.getvalue())
+    backend.write("v15/avatars/evil.json", json.dumps({"avatar_id": "evil", "sha256": sha256}).encode())
+
+    results, store = node("fresh")
+    with pytest.raises(ValueError, match="Unsafe"):
+        store.fetch("evil")
+    assert not os.path.exists(os.path.join(results, "v15", "escape.txt"))
+
+
+def test_republished_avatar_replaces_the_fetched_copy_only(nodes):
+    backend, node = nodes
+    builder_results, builder = node("builder")
+    write_avatar(builder_results, avatar_id="anna")
+    builder.publish("anna")
+    results, store = node("fresh")
+    store.fetch("anna")
+
+    info_path = os.path.join(builder_results, "v15", "avatars", "anna", "avator_info.json")
+    with open(info_path, "w") as f:
+        f.write('{"avatar_id": "anna", "bbox_shift": 5, "version": "v15"}')
+    builder.publish("anna")
+    store.fetch("anna")
+    with open(os.path.join(results, "v15", "avatars", "anna", "avator_info.json")) as f:
+        assert json.load(f)["bbox_shift"] == 5
+    assert backend.downloads == 2
+    # The builder's own copy is never replaced by its published archive
+    assert builder.local_marker("anna") is None
+    assert builder.fetch("anna")
+
+
+def test_fetched_avatars_are_evicted_least_recently_used_first(nodes):
+    backend, node = nodes
+    builder_results, builder = node("builder")
+    for avatar_id in ("a", "b", "c"):
+        write_avatar(builder_results, avatar_id=avatar_id)
+        builder.publish(avatar_id)
+    loaded = {"a"}
+    results, store = node("fresh", in_use=lambda: loaded)
+    for avatar_id in ("a", "b"):
+        store.fetch(avatar_id)
+    size = sum(os.path.getsize(os.path.join(r, f))
+               for r, _, files in os.walk(os.path.join(results, "v15", "avatars", "b")) for f in files)
+    store.max_bytes = int(size * 2.5)
+
+    store.fetch("c")
+    avatars_dir = os.path.join(results, "v15", "avatars")
+    # "a" is the oldest but loaded, so "b" goes
+    assert sorted(os.listdir(avatars_dir)) == ["a", "c"]
+    assert all(os.path.exists(os.path.join(avatars_dir, a, MARKER_FILE)) for a in ("a", "c"))
+
+
+def test_unpublished_avatar_is_not_found(nodes):
+    _, node = nodes
+    results, store = node("fresh")
+    assert store.fetch("nobody") is False
+    with pytest.raises(FileNotFoundError):
+        _load(results, "nobody", store)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+from musetalk_server.core.avatar import Avatar
+from musetalk_server.core.buffers import BufferSet
+from musetalk_server.services.blending import TensorBlender, make_blender, paste_region
+from musetalk_server.services.inference import blend_frame, blend_patch
+from musetalk_server.tests.conftest import write_avatar, CYCLE_LEN
+
+
+@pytest.fixture
+def avatar(tmp_path):
+    write_avatar(str(tmp_path))
+    avatar = Avatar("tiny", results_dir=str(tmp_path))
+    avatar.load_state()
+    rng = np.random.default_rng(0)
+    # Face and crop boxes that differ between cycle frames, soft masks and textured frames
+    avatar.frame_list_cycle = [rng.integers(0, 255, (48, 64, 3), dtype=np.uint8) for _ in range(CYCLE_LEN)]
+    avatar.coord_list_cycle = [[8, 8, 40, 40], [10, 6, 38, 41]] * (CYCLE_LEN // 2) + [[8, 8, 40, 40]] * (CYCLE_LEN % 2)
+    avatar.mask_coords_list_cycle = [[4, 2, 44, 42], [6, 4, 42, 46]] * (CYCLE_LEN // 2) + [[4, 2, 44, 42]] * (CYCLE_LEN % 2)
+    avatar.mask_list_cycle = [
+        rng.integers(0, 255, (y2 - y1, x2 - x1, 3), dtype=np.uint8)
+        for x1, y1, x2, y2 in avatar.mask_coords_list_cycle
+    ]
+    return avatar
+
+
+def test_tensor_blend_matches_cv2_blend(avatar):
+    crops = np.random.default_rng(1).integers(0, 255, (4, 256, 256, 3), dtype=np.uint8)
+    regions = TensorBlender(torch.device("cpu")).blend(avatar, crops, range(3, 7))
+
+    for i, region in enumerate(regions):
+        box, patch = blend_patch(avatar, crops[i], 3 + i)
+        assert region.box == box
+        assert region.pixels.shape == patch.shape
+        # cv2 resizes with fixed-point weights; allow a rounding step
+        assert np.abs(region.pixels.astype(int) - patch.astype(int)).max() <= 2
+
+
+def test_pasted_region_matches_full_frame_blend(avatar):
+    crops = np.random.default_rng(2).integers(0, 255, (2, 256, 256, 3), dtype=np.uint8)
+    regions = TensorBlender(torch.device("cpu")).blend(avatar, torch.from_numpy(crops), [CYCLE_LEN, CYCLE_LEN + 1])
+    buffers = BufferSet()
+
+    for i, region in enumerate(regions):
+        frame = paste_region(avatar, region, CYCLE_LEN + i, buffers)
+        expected = blend_frame(avatar, crops[i], CYCLE_LEN + i)
+        assert np.abs(frame.astype(int) - expected.astype(int)).max() <= 2
+
+
+def test_make_blender():
+    assert make_blender("cv2", torch.device("cpu")) is None
+    assert isinstance(make_blender("torch", torch.device("cpu")), TensorBlender)
+    with pytest.raises(ValueError):
+        make_blender("opengl", torch.device("cpu"))
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import torch
+from musetalk_server.core import buffers as buffers_module
+from musetalk_server.core.buffers import BufferPool, BufferSet, MemoryPolicy
+
+
+def test_buffer_set_reuses_buffers_per_shape():
+    buffers = BufferSet()
+    a = buffers.tensor("latents", (4, 8, 32, 32), torch.float16, "cpu")
+    assert buffers.tensor("latents", (4, 8, 32, 32), torch.float16, "cpu") is a
+    assert buffers.tensor("latents", (3, 8, 32, 32), torch.float16, "cpu") is not a
+    frame = buffers.array("frame", (48, 64, 3), np.uint8)
+    assert buffers.array("frame", (48, 64, 3), np.uint8) is frame
+    assert buffers.allocations == 3
+    assert buffers.nbytes == (4 + 3) * 8 * 32 * 32 * 2 + 48 * 64 * 3
+
+
+def test_pool_hands_idle_sets_to_the_next_render():
+    pool = BufferPool(max_idle=1)
+    with pool.lease() as first, pool.lease() as second:
+        assert first is not second
+    with pool.lease() as again:
+        # Only one idle set is kept: the first one returned
+        assert again is second
+
+
+@pytest.mark.parametrize("policy, releases", [("request", 2), ("idle", 1), ("never", 0)])
+def test_memory_policy(monkeypatch, policy, releases):
+    calls = []
+    monkeypatch.setattr(buffers_module.gc, "collect", lambda: calls.append(True))
+    memory = MemoryPolicy(policy)
+    # Two overlapping renders
+    memory.begin()
+    memory.begin()
+    memory.end()
+    memory.end()
+    assert len(calls) == releases
+
+
+def test_memory_policy_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        MemoryPolicy("sometimes")
@@ -0,0 +1,100 @@
+import types
+import pytest
+import torch
+from musetalk_server.core import cpu_profile
+from musetalk_server.core.cpu_profile import (
+    configure_threads,
+    optimize_module,
+    profile_components,
+    resolve_profile,
+    whisper_report,
+)
+from musetalk_server.core.engine import EagerEngine, check_parity
+
+
+class _TinyWhisper(torch.nn.Module):
+    """Whisper's encoder call: (n, 80, frames) features in, per-layer hidden states out."""
+
+    def __init__(self):
+        super().__init__()
+        self.encoder = _TinyEncoder()
+
+
+class _TinyEncoder(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.ModuleList([torch.nn.Linear(80, 80) for _ in range(2)])
+
+    def forward(self, features, output_hidden_states=True):
+        hidden = [features.transpose(1, 2)]
+        for layer in self.layers:
+            hidden.append(torch.tanh(layer(hidden[-1])))
+        return types.SimpleNamespace(hidden_states=tuple(hidden))
+
+
+def _profiled_engine(models, profile):
+    pe, unet, vae, timesteps = models
+    optimized = profile_components({"pe": pe, "unet": unet.model, "vae": vae.vae}, profile)
+    vae_copy = type(vae)()
+    vae_copy.vae = optimized["vae"]
+    return EagerEngine(optimized["pe"], types.SimpleNamespace(model=optimized["unet"]), vae_copy, timesteps)
+
+
+def test_int8_quantizes_linear_layers_only(tiny_models):
+    engine = _profiled_engine(tiny_models, "int8")
+    assert isinstance(engine.unet.model.proj, torch.ao.nn.quantized.dynamic.Linear)
+    assert isinstance(engine.unet.model.conv, torch.nn.Conv2d)
+    # The reference modules are left untouched
+    assert isinstance(tiny_models[1].model.proj, torch.nn.Linear)
+
+    report = check_parity(engine, EagerEngine(*tiny_models), torch.device("cpu"), batch_sizes=(1, 3))
+    assert report["unet_max_abs"] < 0.05
+    assert report["frame_max_abs"] <= 2
+
+
+def test_bf16_keeps_the_vae_in_fp32(tiny_models):
+    engine = _profiled_engine(tiny_models, "bf16")
+    assert engine.dtype == torch.bfloat16
+    assert engine.vae.vae.dtype == torch.float32
+
+    report = check_parity(engine, EagerEngine(*tiny_models), torch.device("cpu"), batch_sizes=(2,))
+    assert report["unet_max_abs"] < 0.1
+    assert report["frame_max_abs"] <= 4
+
+
+def test_channels_last_for_convolutions(tiny_models):
+    vae = optimize_module(tiny_models[2].vae, "vae", "fp32")
+    assert vae.up.weight.is_contiguous(memory_format=torch.channels_last)
+
+
+def test_whisper_report_against_fp32():
+    torch.manual_seed(0)
+    reference = _TinyWhisper().eval()
+    candidate = profile_components({"whisper": reference}, "int8")["whisper"]
+    report = whisper_report(reference, candidate, iterations=1)
+    assert 0 < report["whisper_rel_err"] < 0.05
+    assert report["whisper_ms"] > 0
+    assert whisper_report(reference, reference, iterations=1)["whisper_max_abs"] == 0
+
+
+def test_resolve_profile(monkeypatch):
+    monkeypatch.setattr(cpu_profile, "bf16_supported", lambda: False)
+    assert resolve_profile("auto") == "int8"
+    assert resolve_profile("bf16") == "int8"
+    assert resolve_profile("fp32") == "fp32"
+    monkeypatch.setattr(cpu_profile, "bf16_supported", lambda: True)
+    assert resolve_profile("auto") == "bf16"
+    with pytest.raises(ValueError):
+        resolve_profile("fp16")
+
+
+def test_configure_threads_leaves_cores_for_blending(monkeypatch):
+    previous = torch.get_num_threads()
+    monkeypatch.setattr(cpu_profile, "available_cores", lambda: 8)
+    try:
+        assert configure_threads(0, blend_threads=3) == 5
+        assert torch.get_num_threads() == 5
+        assert configure_threads(0, blend_threads=16) == 1
+        assert configure_threads(2) == 2
+    finally:
+        torch.set_num_threads(previous)
@@ -0,0 +1,87 @@
+import os
+import numpy as np
+import pytest
+import torch
+from musetalk_server.core.engine import (
+    EagerEngine,
+    build_engine,
+    check_parity,
+    benchmark,
+    weights_fingerprint,
+)
+
+# Engine tests use the tiny_models fixture from conftest: stand-in modules with
+# the same call signatures as the upstream PE / UNet / VAE, so they run on CPU
+# without model weights.
+
+
+class TestEagerEngine:
+    def test_decode_returns_bgr_uint8_frames(self, tiny_models):
+        engine = EagerEngine(*tiny_models)
+        pred = torch.randn(3, 4, 32, 32)
+        frames = engine.decode(pred)
+        assert frames.shape == (3, 256, 256, 3)
+        assert frames.dtype == np.uint8
+
+
+class TestTorchScriptEngine:
+    def test_parity_with_eager(self, tiny_models, tmp_path):
+        device = torch.device("cpu")
+        engine = build_engine("torchscript", *tiny_models, device=device, cache_dir=str(tmp_path), fingerprint="t")
+        report = check_parity(engine, EagerEngine(*tiny_models), device, batch_sizes=(1, 3))
+        assert report["unet_max_abs"] < 1e-5
+        assert report["frame_max_abs"] <= 1
+
+    def test_artifacts_are_cached(self, tiny_models, tmp_path):
+        device = torch.device("cpu")
+        build_engine("torchscript", *tiny_models, device=device, cache_dir=str(tmp_path), fingerprint="t")
+        artifacts = sorted(os.listdir(tmp_path))
+        mtimes = [os.stat(tmp_path / name).st_mtime_ns for name in artifacts]
+        assert len(artifacts) == 3
+
+        build_engine("torchscript", *tiny_models, device=device, cache_dir=str(tmp_path), fingerprint="t")
+        assert [os.stat(tmp_path / name).st_mtime_ns for name in artifacts] == mtimes
+
+    def test_benchmark_reports_fps(self, tiny_models, tmp_path):
+        device = torch.device("cpu")
+        engine = build_engine("torchscript", *tiny_models, device=device, cache_dir=str(tmp_path), fingerprint="t")
+        assert benchmark(engine, device, batch_size=2, iterations=2, warmup=1) > 0
+
+
+class TestOnnxEngine:
+    def test_parity_with_eager(self, tiny_models, tmp_path):
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+        device = torch.device("cpu")
+        engine = build_engine("onnx", *tiny_models, device=device, cache_dir=str(tmp_path), fingerprint="t")
+        report = check_parity(engine, EagerEngine(*tiny_models), device, batch_sizes=(1, 3))
+        assert report["unet_max_abs"] < 1e-4
+        assert report["frame_max_abs"] <= 1
+
+    def test_runs_through_io_binding(self, tiny_models, tmp_path):
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+        device = torch.device("cpu")
+        engine = build_engine("onnx", *tiny_models, device=device, cache_dir=str(tmp_path), fingerprint="t")
+        for module in engine.modules.values():
+            # The copying feed/fetch path must not be used
+            module.session.run = None
+        latents = torch.randn(3, 8, 32, 32)
+        audio = engine.encode_audio(torch.randn(3, 50, 384))
+        pred = engine.predict(latents, audio)
+        assert audio.shape == (3, 50, 384)
+        assert pred.shape == (3, 4, 32, 32)
+        assert engine.decode(pred).shape == (3, 256, 256, 3)
+
+
+def test_unknown_backend_rejected(tiny_models):
+    with pytest.raises(ValueError):
+        build_engine("tensorrt", *tiny_models, device=torch.device("cpu"))
+
+
+def test_fingerprint_changes_with_weights(tmp_path):
+    weights = tmp_path / "unet.pth"
+    weights.write_bytes(b"a")
+    before = weights_fingerprint(str(weights))
+    weights.write_bytes(b"ab")
+    assert weights_fingerprint(str(weights)) != before
@@ -0,0 +1,375 @@
+import os
+import cv2
+import json
+import shutil
+import subprocess
+import threading
+import types
+import zipfile
+import numpy as np
+import pytest
+import torch
+from musetalk_server.core.avatar import Avatar
+from musetalk_server.core.buffers import BufferSet
+from musetalk_server.core.metrics import metrics
+from musetalk_server.core.scheduler import GpuScheduler
+from musetalk_server.services import inference as inference_module
+from musetalk_server.services.audio import SAMPLE_RATE, AudioClip
+from musetalk_server.services.bundle import build_bundle
+from musetalk_server.services.inference import (
+    CancelToken, InferenceCancelled, InferenceModels, InferenceService, predict_batches, blend_frame, blend_patch,
+    inference_batch, inference_stream, inference_progressive,
+)
+from musetalk_server.tests.conftest import FakeFeatureExtractor, FakeEncoder
+from musetalk_server.tests.conftest import write_avatar, CYCLE_LEN
+
+# The prediction loop runs against an engine whose decoded crop is the latent
+# value it was given, so interpolated frames can be checked exactly. Blending
+# tests use the synthetic avatar from test_avatar.
+
+
+class _ValueEngine:
+    name = "value"
+    dtype = torch.float32
+
+    def __init__(self):
+        self.frames_inferred = 0
+
+    def encode_audio(self, whisper_batch):
+        return whisper_batch
+
+    def predict(self, latents, audio_features):
+        self.frames_inferred += latents.shape[0]
+        return latents
+
+    def decode(self, latents):
+        values = latents[:, 0, 0, 0].numpy().astype(np.uint8)
+        return np.broadcast_to(values[:, None, None, None], (len(values), 4, 4, 3)).copy()
+
+    def decode_tensor(self, latents):
+        return torch.from_numpy(self.decode(latents))
+
+
+def _run(num_frames, lip_stride, batch_size=4, buffers=None):
+    engine = _ValueEngine()
+    models = InferenceModels(None, None, None, None, None, None, engine=engine)
+    # Latent i decodes to value 10 * i; frame i uses latent i
+    latent_cycle = (torch.arange(num_frames, dtype=torch.float32) * 10)[:, None, None, None].expand(-1, 8, 32, 32)
+    cycle_index = torch.arange(num_frames)
+    prompts = torch.zeros(num_frames, 50, 384)
+    batches = [prompts[i:i + batch_size] for i in range(0, num_frames, batch_size)]
+    recon = list(predict_batches(models, iter(batches), latent_cycle, cycle_index, torch.device("cpu"), lip_stride,
+                                 buffers))
+    return engine, np.concatenate(recon)[:, 0, 0, 0]
+
+
+@pytest.mark.parametrize("num_frames", [1, 9, 17])
+def test_stride_one_infers_every_frame(num_frames):
+    engine, values = _run(num_frames, 1)
+    assert engine.frames_inferred == num_frames
+    assert values.tolist() == [10 * i for i in range(num_frames)]
+
+
+@pytest.mark.parametrize("num_frames, lip_stride", [(9, 2), (17, 2), (10, 3), (2, 4)])
+def test_strided_interpolates_between_anchors(num_frames, lip_stride):
+    engine, values = _run(num_frames, lip_stride)
+    anchors = len(range(0, num_frames, lip_stride)) + ((num_frames - 1) % lip_stride != 0)
+    assert engine.frames_inferred == anchors
+    # Crops are linear in the latent here, so blending anchors reproduces every frame
+    assert len(values) == num_frames
+    assert np.abs(values.astype(int) - 10 * np.arange(num_frames)).max() <= 1
+
+
+@pytest.mark.parametrize("lip_stride", [1, 2])
+def test_prediction_reuses_pooled_latent_buffers(lip_stride):
+    buffers = BufferSet()
+    _, values = _run(17, lip_stride, buffers=buffers)
+    assert np.abs(values.astype(int) - 10 * np.arange(17)).max() <= 1
+    # One buffer per batch shape (full and short last batch), not one per batch
+    assert buffers.allocations <= 2
+    _run(17, lip_stride, buffers=buffers)
+    assert buffers.allocations <= 2
+
+
+def test_blend_frame_into_pooled_buffer(tmp_path):
+    write_avatar(str(tmp_path))
+    avatar = Avatar("tiny", results_dir=str(tmp_path))
+    avatar.load_state()
+    avatar.mask_coords_list_cycle = [[4, 2, 44, 42]] * CYCLE_LEN
+    avatar.mask_list_cycle = [np.full((40, 40, 3), 128, dtype=np.uint8)] * CYCLE_LEN
+    original = [frame.copy() for frame in avatar.frame_list_cycle]
+    res_frame = np.random.default_rng(0).integers(0, 255, (256, 256, 3), dtype=np.uint8)
+    buffers = BufferSet()
+
+    for idx in range(CYCLE_LEN):
+        expected = blend_frame(avatar, res_frame, idx)
+        assert np.array_equal(blend_frame(avatar, res_frame, idx, buffers), expected)
+    assert buffers.allocations == 1
+    assert all(np.array_equal(a, b) for a, b in zip(avatar.frame_list_cycle, original))
+
+
+def test_blend_patch_matches_full_frame_blend(tmp_path):
+    write_avatar(str(tmp_path))
+    avatar = Avatar("tiny", results_dir=str(tmp_path))
+    avatar.load_state()
+    # Crop box around the face box, as preprocessing produces, with a soft mask
+    # so the blend actually mixes face and background
+    avatar.mask_coords_list_cycle = [[4, 2, 44, 42]] * CYCLE_LEN
+    avatar.mask_list_cycle = [np.tile(np.linspace(0, 255, 40, dtype=np.uint8)[:, None, None], (1, 40, 3))] * CYCLE_LEN
+    res_frame = np.random.default_rng(0).integers(0, 255, (256, 256, 3), dtype=np.uint8)
+
+    full = blend_frame(avatar, res_frame, 2)
+    (x1, y1, x2, y2), patch = blend_patch(avatar, res_frame, 2)
+
+    assert np.array_equal(patch, full[y1:y2, x1:x2])
+    outside = full.copy()
+    outside[y1:y2, x1:x2] = avatar.frame_list_cycle[2][y1:y2, x1:x2]
+    assert np.array_equal(outside, avatar.frame_list_cycle[2])
+
+
+def test_bundle_holds_encoded_cycle(tmp_path):
+    write_avatar(str(tmp_path))
+    avatar = Avatar("tiny", results_dir=str(tmp_path))
+    avatar.load_state()
+
+    path = build_bundle(avatar, fps=25)
+    assert build_bundle(avatar, fps=25) == path
+    with zipfile.ZipFile(path) as bundle:
+        manifest = json.loads(bundle.read("manifest.json"))
+        assert manifest["cycle_len"] == CYCLE_LEN
+        assert manifest["patch_boxes"][0] == [4, 4, 28, 28]
+        assert bundle.read(manifest["frames"][3]) == avatar.encoded_frame(3)
+
+
+@pytest.fixture
+def stream_inputs(tmp_path, monkeypatch):
+    """Avatar, audio and models of a stream whose frames are the decoded 4x4 crops."""
+    write_avatar(str(tmp_path))
+    avatar = Avatar("tiny", results_dir=str(tmp_path))
+    avatar.load_state()
+    monkeypatch.setattr(inference_module, "blend_frame", lambda avatar, res_frame, idx, buffers=None: res_frame)
+    engine = _ValueEngine()
+    models = InferenceModels(
+        vae=None,
+        unet=types.SimpleNamespace(model=types.SimpleNamespace(dtype=torch.float32)),
+        pe=None,
+        audio_processor=types.SimpleNamespace(feature_extractor=FakeFeatureExtractor()),
+        whisper=types.SimpleNamespace(encoder=FakeEncoder()),
+        timesteps=None,
+        engine=engine,
+    )
+    # 3 s of audio: 75 frames, far more than the worker queues hold
+    audio = AudioClip(np.zeros(3 * SAMPLE_RATE, dtype=np.float32), SAMPLE_RATE)
+    return avatar, audio, models, engine
+
+
+@pytest.fixture
+def stream(stream_inputs):
+    avatar, audio, models, engine = stream_inputs
+
+    def start(cancel=None, **kwargs):
+        return inference_stream(avatar, audio, models, fps=25, batch_size=4, device=torch.device("cpu"), cancel=cancel,
+                                **kwargs)
+
+    return start, engine
+
+
+@pytest.mark.parametrize("lip_stride", [1, 2])
+def test_tensor_predictions_match_numpy(lip_stride):
+    _, values = _run(17, lip_stride)
+    engine = _ValueEngine()
+    models = InferenceModels(None, None, None, None, None, None, engine=engine)
+    latent_cycle = (torch.arange(17, dtype=torch.float32) * 10)[:, None, None, None].expand(-1, 8, 32, 32)
+    batches = [torch.zeros(17, 50, 384)[i:i + 4] for i in range(0, 17, 4)]
+    recon = list(predict_batches(models, iter(batches), latent_cycle, torch.arange(17), torch.device("cpu"), lip_stride,
+                                 as_tensor=True))
+    assert all(isinstance(batch, torch.Tensor) for batch in recon)
+    assert torch.cat(recon)[:, 0, 0, 0].numpy().tolist() == values.tolist()
+
+
+def test_stream_with_torch_blend_backend(stream):
+    start, engine = stream
+    patches = list(start(patch_mode=True, blend_backend="torch"))
+    assert len(patches) == 75
+    assert [p.frame_index for p in patches[:3]] == [0, 1, 2]
+    assert patches[0].box == (4, 4, 28, 28)
+
+
+def test_stream_with_jpeg_splicing(stream):
+    start, engine = stream
+    frames = list(start(blend_backend="torch", jpeg_splice=True))
+    assert len(frames) == 75
+    decoded = cv2.imdecode(np.frombuffer(frames[0], np.uint8), cv2.IMREAD_COLOR)
+    assert decoded.shape == (48, 64, 3)
+
+
+def test_stream_takes_a_scheduler_turn_per_batch(stream):
+    start, engine = stream
+    ticket = GpuScheduler(slots=1).ticket("interactive", fps=25)
+    assert len(list(start(ticket=ticket))) == 75
+    assert (ticket.batches, ticket.frames) == (19, 75)
+    assert ticket.scheduler.active == 0
+
+
+class TestCancellation:
+    def test_closing_the_stream_stops_workers(self, stream):
+        start, engine = stream
+        cancelled = metrics.get("inference.cancelled")
+        threads = threading.active_count()
+        frames = start()
+        next(frames), next(frames)
+        frames.close()
+        assert threading.active_count() == threads
+        assert engine.frames_inferred < 75
+        assert metrics.get("inference.cancelled") == cancelled + 1
+
+    def test_cancel_token_ends_stream(self, stream):
+        start, engine = stream
+        cancel = CancelToken()
+        frames = start(cancel)
+        next(frames)
+        cancel.cancel("disconnect")
+        with pytest.raises(InferenceCancelled, match="disconnect"):
+            list(frames)
+        assert engine.frames_inferred < 75
+
+    def test_uncancelled_stream_completes(self, stream):
+        start, engine = stream
+        assert len(list(start(CancelToken(timeout=60)))) == 75
+
+    def test_token_expires(self):
+        cancel = CancelToken(timeout=0.01)
+        assert not cancel.cancelled
+        threading.Event().wait(0.02)
+        assert cancel.cancelled and cancel.reason == "timeout"
+
+
+def _fail_after(frames, engine):
+    """Makes the engine raise (like a CUDA OOM) once `frames` frames were predicted."""
+    predict = engine.predict
+
+    def failing(latents, audio_features):
+        if engine.frames_inferred >= frames:
+            raise RuntimeError("CUDA out of memory")
+        return predict(latents, audio_features)
+    engine.predict = failing
+
+
+class TestWorkerErrors:
+    # A truncated render must never look like a finished one (it would be cached)
+    def test_prediction_error_fails_the_stream(self, stream):
+        start, engine = stream
+        failed = metrics.get("inference.failed")
+        _fail_after(20, engine)
+        frames = start()
+        delivered = []
+        with pytest.raises(RuntimeError, match="out of memory"):
+            for frame in frames:
+                delivered.append(frame)
+        assert len(delivered) <= 20
+        assert metrics.get("inference.failed") == failed + 1
+
+    def test_blend_error_fails_the_stream(self, stream, monkeypatch):
+        start, engine = stream
+
+        def blend(avatar, res_frame, idx, buffers=None):
+            if idx == 10:
+                raise ValueError("bad crop")
+            return res_frame
+        monkeypatch.setattr(inference_module, "blend_frame", blend)
+        with pytest.raises(ValueError, match="bad crop"):
+            list(start())
+
+    @pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+    def test_failed_progressive_render_leaves_no_output(self, stream_inputs, tmp_path):
+        avatar, audio, models, engine = stream_inputs
+        _fail_after(40, engine)
+        output_path = str(tmp_path / "render.mp4")
+        with pytest.raises(RuntimeError, match="out of memory"):
+            for _ in inference_progressive(avatar, audio, output_path, models, fps=25, batch_size=4,
+                                           device=torch.device("cpu")):
+                pass
+        assert not os.path.exists(output_path)
+
+
+def test_render_settings_separate_precisions():
+    models = {name: None for name in ("vae", "unet", "pe", "audio_processor", "whisper", "timesteps")}
+    models["engine"] = types.SimpleNamespace(name="eager")
+    settings = types.SimpleNamespace(version="v15", fps=25, audio_padding_length_left=2, audio_padding_length_right=2,
+                                     blend_backend="cv2", batch_size=4, lip_stride=1)
+    fp32 = InferenceService({**models, "precision": "fp32"}, settings).render_settings()
+    int8 = InferenceService({**models, "precision": "int8"}, settings).render_settings()
+    # Same engine name, different pixels: the result cache must not mix them
+    assert fp32["engine"] == int8["engine"] and fp32 != int8
+
+
+
+def test_concurrent_batch_renders_keep_their_frames_apart(tmp_path, monkeypatch):
+    # Both renders write their frames next to the same output directory at the same time
+    both_started = threading.Barrier(2)
+    muxed = {}
+
+    def frames(avatar, *args, **kwargs):
+        both_started.wait(timeout=5)
+        for i in range(5):
+            yield f"{avatar}-{i}".encode()
+
+    def mux(frame_dir, audio, output_path, fps=25, ffmpeg_path="ffmpeg"):
+        both_started.wait(timeout=5)
+        muxed[output_path] = [open(os.path.join(frame_dir, name), "rb").read() for name in sorted(os.listdir(frame_dir))]
+
+    monkeypatch.setattr(inference_module, "inference_stream", frames)
+    monkeypatch.setattr(inference_module, "mux_frames", mux)
+    renders = [threading.Thread(target=inference_batch, args=(name, None, str(tmp_path / f"{name}.mp4"), None))
+               for name in ("anna", "ben")]
+    for render in renders:
+        render.start()
+    for render in renders:
+        render.join()
+    for name in ("anna", "ben"):
+        assert muxed[str(tmp_path / f"{name}.mp4")] == [f"{name}-{i}".encode() for i in range(5)]
+    assert os.listdir(tmp_path) == []
+
+
+def _top_level_boxes(data: bytes) -> list:
+    boxes, offset = [], 0
+    while offset + 8 <= len(data):
+        size = int.from_bytes(data[offset:offset + 4], "big")
+        boxes.append(data[offset + 4:offset + 8])
+        if size < 8:
+            break
+        offset += size
+    return boxes
+
+
+def _packet_md5s(path: str) -> dict:
+    """Stream index -> md5 of each encoded packet in order (timestamps differ between the muxers)."""
+    out = subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-c", "copy", "-f", "framemd5", "-"],
+                         check=True, capture_output=True, text=True).stdout
+    packets = {}
+    for line in out.splitlines():
+        if line and not line.startswith("#"):
+            fields = [field.strip() for field in line.split(",")]
+            packets.setdefault(fields[0], []).append(fields[5])
+    return packets
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+def test_progressive_render_streams_what_it_caches(stream_inputs, tmp_path):
+    avatar, audio, models, _ = stream_inputs
+    output_path = str(tmp_path / "render.mp4")
+    streamed = b"".join(inference_progressive(avatar, audio, output_path, models, fps=25, batch_size=4,
+                                              device=torch.device("cpu")))
+
+    # Fragmented MP4: header and empty moov first, then fragments
+    boxes = _top_level_boxes(streamed)
+    assert boxes[:2] == [b"ftyp", b"moov"]
+    assert boxes.count(b"moof") >= 3 and boxes.count(b"moof") == boxes.count(b"mdat")
+    # The cached file is a regular MP4 holding the same encoded video and audio
+    with open(output_path, "rb") as f:
+        assert b"moof" not in _top_level_boxes(f.read())
+    streamed_path = tmp_path / "streamed.mp4"
+    streamed_path.write_bytes(streamed)
+    packets = _packet_md5s(str(streamed_path))
+    assert packets == _packet_md5s(output_path)
+    assert len(packets["0"]) == 75 and packets["1"]
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import types
+import cv2
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+from musetalk_server.core.avatar import Avatar
+from musetalk_server.core.metrics import metrics
+from musetalk_server.services import jobs as jobs_module
+from musetalk_server.services.audio import SAMPLE_RATE
+from musetalk_server.services.inference import CancelToken, InferenceCancelled, InferenceService
+from musetalk_server.services.jobs import JobManager, RenderJob, render_job
+from musetalk_server.tests.conftest import FakeFeatureExtractor, FakeEncoder
+from musetalk_server.tests.conftest import write_avatar, CYCLE_LEN
+
+# Jobs run the real scheduler against an engine whose crop encodes the latent
+# (= cycle index) it was given. Muxing is replaced by a stand-in that writes the
+# decoded cycle index of every frame to the output file.
+
+FPS = 25
+
+
+class _RecordingEngine:
+    name = "recording"
+    dtype = torch.float32
+
+    def __init__(self):
+        self.batches = []
+
+    def encode_audio(self, whisper_batch):
+        return whisper_batch
+
+    def predict(self, latents, audio_features):
+        self.batches.append(latents.shape[0])
+        return latents
+
+    def decode(self, latents):
+        values = 100 + 20 * latents[:, 0, 0, 0].round().to(torch.uint8).numpy()
+        return np.broadcast_to(values[:, None, None, None], (len(values), 16, 16, 3)).copy()
+
+
+def _fake_mux(frame_dir, audio, output_path, fps=25, ffmpeg_path="ffmpeg"):
+    frames = []
+    for name in sorted(n for n in os.listdir(frame_dir) if n.endswith(".jpg")):
+        value = cv2.imread(os.path.join(frame_dir, name)).mean()
+        frames.append(int(round((value - 100) / 20)))
+    with open(output_path, "w") as f:
+        json.dump(frames, f)
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    results = str(tmp_path / "results")
+    for avatar_id in ("anna", "ben"):
+        write_avatar(results, avatar_id=avatar_id)
+    avatars = {}
+
+    def get_avatar(avatar_id):
+        if avatar_id not in avatars and os.path.isdir(os.path.join(results, "v15", "avatars", avatar_id)):
+            avatars[avatar_id] = Avatar(avatar_id, results_dir=results)
+        return avatars.get(avatar_id)
+
+    monkeypatch.setattr(jobs_module, "encode_frame",
+                        lambda avatar, res_frame, idx, *args: cv2.imencode('.jpg', res_frame)[1].tobytes())
+    monkeypatch.setattr(jobs_module, "mux_frames", _fake_mux)
+    engine = _RecordingEngine()
+    models = {
+        'vae': None,
+        'unet': types.SimpleNamespace(model=types.SimpleNamespace(dtype=torch.float32)),
+        'pe': None,
+        'audio_processor': types.SimpleNamespace(feature_extractor=FakeFeatureExtractor()),
+        'whisper': types.SimpleNamespace(encoder=FakeEncoder()),
+        'timesteps': None,
+        'engine': engine,
+        'device': torch.device("cpu"),
+    }
+    settings = types.SimpleNamespace(
+        fps=FPS, batch_size=4, lip_stride=1, audio_padding_length_left=2, audio_padding_length_right=2,
+        latent_device_budget_mb=0, blend_backend="cv2", jpeg_splice=False, ffmpeg_path="ffmpeg",
+    )
+
+    def audio(name, frames):
+        path = str(tmp_path / name)
+        samples = frames * SAMPLE_RATE // FPS
+        sf.write(path, np.linspace(-0.5, 0.5, samples, dtype=np.float32), SAMPLE_RATE)
+        return path
+
+    def make_job(pairs, job_id="job"):
+        job_dir = str(tmp_path / "jobs" / job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        items = [
+            {"index": i, "avatar_id": avatar_id, "audio": path, "output_path": str(tmp_path / "out" / f"{i}.mp4"),
+             "status": "pending", "frames_done": 0, "frames_total": 0, "error": None}
+            for i, (avatar_id, path) in enumerate(pairs)
+        ]
+        return RenderJob(job_id, job_dir, items, str(tmp_path / "out"))
+
+    def service(**overrides):
+        return InferenceService(models, types.SimpleNamespace(**{**vars(settings), **overrides}))
+
+    return types.SimpleNamespace(get_avatar=get_avatar, engine=engine, audio=audio, make_job=make_job,
+                                 service=service, models=models)
+
+
+def _output(item):
+    with open(item["output_path"]) as f:
+        return json.load(f)
+
+
+class TestRenderJob:
+    def test_renders_every_item_with_its_own_cycle(self, env):
+        a, b = env.audio("a.wav", 10), env.audio("b.wav", 7)
+        job = env.make_job([("anna", a), ("ben", b), ("anna", b)])
+        render_job(job, env.service(), env.get_avatar)
+
+        for item, frames in zip(job.items, (10, 7, 7)):
+            assert item["status"] == "done"
+            assert item["frames_done"] == item["frames_total"] == frames
+            # Each clip starts at cycle frame 0, even when packed behind another clip
+            assert _output(item) == [i % CYCLE_LEN for i in range(frames)]
+        assert not os.path.exists(os.path.join(job.job_dir, "frames"))
+        with open(job.path) as f:
+            assert [item["status"] for item in json.load(f)["items"]] == ["done"] * 3
+
+    def test_packs_clips_of_an_avatar_into_full_batches(self, env):
+        a, b = env.audio("a.wav", 10), env.audio("b.wav", 7)
+        job = env.make_job([("anna", a), ("ben", b), ("anna", b)])
+        render_job(job, env.service(), env.get_avatar)
+        # anna: 17 frames in batches of 4, ben: 7 frames; one short batch per avatar
+        assert env.engine.batches == [4, 4, 4, 4, 1, 4, 3]
+
+    def test_shares_whisper_features_between_items(self, env):
+        a, b = env.audio("a.wav", 10), env.audio("b.wav", 7)
+        job = env.make_job([("anna", a), ("ben", a), ("anna", b), ("ben", a)])
+        encoder = env.models['whisper'].encoder
+        misses, hits = metrics.get("jobs.feature_misses"), metrics.get("jobs.feature_hits")
+        render_job(job, env.service(), env.get_avatar)
+
+        assert encoder.calls == 2
+        assert metrics.get("jobs.feature_misses") - misses == 2
+        assert metrics.get("jobs.feature_hits") - hits == 2
+        assert all(item["status"] == "done" for item in job.items)
+
+    def test_strided_clips_are_predicted_separately(self, env):
+        a = env.audio("a.wav", 9)
+        job = env.make_job([("anna", a), ("anna", a)])
+        render_job(job, env.service(lip_stride=2), env.get_avatar)
+        # Anchors 0, 2, 4, 6, 8 of each clip
+        assert env.engine.batches == [4, 1, 4, 1]
+        assert [item["frames_total"] for item in job.items] == [9, 9]
+
+    def test_failed_items_do_not_stop_the_job(self, env):
+        a = env.audio("a.wav", 5)
+        job = env.make_job([("nobody", a), ("anna", str(env.audio("b.wav", 5)) + ".missing"), ("anna", a)])
+        render_job(job, env.service(), env.get_avatar)
+
+        assert [item["status"] for item in job.items] == ["failed", "failed", "done"]
+        assert "not found" in job.items[0]["error"]
+        assert "Cannot read audio" in job.items[1]["error"]
+
+    def test_resumes_only_unfinished_items(self, env):
+        a = env.audio("a.wav", 6)
+        job = env.make_job([("anna", a), ("ben", a)])
+        job.items[0]["status"] = "done"
+        render_job(job, env.service(), env.get_avatar)
+
+        assert not os.path.exists(job.items[0]["output_path"])
+        assert job.items[1]["status"] == "done"
+        assert env.engine.batches == [4, 2]
+
+    def test_cancelled_job_keeps_finished_items(self, env):
+        a = env.audio("a.wav", 5)
+        job = env.make_job([("anna", a), ("ben", a)])
+        cancel = CancelToken()
+        real_decode = env.engine.decode
+
+        def decode(latents):
+            if len(env.engine.batches) > 2:
+                cancel.cancel()
+            return real_decode(latents)
+
+        env.engine.decode = decode
+        with pytest.raises(InferenceCancelled):
+            render_job(job, env.service(), env.get_avatar, cancel)
+        assert job.items[0]["status"] == "done"
+        assert job.items[1]["status"] == "pending"
+        assert not os.path.exists(os.path.join(job.job_dir, "frames"))
+
+
+class TestJobManager:
+    def test_requeues_unfinished_jobs_on_start(self, tmp_path):
+        root = str(tmp_path / "jobs")
+        for job_id, status in (("old", "completed"), ("interrupted", "running"), ("waiting", "queued")):
+            job = RenderJob(job_id, os.path.join(root, job_id), [], "out", status=status)
+            os.makedirs(job.job_dir)
+            job.save()
+
+        ran = []
+        manager = JobManager(root)
+        manager.start(lambda job, cancel: ran.append(job.job_id))
+        manager.submit(RenderJob("new", os.path.join(root, "new"), [], "out"))
+
+        for _ in range(100):
+            if manager.get("new").status == "completed":
+                break
+            time.sleep(0.02)
+        assert sorted(ran) == ["interrupted", "new", "waiting"]
+        assert RenderJob.load(os.path.join(root, "interrupted")).status == "completed"
+        assert manager.get("old").status == "completed"
+
+    def test_cancel_queued_job(self, tmp_path):
+        manager = JobManager(str(tmp_path / "jobs"))
+        job = manager.submit(RenderJob("queued", str(tmp_path / "jobs" / "queued"), [], "out"))
+        assert manager.cancel("queued")
+        assert job.status == "cancelled"
+        assert RenderJob.load(job.job_dir).status == "cancelled"
+        assert not manager.cancel("queued")
@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+import pytest
+from musetalk_server.core.jpeg_splice import (
+    JpegSplicer, encode_segments, join_segments, restart_interval, MCU_SIZE
+)
+
+
+def _frames(count, height, width):
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 255, (count, height, width, 3), dtype=np.uint8)
+    # Smooth frames, closer to video than raw noise
+    return [cv2.GaussianBlur(frame, (0, 0), 3) for frame in noise]
+
+
+@pytest.mark.parametrize("width", [64, 80, 1920, 1925])
+def test_restart_interval_divides_mcu_row(width):
+    interval = restart_interval(width)
+    assert 1 <= interval <= 8
+    assert -(-width // MCU_SIZE) % interval == 0
+
+
+def test_segments_round_trip():
+    frame = _frames(1, 72, 100)[0]
+    header, segments = encode_segments(frame, restart_interval(100))
+    data = join_segments(header, segments)
+    assert data == cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_RST_INTERVAL, restart_interval(100)])[1].tobytes()
+    assert len(segments) == 5 * (7 // restart_interval(100))
+
+
+@pytest.mark.parametrize("size, box", [
+    ((144, 256), (70, 40, 150, 110)),   # interior, MCU-aligned frame
+    ((150, 259), (3, 5, 60, 50)),       # top-left corner, partial MCUs at the edges
+    ((150, 259), (200, 100, 259, 150)),  # bottom-right corner
+])
+def test_spliced_frame_matches_full_encode(size, box):
+    height, width = size
+    frames = _frames(2, height, width)
+    splicer = JpegSplicer(frames)
+    x1, y1, x2, y2 = box
+    face = np.random.default_rng(1).integers(0, 255, (y2 - y1, x2 - x1, 3), dtype=np.uint8)
+
+    for cycle_idx in (1, 3):
+        composed = frames[cycle_idx % 2].copy()
+        composed[y1:y2, x1:x2] = face
+        data = splicer.encode(cycle_idx, box, face)
+
+        assert data == join_segments(*encode_segments(composed, restart_interval(width)))
+        decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        reference = cv2.imdecode(cv2.imencode('.jpg', composed)[1], cv2.IMREAD_COLOR)
+        # Restart markers don't change the coded image
+        assert np.array_equal(decoded, reference)
@@ -0,0 +1,90 @@
+import sys
+import types
+import threading
+import pytest
+from musetalk_server.core import model_loader as loader_module
+from musetalk_server.core.model_loader import ModelLoader, ROLE_COMPONENTS, PREPROCESS_COMPONENTS
+
+# A fresh ModelLoader per test whose components are stub objects; loading and
+# unloading only touches the bookkeeping.
+
+
+@pytest.fixture
+def loader(monkeypatch):
+    monkeypatch.setattr(ModelLoader, "_instance", None)
+    monkeypatch.setattr(loader_module, "configure_threads", lambda *args: 1)
+    monkeypatch.setattr(loader_module.conf, "role", "inference")
+    loads = []
+    for name in ROLE_COMPONENTS["all"]:
+        def load(self, name=name):
+            loads.append(name)
+            setattr(self, name, object())
+        monkeypatch.setattr(ModelLoader, f"_load_{name}", load)
+    monkeypatch.setattr(ModelLoader, "get_engine", lambda self, backend=None: None)
+    loader = ModelLoader()
+    loader.loads = loads
+    return loader
+
+
+def _age(loader, seconds):
+    for name in loader._last_used:
+        loader._last_used[name] -= seconds
+
+
+def test_loads_only_the_role_components(loader):
+    loader.load()
+    assert loader.loads == ["vae", "unet", "whisper"]
+    assert loader.is_loaded()
+    assert loader.loaded_components() == ["vae", "unet", "whisper"]
+    loader.load()
+    assert len(loader.loads) == 3
+
+
+def test_on_demand_components_are_unloaded_when_idle(loader):
+    models = loader.get_models(PREPROCESS_COMPONENTS)
+    assert models["dwpose"] is not None and models["face_parsing"] is not None
+    assert loader.unload_idle(timeout=60) == []
+    _age(loader, 120)
+    # Role components stay however long they are idle
+    assert sorted(loader.unload_idle(timeout=60)) == ["dwpose", "face_parsing"]
+    assert loader.loaded_components() == ["vae"]
+
+
+def test_held_components_are_not_unloaded(loader):
+    with loader.hold(("dwpose",)):
+        with loader.hold(("dwpose",)):
+            _age(loader, 120)
+            assert loader.unload_idle(timeout=60) == []
+        _age(loader, 120)
+        assert loader.unload_idle(timeout=60) == []
+    # Released just now: idle only after the timeout
+    assert loader.unload_idle(timeout=60) == []
+    _age(loader, 120)
+    assert loader.unload_idle(timeout=60) == ["dwpose"]
+
+
+def test_unloading_dwpose_releases_the_module(loader, monkeypatch):
+    package = types.ModuleType("musetalk.utils")
+    module = types.ModuleType("musetalk.utils.preprocessing")
+    package.preprocessing = module
+    monkeypatch.setitem(sys.modules, "musetalk.utils", package)
+    monkeypatch.setitem(sys.modules, "musetalk.utils.preprocessing", module)
+    loader.dwpose = module
+    loader.unload(["dwpose"])
+    assert "musetalk.utils.preprocessing" not in sys.modules
+    assert not hasattr(package, "preprocessing")
+
+
+def test_idle_reaper(loader, monkeypatch):
+    monkeypatch.setattr(loader_module.conf, "model_idle_timeout", 0)
+    loader.start_idle_reaper()
+    assert loader._reaper is None
+
+    reaped = threading.Event()
+    monkeypatch.setattr(loader_module.conf, "model_idle_timeout", 0.1)
+    monkeypatch.setattr(loader, "unload_idle", lambda: reaped.set())
+    loader.start_idle_reaper()
+    reaper = loader._reaper
+    loader.start_idle_reaper()
+    assert loader._reaper is reaper
+    assert reaped.wait(timeout=5)
@@ -0,0 +1,256 @@
+import os
+import types
+import cv2
+import numpy as np
+import pytest
+import torch
+from musetalk_server.core.avatar import Avatar
+from musetalk_server.services import preprocess
+from musetalk_server.services.preprocess import (
+    StageCache, landmarks_to_boxes, process_avatar, detect_landmarks, detect_landmarks_keyframes, keyframe_report,
+)
+
+# Stage caching runs the real pipeline with counting stand-ins for DWPose,
+# the VAE and face parsing, on a directory of synthetic PNG frames.
+
+NUM_FRAMES = 4
+
+
+def _reference_boxes(raw, upperbondrange):
+    """Box loop of upstream get_landmark_and_bbox (musetalk/utils/preprocessing.py)."""
+    coords_list = []
+    for face_land_mark, f in raw:
+        face_land_mark = face_land_mark.copy()
+        if f is None:
+            coords_list += [(0.0, 0.0, 0.0, 0.0)]
+            continue
+        half_face_coord = face_land_mark[29]
+        if upperbondrange != 0:
+            half_face_coord[1] = upperbondrange + half_face_coord[1]
+        half_face_dist = np.max(face_land_mark[:, 1]) - half_face_coord[1]
+        min_upper_bond = 0
+        upper_bond = max(min_upper_bond, half_face_coord[1] - half_face_dist)
+        f_landmark = (np.min(face_land_mark[:, 0]), int(upper_bond), np.max(face_land_mark[:, 0]), np.max(face_land_mark[:, 1]))
+        x1, y1, x2, y2 = f_landmark
+        if y2 - y1 <= 0 or x2 - x1 <= 0 or x1 < 0:
+            coords_list += [f]
+        else:
+            coords_list += [f_landmark]
+    return coords_list
+
+
+def _landmarks(seed):
+    rng = np.random.default_rng(seed)
+    lm = np.stack([rng.integers(10, 50, 68), rng.integers(20, 60, 68)], axis=1).astype(np.int32)
+    lm[28, 1], lm[29, 1], lm[30, 1] = 30, 34, 38
+    return lm
+
+
+@pytest.mark.parametrize("bbox_shift", [0, -7, 5, 40])
+def test_landmarks_to_boxes_matches_upstream(bbox_shift):
+    raw = [(_landmarks(i), (1, 2, 60, 70)) for i in range(5)] + [(_landmarks(9), None)]
+    assert landmarks_to_boxes(raw, bbox_shift) == _reference_boxes(raw, bbox_shift)
+
+
+@pytest.mark.parametrize("bbox_shift", [0, -20])
+def test_box_is_clamped_at_the_top_of_the_frame(bbox_shift):
+    # Nose bridge near the top edge: the mirrored upper bound lies above the frame
+    lm = _landmarks(3)
+    lm[29, 1] = 12
+    (x1, y1, x2, y2), = landmarks_to_boxes([(lm, (1, 2, 60, 70))], bbox_shift)
+    assert y1 == 0 and y2 == np.max(lm[:, 1])
+
+
+def test_stage_cache_persists(tmp_path):
+    stages = StageCache(str(tmp_path))
+    stages.mark("frames", "abc")
+    assert StageCache(str(tmp_path)).is_current("frames", "abc")
+    stages.invalidate("frames")
+    assert not StageCache(str(tmp_path)).is_current("frames", "abc")
+
+
+class _Counter:
+    def __init__(self):
+        self.calls = 0
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    video_dir = tmp_path / "video"
+    video_dir.mkdir()
+    for i in range(NUM_FRAMES):
+        cv2.imwrite(str(video_dir / f"{i:08d}.png"), np.full((96, 96, 3), 40 + i, dtype=np.uint8))
+
+    pose = _Counter()
+
+    def inference_topdown(model, frame):
+        pose.calls += 1
+        keypoints = np.zeros((1, 133, 2))
+        keypoints[0, 23:91] = _landmarks(0)
+        return keypoints
+
+    dwpose = types.SimpleNamespace(
+        model=None,
+        inference_topdown=inference_topdown,
+        merge_data_samples=lambda keypoints: types.SimpleNamespace(pred_instances=types.SimpleNamespace(keypoints=keypoints)),
+        fa=types.SimpleNamespace(get_detections_for_batch=lambda frames: [(5, 5, 80, 80)] * len(frames)),
+    )
+
+    vae = _Counter()
+    vae.get_latents_for_unet = lambda crop: (setattr(vae, "calls", vae.calls + 1), torch.zeros(1, 8, 32, 32))[1]
+
+    parser = _Counter()
+
+    def prepare_material(frame, bbox, fp=None, mode="jaw"):
+        parser.calls += 1
+        return np.full((20, 20, 3), 255, dtype=np.uint8), [0, 0, 20, 20]
+
+    monkeypatch.setattr(preprocess, "get_image_prepare_material", prepare_material)
+
+    def run(avatar_id="tiny", **params):
+        process_avatar(avatar_id, str(video_dir), vae, None, dwpose=dwpose, results_dir=str(tmp_path / "results"), **params)
+        return pose.calls, vae.calls, parser.calls
+
+    return run, tmp_path / "results" / "v15" / "avatars" / "tiny"
+
+
+class TestStagedPreprocessing:
+    def test_builds_cycle_outputs(self, pipeline):
+        run, base = pipeline
+        assert run() == (NUM_FRAMES, NUM_FRAMES, NUM_FRAMES)
+        assert len(os.listdir(base / "full_imgs")) == 2 * NUM_FRAMES
+        assert len(os.listdir(base / "mask")) == 2 * NUM_FRAMES
+        assert len(torch.load(base / "latents.pt")) == 2 * NUM_FRAMES
+
+    def test_unchanged_parameters_skip_everything(self, pipeline):
+        run, base = pipeline
+        run()
+        avatar = Avatar("tiny", results_dir=str(base.parents[2]))
+        version = avatar.content_version
+        assert run() == (NUM_FRAMES, NUM_FRAMES, NUM_FRAMES)
+        # Cached renders, shared-store mappings and bundles of the avatar stay valid
+        assert avatar.content_version == version
+        run(bbox_shift=3)
+        assert avatar.content_version != version
+
+    def test_bbox_shift_reuses_frames_and_landmarks(self, pipeline):
+        run, _ = pipeline
+        run()
+        assert run(bbox_shift=3) == (NUM_FRAMES, 2 * NUM_FRAMES, 2 * NUM_FRAMES)
+
+    def test_parsing_mode_only_redoes_masks(self, pipeline):
+        run, _ = pipeline
+        run()
+        assert run(parsing_mode="face") == (NUM_FRAMES, NUM_FRAMES, 2 * NUM_FRAMES)
+        assert run(parsing_mode="face", left_cheek_width=80) == (NUM_FRAMES, NUM_FRAMES, 3 * NUM_FRAMES)
+
+    def test_keyframe_landmarks_rerun_only_on_change(self, pipeline):
+        run, _ = pipeline
+        # Static face: frames 0, 2 and the last one are detected
+        assert run(keyframe_interval=2) == (3, NUM_FRAMES, NUM_FRAMES)
+        assert run(keyframe_interval=2) == (3, NUM_FRAMES, NUM_FRAMES)
+        assert run() == (3 + NUM_FRAMES, 2 * NUM_FRAMES, 2 * NUM_FRAMES)
+
+
+class TestDeduplicatedBuilds:
+    def test_same_inputs_link_existing_build(self, pipeline):
+        run, base = pipeline
+        run()
+        assert run(avatar_id="twin") == (NUM_FRAMES, NUM_FRAMES, NUM_FRAMES)
+        twin = base.parent / "twin"
+        assert os.path.samefile(base / "latents.pt", twin / "latents.pt")
+        assert os.path.samefile(base / "mask" / "00000000.png", twin / "mask" / "00000000.png")
+        assert len(os.listdir(twin / "full_imgs")) == 2 * NUM_FRAMES
+        # The twin is current on its own: processing it again does nothing
+        version = Avatar("twin", results_dir=str(base.parents[2])).content_version
+        assert run(avatar_id="twin") == (NUM_FRAMES, NUM_FRAMES, NUM_FRAMES)
+        assert Avatar("twin", results_dir=str(base.parents[2])).content_version == version
+
+    def test_different_parameters_are_processed(self, pipeline):
+        run, base = pipeline
+        run()
+        assert run(avatar_id="shifted", bbox_shift=3) == (2 * NUM_FRAMES, 2 * NUM_FRAMES, 2 * NUM_FRAMES)
+        assert not os.path.samefile(base / "latents.pt", base.parent / "shifted" / "latents.pt")
+
+    def test_reprocessing_alias_leaves_original_intact(self, pipeline):
+        run, base = pipeline
+        run()
+        run(avatar_id="twin")
+        coords = (base / "coords.pkl").read_bytes()
+        run(avatar_id="twin", bbox_shift=3)
+        assert (base / "coords.pkl").read_bytes() == coords
+        assert not os.path.samefile(base / "coords.pkl", base.parent / "twin" / "coords.pkl")
+        assert run() == (NUM_FRAMES, 2 * NUM_FRAMES, 2 * NUM_FRAMES)
+
+
+class TestKeyframeLandmarks:
+    """Frames are filled with their index; the fake detector moves the face by `offsets[index]`."""
+
+    @staticmethod
+    def _video(tmp_path, offsets, brightness=None, faceless=()):
+        brightness = brightness or list(range(len(offsets)))
+        frames = []
+        for i, value in enumerate(brightness):
+            path = str(tmp_path / f"{i:08d}.png")
+            cv2.imwrite(path, np.full((96, 96, 3), value, dtype=np.uint8))
+            frames.append(path)
+        index = {value: i for i, value in enumerate(brightness)}
+        detections = []
+
+        def inference_topdown(model, frame):
+            i = index[frame[0, 0, 0]]
+            detections.append(i)
+            keypoints = np.zeros((1, 133, 2))
+            keypoints[0, 23:91] = _landmarks(0) + [offsets[i], offsets[i] // 2]
+            return keypoints
+
+        def get_detections_for_batch(batch):
+            i = index[batch[0][0, 0, 0]]
+            return [None if i in faceless else (5 + offsets[i], 5, 80 + offsets[i], 80)]
+
+        dwpose = types.SimpleNamespace(
+            model=None,
+            inference_topdown=inference_topdown,
+            merge_data_samples=lambda keypoints: types.SimpleNamespace(pred_instances=types.SimpleNamespace(keypoints=keypoints)),
+            fa=types.SimpleNamespace(get_detections_for_batch=get_detections_for_batch),
+        )
+        return dwpose, frames, detections
+
+    def test_slow_drift_is_interpolated(self, tmp_path):
+        offsets = [i // 6 for i in range(61)]
+        dwpose, frames, detections = self._video(tmp_path, offsets)
+        full = detect_landmarks(dwpose, frames)
+        detections.clear()
+        tracked, detected = detect_landmarks_keyframes(dwpose, frames, interval=10)
+        assert detected == list(range(0, 61, 10))
+        assert sorted(detections) == detected
+        report = keyframe_report(full, tracked)
+        assert report["face_mismatches"] == 0
+        assert report["box_iou_mean"] > 0.95 and report["box_iou_min"] > 0.9
+        assert report["box_max_deviation_px"] <= 2
+
+    def test_jump_is_redetected(self, tmp_path):
+        offsets = [0] * 23 + [20] * 18
+        dwpose, frames, _ = self._video(tmp_path, offsets)
+        tracked, detected = detect_landmarks_keyframes(dwpose, frames, interval=10)
+        assert {22, 23} <= set(detected)
+        assert len(detected) < len(frames) // 2
+        assert keyframe_report(detect_landmarks(dwpose, frames), tracked)["box_max_deviation_px"] == 0
+
+    def test_lost_face_is_redetected(self, tmp_path):
+        # The face leaves the frame for a moment, which changes what the frames look like
+        faceless = set(range(14, 17))
+        brightness = [100 + i if i in faceless else i for i in range(31)]
+        dwpose, frames, _ = self._video(tmp_path, [0] * 31, brightness=brightness, faceless=faceless)
+        tracked, detected = detect_landmarks_keyframes(dwpose, frames, interval=10)
+        assert [i for i, (_, bbox) in enumerate(tracked) if bbox is None] == sorted(faceless)
+        assert {13, 14, 16, 17} <= set(detected)
+
+    def test_appearance_change_is_redetected(self, tmp_path):
+        # The face does not move, but frame 15 does not look like its neighbours
+        brightness = list(range(21))
+        brightness[15] = 200
+        dwpose, frames, _ = self._video(tmp_path, [0] * 21, brightness=brightness)
+        _, detected = detect_landmarks_keyframes(dwpose, frames, interval=10)
+        assert 15 in detected
+        assert len(detected) < len(frames)
@@ -0,0 +1,81 @@
+import time
+import numpy as np
+import pytest
+from musetalk_server.services.audio import SAMPLE_RATE, AudioClip
+from musetalk_server.services.realtime import RealtimePacer, audio_chunks
+
+FPS = 25
+
+
+def _clip(frames, channels=1):
+    samples = frames * SAMPLE_RATE // FPS
+    pcm = np.full((samples, channels) if channels > 1 else samples, 0.5, dtype=np.float32)
+    return AudioClip(pcm, SAMPLE_RATE)
+
+
+def _frames(count, delay=0.0, burst=1):
+    for i in range(count):
+        if delay and i % burst == 0:
+            time.sleep(delay)
+        yield f"frame{i}".encode()
+
+
+def test_audio_chunks_cover_clip_one_per_frame():
+    clip = _clip(10)
+    chunks = audio_chunks(clip, FPS, 10)
+    assert len(chunks) == 10
+    assert {len(c) for c in chunks} == {2 * SAMPLE_RATE // FPS}
+    assert sum(len(c) for c in chunks) == 2 * len(clip.pcm)
+    # 16-bit big-endian
+    assert chunks[0][:2] == int(0.5 * 32767).to_bytes(2, "big", signed=True)
+
+
+def test_audio_chunks_keep_channels_interleaved():
+    chunks = audio_chunks(_clip(4, channels=2), FPS, 4)
+    assert len(chunks[0]) == 2 * 2 * SAMPLE_RATE // FPS
+
+
+def test_pacer_interleaves_audio_before_video_with_pts():
+    closed = []
+    pacer = RealtimePacer(_frames(5), _clip(5), fps=100, prebuffer=2, on_close=lambda: closed.append(True))
+    parts = list(pacer)
+    assert [(p.kind, p.index) for p in parts[:4]] == [("audio", 0), ("video", 0), ("audio", 1), ("video", 1)]
+    assert [p.payload for p in parts if p.kind == "video"] == [f"frame{i}".encode() for i in range(5)]
+    assert [p.pts for p in parts if p.kind == "video"] == pytest.approx([i / 100 for i in range(5)])
+    assert pacer.stats["frames"] == 5
+    assert pacer.stats["underruns"] == 0
+    assert closed == [True]
+
+
+def test_pacer_plays_bursts_at_even_spacing():
+    fps = 50
+    sent = []
+    for part in RealtimePacer(_frames(8), _clip(8), fps=fps, prebuffer=4):
+        if part.kind == "video":
+            sent.append(time.monotonic())
+    gaps = np.diff(sent)
+    assert gaps.min() > 0.5 / fps
+    assert sent[-1] - sent[0] == pytest.approx(7 / fps, abs=0.05)
+
+
+def test_pacer_counts_underruns_when_source_is_slower_than_fps():
+    pacer = RealtimePacer(_frames(6, delay=0.05), _clip(6), fps=100, prebuffer=1)
+    assert len([p for p in pacer if p.kind == "video"]) == 6
+    assert pacer.stats["underruns"] >= 3
+    assert pacer.stats["stall_ms"] > 0
+
+
+def test_pacer_reraises_source_errors_and_closes_source():
+    closed = []
+
+    def frames():
+        try:
+            yield b"frame0"
+            raise RuntimeError("render failed")
+        finally:
+            closed.append(True)
+
+    pacer = RealtimePacer(frames(), _clip(2), fps=100, prebuffer=1)
+    with pytest.raises(RuntimeError, match="render failed"):
+        list(pacer)
+    assert closed == [True]
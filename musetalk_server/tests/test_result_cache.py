@@ -0,0 +1,78 @@
+import os
+import time
+import pytest
+from musetalk_server.services.result_cache import ResultCache
+
+
+def _render(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(b"x" * size)
+    return str(path)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(str(tmp_path / "inference"), max_bytes=250, ttl_seconds=3600)
+
+
+class TestResultCacheKey:
+    def test_key_is_stable(self):
+        a = ResultCache.make_key("av", "v1", "abc", {"fps": 25, "version": "v15"})
+        b = ResultCache.make_key("av", "v1", "abc", {"version": "v15", "fps": 25})
+        assert a == b
+
+    @pytest.mark.parametrize("change", [
+        ("av2", "v1", "abc", {"fps": 25}),
+        ("av", "v2", "abc", {"fps": 25}),
+        ("av", "v1", "abd", {"fps": 25}),
+        ("av", "v1", "abc", {"fps": 30}),
+    ])
+    def test_key_changes_with_content(self, change):
+        assert ResultCache.make_key("av", "v1", "abc", {"fps": 25}) != ResultCache.make_key(*change)
+
+
+class TestResultCache:
+    def test_miss_then_hit(self, cache, tmp_path):
+        assert cache.get("k1") is None
+        stored = cache.put("k1", _render(tmp_path, "r1.mp4", 10))
+        assert cache.get("k1") == stored
+        assert os.path.exists(stored)
+
+    def test_store_larger_than_the_limit_is_kept_until_the_next_store(self, cache, tmp_path):
+        old = cache.put("old", _render(tmp_path, "r0.mp4", 10))
+        stored = cache.put("big", _render(tmp_path, "r1.mp4", 300))
+        assert cache.get("big") == stored
+        assert not os.path.exists(old)
+        cache.put("next", _render(tmp_path, "r2.mp4", 10))
+        assert not os.path.exists(stored)
+
+    def test_disabled_cache_always_misses(self, cache, tmp_path):
+        cache.put("k1", _render(tmp_path, "r1.mp4", 10))
+        cache.enabled = False
+        assert cache.get("k1") is None
+
+    def test_ttl_eviction(self, cache, tmp_path):
+        stored = cache.put("old", _render(tmp_path, "r1.mp4", 10))
+        past = time.time() - 7200
+        os.utime(stored, (past, past))
+        assert cache.get("old") is None
+        cache.evict()
+        assert not os.path.exists(stored)
+
+    def test_size_eviction_is_lru(self, cache, tmp_path):
+        first = cache.put("a", _render(tmp_path, "a.mp4", 100))
+        os.utime(first, (time.time() - 60, time.time() - 60))
+        second = cache.put("b", _render(tmp_path, "b.mp4", 100))
+        os.utime(second, (time.time() - 30, time.time() - 30))
+        cache.get("a")  # refresh: "b" is now least recently used
+        cache.put("c", _render(tmp_path, "c.mp4", 100))
+        assert os.path.exists(first)
+        assert not os.path.exists(second)
+
+    def test_in_progress_renders_are_kept(self, cache, tmp_path):
+        os.makedirs(cache.root, exist_ok=True)
+        partial = os.path.join(cache.root, "tmp_render.mp4")
+        with open(partial, "wb") as f:
+            f.write(b"x" * 1000)
+        cache.evict()
+        assert os.path.exists(partial)
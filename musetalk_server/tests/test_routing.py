@@ -0,0 +1,187 @@
+import json
+import asyncio
+import httpx
+from musetalk_server.core.metrics import metrics
+from musetalk_server.routing import AffinityMiddleware, AffinityRouter, HashRing, node_tag, routing_key
+from musetalk_server.services.jobs import JobManager
+
+NODES = ["http://a", "http://b", "http://c"]
+
+
+def _capacity(hot=(), spare=100.0, status="ready"):
+    return {"status": status, "fps": 25, "spare_fps": spare, "queue_depth": 0,
+            "hot_avatars": [{"avatar_id": a} for a in hot]}
+
+
+def _scope(path, method="GET", headers=(), query=b""):
+    return {"type": "http", "method": method, "path": path, "raw_path": path.encode(), "query_string": query,
+            "headers": [(k.lower(), v) for k, v in headers]}
+
+
+def test_ring_moves_only_the_removed_nodes_avatars():
+    full, reduced = HashRing(NODES), HashRing(["http://a", "http://c"])
+    keys = [f"avatar{i}" for i in range(200)]
+    moved = [k for k in keys if full.walk(k)[0] != "http://b" and full.walk(k)[0] != reduced.walk(k)[0]]
+    assert moved == []
+    assert sorted(full.walk("anna")) == NODES
+
+
+def test_prefers_a_node_with_the_avatar_loaded():
+    router = AffinityRouter(NODES)
+    owner = router.ring.walk("anna")[0]
+    other = router.ring.walk("anna")[2]
+    for url in NODES:
+        router.update(url, _capacity(hot=["anna"] if url == other else ()))
+    hits = metrics.get("routing.affinity_hits")
+    assert router.choose("anna") == other
+    assert metrics.get("routing.affinity_hits") - hits == 1
+
+    # Saturated: the avatar goes to the first node on the ring with room instead
+    router.update(other, _capacity(hot=["anna"], spare=10.0))
+    assert router.choose("anna") == owner
+
+
+def test_bookings_spread_a_burst_until_the_next_poll():
+    router = AffinityRouter(NODES)
+    for url in NODES:
+        router.update(url, _capacity(spare=40.0))
+    chosen = [router.choose(f"avatar{i}") for i in range(3)]
+    # Each node had room for one more 25 fps stream
+    assert sorted(chosen) == NODES
+    fallbacks = metrics.get("routing.fallbacks")
+    router.choose("avatar9")
+    assert metrics.get("routing.fallbacks") - fallbacks == 1
+
+
+def test_down_and_starting_nodes_are_skipped():
+    router = AffinityRouter(NODES)
+    order = router.ring.walk("anna")
+    router.update(order[0], None)
+    router.update(order[1], _capacity(status="starting"))
+    router.update(order[2], _capacity())
+    assert router.choose("anna") == order[2]
+    assert router.choose(None, render=False) == order[2]
+
+
+def test_routing_key():
+    assert routing_key(_scope("/inference/stream/anna", "POST"), b"") == ("avatar", "anna")
+    assert routing_key(_scope("/avatars/anna/bundle/frames/3"), b"") == ("avatar", "anna")
+    assert routing_key(_scope("/avatars/preprocess", "POST"), b"") == (None, None)
+    assert routing_key(_scope("/sessions/s1/stream"), b"") == ("sessions", "s1")
+    assert routing_key(_scope("/jobs", headers=[(b"X-Avatar-Id", b"ben")]), b"") == ("avatar", "ben")
+    multipart = [(b"content-type", b"multipart/form-data; boundary=x")]
+    body = b'--x\r\nContent-Disposition: form-data; name="avatar_id"\r\n\r\nanna\r\n--x--\r\n'
+    assert routing_key(_scope("/sessions", "POST", multipart), body) == ("avatar", "anna")
+    form = [(b"content-type", b"application/x-www-form-urlencoded")]
+    assert routing_key(_scope("/sessions", "POST", form), b"avatar_id=ben&batch_size=4") == ("avatar", "ben")
+
+
+class _Harness:
+    """AffinityMiddleware in node mode ("http://a") over fake upstream nodes."""
+
+    def __init__(self, capacities):
+        self.forwarded = []
+        self.bodies = []
+        self.local = []
+        self.pulled = 0
+
+        def upstream(request):
+            node = f"{request.url.scheme}://{request.url.host}"
+            if request.url.path == "/capacity":
+                return httpx.Response(200, json=capacities[node])
+            self.forwarded.append((node, request.url.path, request.headers.get("x-musetalk-routed")))
+            self.bodies.append(request.content)
+            if request.url.path == "/sessions":
+                return httpx.Response(200, stream=httpx.ByteStream(b'{"session_id": "s1"}'))
+            return httpx.Response(200, stream=httpx.ByteStream(b"from " + node.encode()))
+
+        async def app(scope, receive, send):
+            message = await receive()
+            self.local.append((scope["path"], message["body"]))
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"local"})
+
+        self.middleware = AffinityMiddleware(app, AffinityRouter(NODES), self_url="http://a",
+                                             transport=httpx.MockTransport(upstream))
+
+    def request(self, scope, body=b"", chunks=None):
+        messages = []
+        chunks = chunks or [body]
+        received = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+                    for i, chunk in enumerate(chunks)]
+        self.pulled = 0
+
+        async def receive():
+            if received:
+                self.pulled += 1
+                return received.pop(0)
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(self.middleware(scope, receive, send))
+        return messages[0]["status"], b"".join(m.get("body", b"") for m in messages[1:])
+
+
+def test_middleware_forwards_to_the_hot_node_and_pins_sessions():
+    harness = _Harness({"http://a": _capacity(), "http://b": _capacity(hot=["anna"]), "http://c": _capacity()})
+
+    assert harness.request(_scope("/inference/stream/anna", "POST")) == (200, b"from http://b")
+    assert harness.forwarded == [("http://b", "/inference/stream/anna", "1")]
+
+    form = [(b"content-type", b"application/x-www-form-urlencoded")]
+    status, body = harness.request(_scope("/sessions", "POST", form), b"avatar_id=anna")
+    assert json.loads(body) == {"session_id": "s1"}
+    # Follow-up requests for the session go where it was created
+    harness.request(_scope("/sessions/s1/stream"))
+    assert harness.forwarded[-1][:2] == ("http://b", "/sessions/s1/stream")
+
+    # No avatar, or an unknown session: served by this node
+    assert harness.request(_scope("/avatars")) == (200, b"local")
+    assert harness.request(_scope("/sessions/other")) == (200, b"local")
+    # Already forwarded by another node: never routed again
+    assert harness.request(_scope("/inference/stream/anna", "POST", [(b"x-musetalk-routed", b"1")]),
+                           b"audio") == (200, b"local")
+    assert harness.local[-1] == ("/inference/stream/anna", b"audio")
+
+
+def test_uploads_are_streamed_after_the_routing_key(monkeypatch):
+    harness = _Harness({"http://a": _capacity(), "http://b": _capacity(hot=["anna"]), "http://c": _capacity()})
+    pulled_when_routed = []
+    choose = harness.middleware.router.choose
+    monkeypatch.setattr(harness.middleware.router, "choose",
+                        lambda *args: (pulled_when_routed.append(harness.pulled), choose(*args))[1])
+    multipart = [(b"content-type", b"multipart/form-data; boundary=xyz")]
+    chunks = [
+        b'--xyz\r\nContent-Disposition: form-data; name="avatar_id"\r\n\r\nan',
+        b'na\r\n--xyz\r\nContent-Disposition: form-data; name="video_file"; filename="v.mp4"\r\n\r\n',
+        b"v" * 100_000,
+        b"v" * 100_000 + b"\r\n--xyz--\r\n",
+    ]
+
+    # Read up to the avatar_id field only; the video is streamed on to the node
+    assert harness.request(_scope("/avatars/preprocess", "POST", multipart), chunks=chunks) == (200, b"from http://b")
+    assert pulled_when_routed == [2]
+    assert harness.bodies[-1] == b"".join(chunks)
+
+    # Keyed by the header: only the first chunk is read before routing
+    headers = multipart + [(b"x-avatar-id", b"anna")]
+    assert harness.request(_scope("/avatars/preprocess", "POST", headers), chunks=chunks) == (200, b"from http://b")
+    assert pulled_when_routed[-1] == 1
+    assert harness.bodies[-1] == b"".join(chunks)
+
+    # A urlencoded value split across chunks is not cut short
+    form = [(b"content-type", b"application/x-www-form-urlencoded")]
+    harness.request(_scope("/sessions", "POST", form), chunks=[b"avatar_id=an", b"na&batch_size=4"])
+    assert harness.forwarded[-1][:2] == ("http://b", "/sessions")
+
+
+def test_follow_ups_reach_the_creating_node_without_a_pin(tmp_path):
+    # Created on node b; the balancer sends the follow-ups to node a, which never saw the create
+    harness = _Harness({url: _capacity() for url in NODES})
+    job_id = JobManager(str(tmp_path), id_prefix=node_tag("http://b/")).new_job_id()
+    assert harness.request(_scope(f"/jobs/{job_id}")) == (200, b"from http://b")
+    assert harness.request(_scope(f"/sessions/{node_tag('http://c')}-0f1e/stream")) == (200, b"from http://c")
+    assert harness.request(_scope(f"/sessions/{node_tag('http://a')}-0f1e")) == (200, b"local")
+    assert harness.request(_scope("/jobs/0f1e")) == (200, b"local")
@@ -0,0 +1,168 @@
+import time
+import types
+import threading
+import pytest
+import torch
+from musetalk_server.core.metrics import metrics
+from musetalk_server.core.scheduler import GpuScheduler, parse_priority_keys
+from musetalk_server.services.capacity import capacity_report
+
+
+def _wait_for(condition, timeout=2.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.005)
+
+
+def _queue_behind(scheduler, tickets):
+    """Holds the device while `tickets` queue up (in list order); returns the order they got their turns."""
+    holder = scheduler.ticket("interactive")
+    assert scheduler.acquire(holder)
+    order = []
+
+    def run(name, ticket):
+        scheduler.acquire(ticket)
+        order.append(name)
+        scheduler.release(ticket)
+
+    threads = []
+    for name, ticket in tickets:
+        thread = threading.Thread(target=run, args=(name, ticket))
+        thread.start()
+        threads.append(thread)
+        _wait_for(lambda: len(scheduler._waiting) == len(threads))
+    scheduler.release(holder)
+    for thread in threads:
+        thread.join()
+    return order
+
+
+def test_higher_class_gets_the_next_turn():
+    scheduler = GpuScheduler(slots=1, aging_seconds=0)
+    order = _queue_behind(scheduler, [
+        ("bulk", scheduler.ticket("bulk")),
+        ("standard", scheduler.ticket("standard")),
+        ("interactive", scheduler.ticket("interactive")),
+    ])
+    assert order == ["interactive", "standard", "bulk"]
+
+
+def test_earliest_deadline_first_within_a_class():
+    scheduler = GpuScheduler(slots=1, aging_seconds=0)
+    ahead = scheduler.ticket("interactive", fps=25)
+    behind = scheduler.ticket("interactive", fps=25)
+    # 2 s of frames already rendered: its next batch isn't due for a while
+    ahead.frames = 50
+    assert _queue_behind(scheduler, [("ahead", ahead), ("behind", behind)]) == ["behind", "ahead"]
+
+
+def test_aging_keeps_bulk_work_from_starving():
+    scheduler = GpuScheduler(slots=1, aging_seconds=0.05)
+    bulk = scheduler.ticket("bulk")
+    holder = scheduler.ticket("interactive")
+    assert scheduler.acquire(holder)
+    order = []
+
+    def run(name, ticket):
+        scheduler.acquire(ticket)
+        order.append(name)
+        scheduler.release(ticket)
+
+    waiter = threading.Thread(target=run, args=("bulk", bulk))
+    waiter.start()
+    # Waited two aging periods: now in the interactive class, with the older deadline
+    time.sleep(0.12)
+    late = threading.Thread(target=run, args=("interactive", scheduler.ticket("interactive")))
+    late.start()
+    _wait_for(lambda: len(scheduler._waiting) == 2)
+    scheduler.release(holder)
+    waiter.join()
+    late.join()
+    assert order == ["bulk", "interactive"]
+
+
+def test_preemptions_are_counted_for_the_passed_over_class():
+    scheduler = GpuScheduler(slots=1, aging_seconds=0)
+    before = metrics.get("scheduler.preemptions.bulk")
+    _queue_behind(scheduler, [("bulk", scheduler.ticket("bulk")), ("interactive", scheduler.ticket("interactive"))])
+    assert metrics.get("scheduler.preemptions.bulk") - before == 1
+
+
+def test_iterate_takes_one_turn_per_batch():
+    scheduler = GpuScheduler(slots=1)
+    ticket = scheduler.ticket("standard", fps=25)
+    active = []
+
+    def batches():
+        for _ in range(3):
+            active.append(scheduler.active)
+            yield [0] * 4
+
+    assert len(list(ticket.iterate(batches()))) == 3
+    assert active == [1, 1, 1]
+    assert scheduler.active == 0
+    assert (ticket.batches, ticket.frames) == (3, 12)
+
+
+def test_iterate_stops_when_cancelled_while_waiting():
+    scheduler = GpuScheduler(slots=1)
+    holder = scheduler.ticket("interactive")
+    assert scheduler.acquire(holder)
+    cancelled = threading.Event()
+    threading.Timer(0.05, cancelled.set).start()
+    assert list(scheduler.ticket("bulk").iterate(iter([[1]]), cancelled.is_set)) == []
+    assert scheduler._waiting == []
+    scheduler.release(holder)
+
+
+def test_zero_slots_disables_scheduling():
+    scheduler = GpuScheduler(slots=0)
+    tickets = [scheduler.ticket("bulk") for _ in range(3)]
+    assert all(scheduler.acquire(t) for t in tickets)
+    assert scheduler.active == 0
+
+
+def test_parse_priority_keys():
+    assert parse_priority_keys("a=interactive, b = bulk,") == {"a": "interactive", "b": "bulk"}
+    assert parse_priority_keys("") == {}
+    with pytest.raises(ValueError):
+        parse_priority_keys("a=urgent")
+    with pytest.raises(ValueError):
+        GpuScheduler().ticket("urgent")
+
+
+def test_load_reports_running_renders_and_throughput():
+    scheduler = GpuScheduler(slots=1)
+    stream = scheduler.ticket("interactive", fps=25)
+    batch = scheduler.ticket("bulk")
+    loads = []
+
+    def batches():
+        time.sleep(0.02)
+        loads.append(scheduler.load())
+        yield [0] * 4
+
+    running = batch.iterate(batches())
+    next(running)
+    list(stream.iterate(batches()))
+    assert loads[1]["renders"] == {"interactive": 1, "standard": 0, "bulk": 1}
+    assert (loads[1]["realtime_renders"], loads[1]["realtime_fps"]) == (1, 25)
+    # ~5 ms of device time per frame
+    assert 50 < scheduler.load()["throughput_fps"] < 200
+    running.close()
+    assert scheduler.load()["renders"]["bulk"] == 0
+
+
+def test_capacity_report():
+    scheduler = GpuScheduler(slots=1)
+    scheduler.record(4, 20.0)
+    avatar = types.SimpleNamespace(avatar_id="anna", is_loaded=True, memory_bytes=3 * 1024 * 1024, is_pinned=False)
+    report = capacity_report(scheduler, types.SimpleNamespace(list=lambda: [1]), types.SimpleNamespace(pending=lambda: 2),
+                             {"anna": avatar}, torch.device("cpu"), fps=25)
+    assert (report["capacity_fps"], report["spare_fps"]) == (200.0, 200.0)
+    assert report["queue_depth"] == 2 and report["open_sessions"] == 1
+    assert report["hot_avatars"] == [{"avatar_id": "anna", "memory_mb": 3.0, "pinned": False}]
+    assert report["host_memory_total_mb"] > 0 and report["device_memory_free_mb"] is None
+    assert capacity_report(scheduler, types.SimpleNamespace(list=list), types.SimpleNamespace(pending=int), {},
+                           torch.device("cpu"), fps=25, capacity_fps=20)["spare_fps"] == 20
@@ -0,0 +1,104 @@
+import types
+import cv2
+import numpy as np
+import pytest
+import torch
+from musetalk_server.core.avatar import Avatar
+from musetalk_server.services import session as session_module
+from musetalk_server.services.audio import SAMPLE_RATE, AudioClip
+from musetalk_server.services.inference import InferenceModels
+from musetalk_server.services.session import AvatarSession
+from musetalk_server.tests.conftest import FakeFeatureExtractor, FakeEncoder
+from musetalk_server.tests.conftest import write_avatar, CYCLE_LEN
+
+# Session tests drive the real workers with an engine whose output encodes the
+# latent (= cycle index) it was given, so the played sequence can be checked
+# frame by frame. Idle frames are the avatar's cycle frames (value 10 * index).
+
+FPS = 50
+UTTERANCE_FRAMES = 10
+
+
+class _CycleEngine:
+    name = "cycle"
+    dtype = torch.float32
+
+    def encode_audio(self, whisper_batch):
+        return whisper_batch
+
+    def predict(self, latents, audio_features):
+        return latents
+
+    def decode(self, latents):
+        values = 100 + 20 * latents[:, 0, 0, 0].round().to(torch.uint8).numpy()
+        return np.broadcast_to(values[:, None, None, None], (len(values), 16, 16, 3)).copy()
+
+
+def _decode_cycle_index(jpeg_bytes):
+    """(is_speech, cycle index) of a frame produced by the stand-ins."""
+    value = cv2.imdecode(np.frombuffer(jpeg_bytes, np.uint8), cv2.IMREAD_COLOR).mean()
+    if value >= 90:
+        return True, int(round((value - 100) / 20))
+    return False, int(round(value / 10))
+
+
+@pytest.fixture
+def session(tmp_path, monkeypatch):
+    write_avatar(str(tmp_path))
+    avatar = Avatar("tiny", results_dir=str(tmp_path))
+    monkeypatch.setattr(session_module, "encode_frame",
+                        lambda avatar, res_frame, idx, *args: cv2.imencode('.jpg', res_frame)[1].tobytes())
+    models = InferenceModels(
+        vae=None,
+        unet=types.SimpleNamespace(model=types.SimpleNamespace(dtype=torch.float32)),
+        pe=None,
+        audio_processor=types.SimpleNamespace(feature_extractor=FakeFeatureExtractor()),
+        whisper=types.SimpleNamespace(encoder=FakeEncoder()),
+        timesteps=None,
+        engine=_CycleEngine(),
+    )
+    session = AvatarSession("test", avatar, models, torch.device("cpu"), fps=FPS, batch_size=4)
+    yield session
+    session.close()
+
+
+def _utterance():
+    return AudioClip(np.zeros(UTTERANCE_FRAMES * SAMPLE_RATE // FPS, dtype=np.float32), SAMPLE_RATE)
+
+
+def _play(session, frames, count):
+    return [_decode_cycle_index(next(frames)) for _ in range(count)]
+
+
+class TestAvatarSession:
+    def test_pins_avatar_until_closed(self, session):
+        assert session.avatar.is_pinned
+        session.close()
+        assert not session.avatar.is_pinned
+
+    def test_idle_frames_between_utterances(self, session):
+        frames = session.frames()
+        played = _play(session, frames, 3)
+        assert played == [(False, i) for i in range(3)]
+
+    def test_cycle_position_carries_over(self, session):
+        frames = session.frames()
+        played = _play(session, frames, 2)
+        for _ in range(2):
+            session.push(_utterance())
+        # Idle frames may play until the first batch is ready; afterwards both
+        # utterances follow back to back, then idle resumes where they ended.
+        while not played[-1][0] or session.info()["utterances_done"] < 2 or session.info()["pending_frames"]:
+            played.append(_decode_cycle_index(next(frames)))
+        played += _play(session, frames, 2)
+
+        indices = [idx for _, idx in played]
+        assert indices == [i % CYCLE_LEN for i in range(len(played))]
+        assert sum(is_speech for is_speech, _ in played) >= 2 * (UTTERANCE_FRAMES - 1)
+        assert not played[-1][0]
+
+    def test_second_consumer_rejected(self, session):
+        frames = session.frames()
+        next(frames)
+        with pytest.raises(RuntimeError):
+            next(session.frames())
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+import torch
+from musetalk_server.core.avatar import Avatar
+from musetalk_server.core.shared_store import SharedAvatarStore
+from musetalk_server.tests.conftest import CYCLE_LEN, write_avatar
+
+
+@pytest.fixture
+def store(tmp_path):
+    write_avatar(str(tmp_path / "results"))
+    return SharedAvatarStore(str(tmp_path / "shm"))
+
+
+def _load(tmp_path, store, decodes):
+    avatar = Avatar("tiny", results_dir=str(tmp_path / "results"))
+    decode = avatar._decode
+    avatar._decode = lambda workers: (decodes.append(1), decode(workers))
+    avatar.load_state(store=store)
+    return avatar
+
+
+def test_second_load_maps_published_copy(tmp_path, store):
+    decodes = []
+    first = _load(tmp_path, store, decodes)
+    second = _load(tmp_path, store, decodes)
+    assert len(decodes) == 1
+
+    private = Avatar("tiny", results_dir=str(tmp_path / "results"))
+    private.load_state()
+    for a, b in zip(second.frame_list_cycle + second.mask_list_cycle,
+                    private.frame_list_cycle + private.mask_list_cycle):
+        assert np.array_equal(a, b)
+    assert torch.equal(second.latent_cycle, private.latent_cycle)
+    assert first.shared_ref != second.shared_ref
+
+
+def test_mapping_is_copy_on_write(tmp_path, store):
+    first = _load(tmp_path, store, [])
+    second = _load(tmp_path, store, [])
+    first.frame_list_cycle[1][:] = 255
+    assert second.frame_list_cycle[1][0, 0, 0] == 10
+
+
+def test_collect_keeps_referenced_entries(tmp_path, store):
+    avatar = _load(tmp_path, store, [])
+    assert store.collect() == []
+    store.detach(avatar)
+    assert len(store.collect()) == 1
+    assert not any(name.endswith(".bin") for name in os.listdir(store.root))
+
+
+def test_collect_drops_refs_of_exited_processes(tmp_path, store):
+    avatar = _load(tmp_path, store, [])
+    dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                          capture_output=True, text=True).stdout.strip()
+    os.rename(avatar.shared_ref, os.path.join(os.path.dirname(avatar.shared_ref), f"{dead}-0"))
+    assert len(store.collect()) == 1
+    # A new load publishes the avatar again
+    decodes = []
+    assert len(_load(tmp_path, store, decodes).frame_list_cycle) == CYCLE_LEN
+    assert len(decodes) == 1
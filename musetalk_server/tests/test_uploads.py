@@ -0,0 +1,36 @@
+import io
+import json
+import os
+import time
+from musetalk_server.services.uploads import UploadStore
+
+
+def _reference(results_dir, avatar_id, video_path):
+    avatar_path = os.path.join(results_dir, "v15", "avatars", avatar_id)
+    os.makedirs(avatar_path)
+    with open(os.path.join(avatar_path, "avator_info.json"), "w") as f:
+        json.dump({"avatar_id": avatar_id, "video_path": video_path}, f)
+
+
+def test_uploads_are_content_addressed(tmp_path):
+    store = UploadStore(str(tmp_path / "uploads"), grace_seconds=0)
+    sha_a, path_a = store.save(io.BytesIO(b"video-bytes"), "talk.MP4")
+    sha_b, path_b = store.save(io.BytesIO(b"video-bytes"), "other_name.mp4")
+    assert sha_a == sha_b and path_a == path_b
+    assert os.path.basename(path_a) == f"{sha_a}.mp4"
+    assert os.listdir(tmp_path / "uploads") == [os.path.basename(path_a)]
+
+
+def test_gc_keeps_referenced_and_recent_uploads(tmp_path):
+    results_dir = str(tmp_path / "results")
+    store = UploadStore(os.path.join(results_dir, "uploads"), grace_seconds=60)
+    _, kept = store.save(io.BytesIO(b"referenced"), "a.mp4")
+    _, orphan = store.save(io.BytesIO(b"orphan"), "b.mp4")
+    _, fresh = store.save(io.BytesIO(b"fresh"), "c.mp4")
+    _reference(results_dir, "alice", kept)
+    old = time.time() - 120
+    for path in (kept, orphan):
+        os.utime(path, (old, old))
+
+    assert store.gc(results_dir) == [os.path.basename(orphan)]
+    assert os.path.exists(kept) and os.path.exists(fresh)
@@ -0,0 +1,42 @@
+import os
+import time
+from musetalk_server.services.warmup import Warmup, mark_used, preload_list, recent_avatars
+
+
+def _avatar_dirs(root, ids):
+    for age, avatar_id in enumerate(ids):
+        path = root / avatar_id
+        path.mkdir(parents=True)
+        (path / "avator_info.json").write_text("{}")
+        stamp = time.time() - 100 * (age + 1)
+        os.utime(path / "avator_info.json", (stamp, stamp))
+
+
+def test_recent_avatars_prefers_last_used(tmp_path):
+    _avatar_dirs(tmp_path, ["newest", "middle", "oldest"])
+    assert recent_avatars(str(tmp_path), 2) == ["newest", "middle"]
+    mark_used(str(tmp_path / "oldest"))
+    assert recent_avatars(str(tmp_path), 2) == ["oldest", "newest"]
+    assert recent_avatars(str(tmp_path), 0) == []
+
+
+def test_preload_list_merges_configured_and_recent(tmp_path):
+    _avatar_dirs(tmp_path, ["a", "b", "c"])
+    assert preload_list(" c, x ,", 2, str(tmp_path)) == ["c", "x", "a", "b"]
+
+
+def test_warmup_reports_done_after_all_loads():
+    warmup = Warmup()
+    assert warmup.is_done
+
+    def load(avatar_id):
+        assert not warmup.is_done
+        if avatar_id == "broken":
+            raise ValueError("corrupt")
+        return avatar_id != "missing"
+
+    warmup.start(["a", "broken", "missing", "b"], load, parallel=2)
+    assert warmup.wait(5)
+    assert sorted(warmup.loaded) == ["a", "b"]
+    assert sorted(warmup.failed) == ["broken", "missing"]
+    assert warmup.pending == []
@@ -15,4 +15,4 @@ echo "  PYTHONPATH: $PYTHONPATH"
 # Run from MuseTalk dir so upstream imports resolve
 cd "$MUSETALK_DIR"
 
-"$PYTHON_BIN" -m pytest "$ROOT_DIR/musetalk_server/tests/test_api.py" -v "$@"
+"$PYTHON_BIN" -m pytest "$ROOT_DIR/musetalk_server/tests" -v "$@"
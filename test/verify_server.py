@@ -49,8 +49,8 @@ def check_health():
             r = httpx.get(f"{SERVER_URL}/health", timeout=5.0)
             if r.status_code == 200:
                 data = r.json()
-                if data.get("status") == "running":
-                    if not VERIFY_REQUIRE_MODELS or data.get("models", {}).get("loaded"):
+                if data.get("status") in ("ready", "starting"):
+                    if not VERIFY_REQUIRE_MODELS or data.get("status") == "ready":
                         log("Server is healthy and models loaded.", "SUCCESS")
                         return True
         except Exception: